@@ -1,5 +1,37 @@
+import hashlib
+
+
+def _canonical(value):
+    """Return value normalized so its repr() is stable across parses.
+
+    Configuration objects referenced from within other configuration
+    (e.g. the ports of a VLAN) are represented by their identity only,
+    so a digest covers exactly one object's own configuration.
+    """
+    if isinstance(value, Conf):
+        return value.conf_ref()
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted(
+            (_canonical(key), _canonical(val))
+            for key, val in value.iteritems())))
+    if isinstance(value, (list, tuple)):
+        return ('list', tuple(_canonical(val) for val in value))
+    if isinstance(value, (set, frozenset)):
+        return ('set', tuple(sorted(_canonical(val) for val in value)))
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def digest(value):
+    """Return a hex SHA-256 digest of a normalized configuration value."""
+    return hashlib.sha256(repr(_canonical(value))).hexdigest()
+
+
 class Conf(object):
     defaults = {}
+    # Set once the configuration is final, when the digest may be cached.
+    _conf_digest = None
 
     def update(self, dictionary):
         # TODO: it would be good to warn on keys that are set but arent in
@@ -9,3 +41,47 @@ class Conf(object):
     def _set_default(self, key, value):
         if key not in self.__dict__ or self.__dict__[key] is None:
             self.__dict__[key] = value
+
+    def conf_ref(self):
+        """Return how this object is referred to from other configuration."""
+        return (self.__class__.__name__, self._id)
+
+    def _digest_items(self):
+        """Return (key, value) items that make up this configuration.
+
+        Dynamic state (dyn_ prefixed attributes) is not configuration.
+        """
+        return [
+            (key, value) for key, value in self.__dict__.iteritems()
+            if not key.startswith('dyn_') and not key.startswith('_conf_')]
+
+    def _compute_conf_digest(self):
+        return digest((self.__class__.__name__, dict(self._digest_items())))
+
+    def conf_digest(self):
+        """Return a digest of this object's configuration.
+
+        Until finalize_digest() is called, the digest is recomputed each
+        time as the configuration may still be changing while parsed.
+
+        Returns:
+            str: hex SHA-256 of the normalized configuration.
+        """
+        if self._conf_digest is not None:
+            return self._conf_digest
+        return self._compute_conf_digest()
+
+    def finalize_digest(self):
+        """Cache the digest, once configuration will no longer change."""
+        self._conf_digest = self._compute_conf_digest()
+
+    def __hash__(self):
+        return hash(self.conf_digest())
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, self.__class__) and
+            self.conf_digest() == other.conf_digest())
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
@@ -13,11 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
 import hashlib
 import logging
+import marshal
 import os
+import sys
 import yaml
 
+from conf import digest
 from dp import DP
 from port import Port
 from vlan import VLAN
@@ -26,21 +30,143 @@ from watcher_conf import WatcherConf
 def get_logger(logname):
     return logging.getLogger(logname + '.config')
 
-def read_config(config_file, logname):
-    logger = get_logger(logname)
+# Use libyaml's loader if PyYAML was built with it, as it is much faster.
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Parsed configuration by file name, with the SHA256 hash of the contents
+# it was parsed from, so that unchanged files are not parsed again.
+_config_file_cache = {}
+
+# Identifies compiled config caches written by this Python version,
+# as the marshal format is specific to it.
+_COMPILED_CACHE_MAGIC = 'faucet config cache %s' % sys.version
+
+
+def _compiled_cache_file(config_file):
+    config_dir, config_name = os.path.split(config_file)
+    return os.path.join(config_dir, '.%s.cache' % config_name)
+
+def _read_compiled_cache(config_file, config_hash):
+    """Return parsed config from a compiled cache, if it matches the file.
+
+    Args:
+        config_file (str): name of config file.
+        config_hash (str): SHA256 hash of config file contents.
+    Returns:
+        dict: parsed config, or None if there is no valid cache.
+    """
     try:
-        with open(config_file, 'r') as stream:
-            conf = yaml.safe_load(stream)
-    except yaml.YAMLError as ex:
-        logger.error('Error in file %s (%s)', config_file, str(ex))
+        with open(_compiled_cache_file(config_file), 'rb') as cache:
+            magic, cache_hash, conf = marshal.load(cache)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if magic != _COMPILED_CACHE_MAGIC or cache_hash != config_hash:
         return None
     return conf
 
+def _write_compiled_cache(config_file, config_hash, conf, logname):
+    """Save parsed config, so that it need not be parsed again."""
+    logger = get_logger(logname)
+    cache_file = _compiled_cache_file(config_file)
+    tmp_cache_file = '%s.%u' % (cache_file, os.getpid())
+    try:
+        contents = marshal.dumps((_COMPILED_CACHE_MAGIC, config_hash, conf))
+        with open(tmp_cache_file, 'wb') as cache:
+            cache.write(contents)
+        os.rename(tmp_cache_file, cache_file)
+    except (IOError, OSError, ValueError) as err:
+        logger.debug('cannot write config cache %s: %s', cache_file, err)
+        if os.path.exists(tmp_cache_file):
+            os.remove(tmp_cache_file)
+
+# (mtime, size, inode) and SHA256 hash of config files by file name, so that
+# a file need only be read and hashed again if its stat has changed.
+_config_file_stats = {}
+# Contents of files read by config_file_hash(), until they are parsed.
+_config_file_contents = {}
+
+def _config_file_stat(config_file_name):
+    stat = os.stat(config_file_name)
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
 def config_file_hash(config_file_name):
-    config_file = open(config_file_name)
-    return hashlib.sha256(config_file.read()).hexdigest()
+    """Return the SHA256 hash of a config file.
+
+    The file is only read if its stat has changed since it was last hashed.
+    The contents read are kept for _read_config_file(), as the file is
+    likely to be parsed next.
+
+    Args:
+        config_file_name (str): name of config file.
+    Returns:
+        str: hex SHA256 hash of the file's contents.
+    """
+    # stat before reading, so a change while reading is seen next time.
+    stat = _config_file_stat(config_file_name)
+    stat_hash = _config_file_stats.get(config_file_name, None)
+    if stat_hash is not None and stat_hash[0] == stat:
+        return stat_hash[1]
+    with open(config_file_name, 'r') as config_file:
+        contents = config_file.read()
+    config_hash = hashlib.sha256(contents).hexdigest()
+    _config_file_stats[config_file_name] = (stat, config_hash)
+    _config_file_contents[config_file_name] = contents
+    return config_hash
+
+def _read_config_file(config_file, logname):
+    """Return the hash and the parsed contents of a config file.
+
+    Args:
+        config_file (str): name of config file.
+        logname (str): logger name.
+    Returns:
+        tuple: (str, dict): SHA256 hash of the file, and its config (None
+            if the file could not be parsed).
+    """
+    logger = get_logger(logname)
+    config_hash = config_file_hash(config_file)
+    contents = _config_file_contents.pop(config_file, None)
+    cached = _config_file_cache.get(config_file, None)
+    if cached is None or cached[0] != config_hash:
+        if contents is None:
+            # Hashed, but not parsed, before.
+            with open(config_file, 'r') as stream:
+                contents = stream.read()
+            config_hash = hashlib.sha256(contents).hexdigest()
+        # A compiled cache of each config file is kept next to it, if
+        # FAUCET_CONFIG_CACHE is set.
+        compiled_cache = os.getenv('FAUCET_CONFIG_CACHE', '')
+        conf = None
+        if compiled_cache:
+            conf = _read_compiled_cache(config_file, config_hash)
+        if conf is None:
+            try:
+                conf = yaml.load(contents, Loader=_YAML_LOADER)
+            except yaml.YAMLError as ex:
+                logger.error('Error in file %s (%s)', config_file, str(ex))
+                return (config_hash, None)
+            if compiled_cache:
+                _write_compiled_cache(config_file, config_hash, conf, logname)
+        cached = (config_hash, conf)
+        _config_file_cache[config_file] = cached
+    # Parsed config is modified as it is applied, so return a copy.
+    return (config_hash, copy.deepcopy(cached[1]))
+
+def read_config(config_file, logname):
+    _, conf = _read_config_file(config_file, logname)
+    return conf
 
-def dp_parser(config_file, logname):
+def dp_parser(config_file, logname, current_dps=None):
+    """Parse DPs from a config file.
+
+    Args:
+        config_file (str): name of config file.
+        logname (str): logger name.
+        current_dps (list): DPs from a previous parse, that are returned
+            again in place of new DPs if their configuration is unchanged.
+    Returns:
+        tuple: (dict, list): hashes of config files loaded, and DPs.
+    """
     logger = get_logger(logname)
     conf = read_config(config_file, logname)
     if conf is None:
@@ -54,18 +180,26 @@ def dp_parser(config_file, logname):
         logger.fatal(
             'Version 1 config is UNSUPPORTED. Please move to version 2')
     elif version == 2:
-        config_hashes, dps = _dp_parser_v2(conf, config_file, logname)
+        result = _dp_parser_v2(conf, config_file, logname, current_dps)
+        if result is None:
+            return None
+        config_hashes, dps = result
     else:
         logger.error('unsupported config version number %s', version)
 
     if dps is not None:
-        for dp in dps:
+        # DPs reused from a previous parse are already finalized.
+        reused_dps = set(id(dp) for dp in current_dps or [])
+        new_dps = [dp for dp in dps if id(dp) not in reused_dps]
+        dp_by_name = dict([(dp.name, dp) for dp in dps])
+        for dp in new_dps:
             try:
-                dp.finalize_config(dps)
+                dp.finalize_config(dp_by_name)
             except AssertionError as err:
                 logger.exception('Error finalizing datapath configs: %s', err)
-        for dp in dps:
-            dp.resolve_stack_topology(dps)
+        DP.resolve_stack_topology(dps)
+        for dp in new_dps:
+            dp.finalize_digest()
 
     return config_hashes, dps
 
@@ -77,11 +211,13 @@ def port_parser(dp_id, p_identifier, port_conf, vlans):
         return port
     if port.native_vlan is not None:
         v_identifier = port.native_vlan
-        vlan = vlans.setdefault(v_identifier, VLAN(v_identifier, dp_id))
-        vlan.untagged.append(port)
+        if v_identifier not in vlans:
+            vlans[v_identifier] = VLAN(v_identifier, dp_id)
+        vlans[v_identifier].untagged.append(port)
     for v_identifier in port.tagged_vlans:
-        vlan = vlans.setdefault(v_identifier, VLAN(v_identifier, dp_id))
-        vlan.tagged.append(port)
+        if v_identifier not in vlans:
+            vlans[v_identifier] = VLAN(v_identifier, dp_id)
+        vlans[v_identifier].tagged.append(port)
 
     return port
 
@@ -91,21 +227,21 @@ def _dp_config_path(config_file, parent_file=None):
     else:
         return os.path.realpath(config_file)
 
-def _dp_include(config_hashes, parent_file, config_file, dps_conf, vlans_conf, acls_conf, logname):
+def _dp_include(config_hashes, parent_file, config_file, conf_fragments, logname):
     logger = get_logger(logname)
 
-    # Save the updated configuration state in separate dicts,
+    # Save the updated configuration state separately,
     # so if an error is found, the changes can simply be thrown away.
+    # Each file's dps/vlans/acls are kept as a fragment, to be merged in
+    # order once all files are loaded.
     new_config_hashes = config_hashes.copy()
-    new_dps_conf = dps_conf.copy()
-    new_vlans_conf = vlans_conf.copy()
-    new_acls_conf = acls_conf.copy()
+    new_conf_fragments = []
 
     if not os.path.isfile(config_file):
         logger.warning('not a regular file or does not exist: %s', config_file)
         return False
 
-    conf = read_config(config_file, logname)
+    config_hash, conf = _read_config_file(config_file, logname)
 
     if not conf:
         logger.warning('error loading config from file: %s', config_file)
@@ -114,11 +250,10 @@ def _dp_include(config_hashes, parent_file, config_file, dps_conf, vlans_conf, a
     # Add the SHA256 hash for this configuration file, so FAUCET can determine
     # whether or not this configuration file should be reloaded upon receiving
     # a HUP signal.
-    new_config_hashes[config_file] = config_file_hash(config_file)
+    new_config_hashes[config_file] = config_hash
 
-    new_dps_conf.update(conf.pop('dps', {}))
-    new_vlans_conf.update(conf.pop('vlans', {}))
-    new_acls_conf.update(conf.pop('acls', {}))
+    new_conf_fragments.append((
+        conf.pop('dps', {}), conf.pop('vlans', {}), conf.pop('acls', {})))
 
     for include_file in conf.pop('include', []):
         include_path = _dp_config_path(include_file, parent_file=config_file)
@@ -132,7 +267,7 @@ def _dp_include(config_hashes, parent_file, config_file, dps_conf, vlans_conf, a
         if not _dp_include(
                 new_config_hashes,
                 config_file, include_path,
-                new_dps_conf, new_vlans_conf, new_acls_conf,
+                new_conf_fragments,
                 logname):
             logger.error('unable to load required include file: %s', include_path)
             return False
@@ -149,7 +284,7 @@ def _dp_include(config_hashes, parent_file, config_file, dps_conf, vlans_conf, a
         if not _dp_include(
                 new_config_hashes,
                 config_file, include_path,
-                new_dps_conf, new_vlans_conf, new_acls_conf,
+                new_conf_fragments,
                 logname):
             new_config_hashes[include_path] = None
             logger.warning('skipping optional include file: %s', include_path)
@@ -157,9 +292,7 @@ def _dp_include(config_hashes, parent_file, config_file, dps_conf, vlans_conf, a
     # Actually update the configuration data structures,
     # now that this file has been successfully loaded.
     config_hashes.update(new_config_hashes)
-    dps_conf.update(new_dps_conf)
-    vlans_conf.update(new_vlans_conf)
-    acls_conf.update(new_acls_conf)
+    conf_fragments.extend(new_conf_fragments)
 
     return True
 
@@ -173,46 +306,104 @@ def _dp_add_vlan(vid_dp, dp, vlan, logname):
                     str.join(", ", vid_dp[vlan.vid]),
                 )
 
-    if vlan not in dp.vlans:
+    if vlan.vid not in dp.vlans:
         dp.add_vlan(vlan)
 
     vid_dp[vlan.vid].add(dp.name)
 
-def _dp_parser_v2(conf, config_file, logname):
+def _port_vids(ports_conf):
+    """Return VLANs that may be referenced by configured ports."""
+    vids = set()
+    for port_conf in ports_conf.itervalues():
+        if port_conf.get('native_vlan', None) is not None:
+            vids.add(port_conf['native_vlan'])
+        vids.update(port_conf.get('tagged_vlans', None) or [])
+    return vids
+
+def _dp_parser_v2(conf, config_file, logname, current_dps=None):
     logger = get_logger(logname)
 
     config_path = _dp_config_path(config_file)
 
     config_hashes = {}
 
-    dps_conf = {}
-    vlans_conf = {}
-    acls_conf = {}
+    conf_fragments = []
 
-    if not _dp_include(config_hashes, None, config_path, dps_conf, vlans_conf, acls_conf, logname):
+    if not _dp_include(config_hashes, None, config_path, conf_fragments, logname):
         logger.critical('error found while loading config file: %s', config_path)
         return None
 
+    dps_conf = {}
+    vlans_conf = {}
+    acls_conf = {}
+    for fragment_dps, fragment_vlans, fragment_acls in conf_fragments:
+        dps_conf.update(fragment_dps)
+        vlans_conf.update(fragment_vlans)
+        acls_conf.update(fragment_acls)
+
     if not dps_conf:
         logger.critical('dps not configured in file: %s', config_path)
         return None
 
+    # A DP is reused if its config, and the config of the VLANs and ACLs it
+    # may reference, are unchanged. As stacked DPs reference each other,
+    # they are always rebuilt.
+    reusable_dps = {}
+    stacked = False
+    for dp_conf in dps_conf.itervalues():
+        if 'stack' in dp_conf or any(
+                'stack' in port_conf
+                for port_conf in dp_conf.get('interfaces', {}).itervalues()):
+            stacked = True
+    if current_dps and not stacked:
+        for dp in current_dps:
+            reusable_dps[dp._id] = dp
+    acls_digest = digest(acls_conf)
+    vlan_digests = {}
+
     dps = []
     vid_dp = {}
 
     for identifier, dp_conf in dps_conf.iteritems():
+        vids = _port_vids(dp_conf.get('interfaces', {}))
+        for vid in vids:
+            if vid not in vlan_digests:
+                vlan_digests[vid] = digest(vlans_conf.get(vid, None))
+        input_digest = digest((
+            identifier, dp_conf, acls_digest,
+            sorted((vid, vlan_digests[vid]) for vid in vids)))
+        current_dp = reusable_dps.get(identifier, None)
+        if (current_dp is not None and
+                current_dp._conf_input_digest == input_digest):
+            for vlan in current_dp.vlans.itervalues():
+                _dp_add_vlan(vid_dp, current_dp, vlan, logname)
+            dps.append(current_dp)
+            continue
+
         ports_conf = dp_conf.pop('interfaces', {})
+        if 'ignore_learn_ins' in dp_conf:
+            del dp_conf['ignore_learn_ins']
+            logger.warning(
+                'DP %s: ignore_learn_ins is no longer supported and is '
+                'ignored, use packet_in_rate instead', identifier)
 
         dp = DP(identifier, dp_conf)
-        dp.sanity_check()
+        try:
+            dp.sanity_check()
+        except AssertionError as err:
+            logger.exception('Error in config file: %s', err)
+            return None
+        dp._conf_input_digest = input_digest
 
         dp_id = dp.dp_id
 
         vlans = {}
         ports = {}
 
-        for vid, vlan_conf in vlans_conf.iteritems():
-            vlans[vid] = VLAN(vid, dp_id, vlan_conf)
+        # Only VLANs the DP's ports reference are built.
+        for vid in vids:
+            if vid in vlans_conf:
+                vlans[vid] = VLAN(vid, dp_id, vlans_conf[vid])
         try:
             for port_num, port_conf in ports_conf.iteritems():
                 port = port_parser(dp_id, port_num, port_conf, vlans)
@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from conf import Conf
+from conf import Conf, digest
 from vlan import VLAN
 from port import Port
 from valve_acl import ACL
@@ -28,6 +28,8 @@ class DP(Conf):
     vlans = None
     ports = None
     running = False
+    # Digest of the config the DP was built from (see config_parser).
+    _conf_input_digest = None
     influxdb_stats = False
     name = None
     dp_id = None
@@ -46,11 +48,26 @@ class DP(Conf):
     high_priority = None
     stack = None
     stack_ports = None
-    ignore_learn_ins = None
+    host_expire_precision = None
+    host_expire_interval = None
+    packet_in_rate = None
+    packet_in_burst = None
+    packet_in_port_ban_time = None
     drop_broadcast_source_address = None
     drop_spoofed_faucet_mac = None
     drop_bpdu = None
     drop_lldp = None
+    packet_in_batch_size = None
+    packet_in_batch_interval = None
+    max_flow_msg_batch_bytes = None
+    reconcile_flows = None
+    group_table = None
+    group_table_routing = None
+    route_update_interval = None
+    route_update_max_flowmods = None
+    fib_aggregation = None
+    max_resolve_backoff_time = None
+    max_hosts_per_resolve_cycle = None
 
     # Values that are set to None will be set using set_defaults
     # they are included here for testing and informational purposes
@@ -80,22 +97,44 @@ class DP(Conf):
         'cookie': 1524372928,
         # inactive MAC timeout
         'timeout': 300,
+        # Don't relearn a host on the same port within this many seconds
+        # of last learning it (eg. packet ins racing the learn flows).
+        'cache_update_guard_time': 2,
+        # Hosts due to expire within this many seconds of each other are
+        # expired together (must be greater than 0).
+        'host_expire_precision': 1,
+        # How often (seconds) to check for hosts due to expire.
+        'host_expire_interval': 5,
         # description, strictly informational
         'description': None,
         # The hardware maker (for chosing an openflow driver)
         'hardware': 'Open vSwitch',
         # ARP and neighbor timeout (seconds)
         'arp_neighbor_timeout': 500,
+        # Nexthops not replying to ARP/ND are retried with exponential
+        # backoff, waiting up to this long (seconds) between attempts.
+        'max_resolve_backoff_time': 32,
+        # Resolve at most this many nexthops per VLAN each time nexthops
+        # are resolved, so many nexthops are resolved over several
+        # intervals rather than in one burst (0 is unlimited).
+        'max_hosts_per_resolve_cycle': 32,
         # OF channel log
         'ofchannel_log': None,
         # stacking config, when cross connecting multiple DPs
         'stack': None,
-        # Ignore every approx nth packet for learning.
-        # 2 will ignore 1 out of 2 packets; 3 will ignore 1 out of 3 packets.
+        # Packet ins per second admitted for learning, across the whole
+        # datapath (0 is unlimited). Ports and VLANs may set their own rate.
         # This limits control plane activity when learning new hosts rapidly.
-        # Flooding will still be done by the dataplane even with a packet
-        # is ignored for learning purposes.
-        'ignore_learn_ins': 3,
+        # Flooding will still be done by the dataplane even when a packet
+        # is ignored for learning purposes. Replaces ignore_learn_ins.
+        'packet_in_rate': 1000,
+        # Packet ins that may be admitted in a burst (defaults to
+        # packet_in_rate, ie. one second's worth).
+        'packet_in_burst': None,
+        # If a port persistently exceeds its packet_in_rate, stop sending its
+        # packet ins for learning to the controller for this many seconds
+        # (0 disables).
+        'packet_in_port_ban_time': 0,
         # By default drop packets with a broadcast source address
         'drop_broadcast_source_address': True,
         # By default drop packets on datapath spoofing the FAUCET_MAC
@@ -104,6 +143,37 @@ class DP(Conf):
         'drop_bpdu': True,
         # By default, drop LLDP. Set to False, to enable NFV offload of LLDP.
         'drop_lldp': True,
+        # Coalesce up to this many packet ins for learning, before processing
+        # them together and sending the resulting flows in one write.
+        # 0 disables batching (every packet in is processed immediately).
+        'packet_in_batch_size': 0,
+        # Maximum time (seconds) a packet in may wait in a batch.
+        'packet_in_batch_interval': 0.005,
+        # OpenFlow messages are sent to the datapath in writes of up to
+        # this many bytes.
+        'max_flow_msg_batch_bytes': 65536,
+        # On connect, change only the flows that differ from the
+        # configuration rather than deleting all flows, so that forwarding
+        # continues across controller restarts and reconnects.
+        'reconcile_flows': False,
+        # Flood using an OpenFlow group per VLAN, so a port changing needs
+        # only a group mod (requires datapath group support). Not used on
+        # stacked datapaths, which flood depending on the input port.
+        'group_table': False,
+        # Route via an OpenFlow indirect group per resolved nexthop, so a
+        # nexthop changing needs only a group mod rather than a flow mod
+        # for each route (requires datapath group support).
+        'group_table_routing': False,
+        # Queue BGP route updates, coalescing updates to the same prefix,
+        # and program them in batches this often (seconds). 0 programs
+        # each update as it is received.
+        'route_update_interval': 0,
+        # Maximum OpenFlow messages sent in each batch of route updates.
+        'route_update_max_flowmods': 1000,
+        # Leave routes out of the FIB that have the same nexthop as the
+        # route covering them, as the covering route's flow forwards their
+        # packets the same way, to save flows in the switch's tables.
+        'fib_aggregation': False,
         }
 
     def __init__(self, _id, conf):
@@ -121,6 +191,9 @@ class DP(Conf):
         # TODO: this shouldnt use asserts
         assert 'dp_id' in self.__dict__
         assert isinstance(self.dp_id, (int, long))
+        assert isinstance(self.host_expire_precision, (int, long, float))
+        assert self.host_expire_precision > 0, (
+            'host_expire_precision must be greater than 0')
         for vid, vlan in self.vlans.iteritems():
             assert isinstance(vid, int)
             assert isinstance(vlan, VLAN)
@@ -149,6 +222,35 @@ class DP(Conf):
         self._set_default('highest_priority', self.high_priority + 98)
         self._set_default('description', self.name)
 
+    def conf_ref(self):
+        return ('DP', self.dp_id)
+
+    def _digest_items(self):
+        """Return configuration items, including those of ACLs/VLANs/ports.
+
+        The digest of a DP changes if any of its configuration changes,
+        so a DP with an unchanged digest needs no flows changed on reload.
+        """
+        items = []
+        for key, value in super(DP, self)._digest_items():
+            if key == 'running':
+                continue
+            if key in ('acls', 'vlans', 'ports'):
+                value = dict(
+                    (conf_id, conf.conf_digest())
+                    for conf_id, conf in value.iteritems())
+            elif key == 'stack' and value and 'graph' in value:
+                value = dict(value)
+                value['graph'] = value['graph'].graph['digest']
+            items.append((key, value))
+        return items
+
+    def finalize_digest(self):
+        for confs in (self.acls, self.vlans, self.ports):
+            for conf in confs.itervalues():
+                conf.finalize_digest()
+        super(DP, self).finalize_digest()
+
     def add_acl(self, acl_ident, acl_conf=None):
         if acl_conf is not None:
             self.acls[acl_ident] = ACL(acl_ident, acl_conf)
@@ -169,7 +271,17 @@ class DP(Conf):
         if vlan.acl_in is not None:
             self.vlan_acl_in[vlan.vid] = vlan.acl_in
 
-    def resolve_stack_topology(self, dps):
+    @staticmethod
+    def resolve_stack_topology(dps):
+        """Resolve the stack topology shared by all DPs.
+
+        The stack graph is built once, and shared by all DPs along with
+        the shortest paths from each DP to the root DP, and each DP's
+        next hop port towards every other DP.
+
+        Args:
+            dps (list): all DPs in the configuration.
+        """
 
         def canonical_edge(dp, port):
             peer_dp = port.stack['dp']
@@ -226,10 +338,30 @@ class DP(Conf):
         if len(graph.edges()):
             for edge_name, count in edge_count.iteritems():
                 assert count == 2, '%s defined only in one direction' % edge_name
-            if self.stack is None:
-                self.stack = {}
-            self.stack['root_dp'] = root_dp
-            self.stack['graph'] = graph
+            graph.graph['digest'] = digest(sorted(graph.edges(keys=True)))
+            root_paths = {}
+            for dp_name, path in networkx.single_source_shortest_path(
+                    graph, root_dp.name).iteritems():
+                root_paths[dp_name] = list(reversed(path))
+            graph.graph['root_paths'] = root_paths
+            next_hop_ports = {}
+            for dp in dps:
+                peer_dp_ports = {}
+                for port in dp.stack_ports:
+                    peer_dp_ports.setdefault(port.stack['dp'].name, port)
+                dp_next_hop_ports = {}
+                if peer_dp_ports:
+                    for dest_dp, path in networkx.single_source_shortest_path(
+                            graph, dp.name).iteritems():
+                        if len(path) > 1:
+                            dp_next_hop_ports[dest_dp] = peer_dp_ports[path[1]]
+                next_hop_ports[dp.name] = dp_next_hop_ports
+            graph.graph['next_hop_ports'] = next_hop_ports
+            for dp in dps:
+                if dp.stack is None:
+                    dp.stack = {}
+                dp.stack['root_dp'] = root_dp
+                dp.stack['graph'] = graph
 
     def shortest_path(self, dest_dp):
         if self.stack is None:
@@ -240,24 +372,27 @@ class DP(Conf):
 
     def shortest_path_port(self, dest_dp):
         """Return port on our DP, that is the shortest path towards dest DP."""
-        shortest_path = self.shortest_path(dest_dp)
-        if shortest_path is not None:
-            peer_dp = shortest_path[1]
-            peer_dp_ports = []
-            for port in self.stack_ports:
-                if port.stack['dp'].name == peer_dp:
-                    peer_dp_ports.append(port)
-            return peer_dp_ports[0]
-        return None
+        if self.stack is None or 'graph' not in self.stack:
+            return None
+        next_hop_ports = self.stack['graph'].graph['next_hop_ports']
+        return next_hop_ports[self.name].get(dest_dp, None)
 
     def shortest_path_to_root(self):
         if self.stack is not None:
             root_dp = self.stack['root_dp']
-            if root_dp != self:
+            if root_dp is not self:
+                root_paths = self.stack['graph'].graph['root_paths']
+                if self.name in root_paths:
+                    return list(root_paths[self.name])
                 return self.shortest_path(root_dp.name)
         return []
 
-    def finalize_config(self, dps):
+    def finalize_config(self, dp_by_name):
+        """Resolve references to ports and other DPs in configuration.
+
+        Args:
+            dp_by_name (dict): all DPs in the configuration, by name.
+        """
 
         def resolve_port_no(port_name):
             if port_name in port_by_name:
@@ -267,11 +402,11 @@ class DP(Conf):
             return None
 
         def resolve_stack_dps():
-            port_stack_dp = {}
+            port_stack_dp = []
             for port in self.stack_ports:
                 stack_dp = port.stack['dp']
-                port_stack_dp[port] = dp_by_name[stack_dp]
-            for port, dp in port_stack_dp.iteritems():
+                port_stack_dp.append((port, dp_by_name[stack_dp]))
+            for port, dp in port_stack_dp:
                 port.stack['dp'] = dp
                 stack_port_name = port.stack['port']
                 port.stack['port'] = dp.ports[stack_port_name]
@@ -312,9 +447,6 @@ class DP(Conf):
         port_by_name = {}
         for port in self.ports.itervalues():
             port_by_name[port.name] = port
-        dp_by_name = {}
-        for dp in dps:
-            dp_by_name[dp.name] = dp
 
         resolve_stack_dps()
         resolve_mirror_destinations()
@@ -25,6 +25,8 @@ import ipaddr
 
 from config_parser import config_file_hash, dp_parser
 from valve import valve_factory
+import valve_host
+import valve_packet
 from util import kill_on_exception, get_sys_prefix, get_logger, dpid_log
 
 from ryu.base import app_manager
@@ -35,10 +37,7 @@ from ryu.controller import dpset
 from ryu.controller import event
 from ryu.controller import ofp_event
 from ryu.lib import hub
-from ryu.lib.packet import ethernet
-from ryu.lib.packet import packet
-from ryu.lib.packet import vlan as ryu_vlan
-from ryu.ofproto import ofproto_v1_3, ether
+from ryu.ofproto import ofproto_v1_3
 from ryu.services.protocols.bgp.bgpspeaker import BGPSpeaker
 
 
@@ -57,6 +56,22 @@ class EventFaucetHostExpire(event.EventBase):
     pass
 
 
+class EventFaucetPacketInFlush(event.EventBase):
+    """Event used to trigger processing of a datapath's batched packet ins."""
+
+    def __init__(self, dp_id):
+        super(EventFaucetPacketInFlush, self).__init__()
+        self.dp_id = dp_id
+
+
+class EventFaucetRouteUpdateFlush(event.EventBase):
+    """Event used to trigger programming of a datapath's queued routes."""
+
+    def __init__(self, dp_id):
+        super(EventFaucetRouteUpdateFlush, self).__init__()
+        self.dp_id = dp_id
+
+
 class Faucet(app_manager.RyuApp):
     """A RyuApp that implements an L2/L3 learning VLAN switch.
 
@@ -101,6 +116,10 @@ class Faucet(app_manager.RyuApp):
 
         # Set up a valve object for each datapath
         self.valves = {}
+        # Hosts learned on edge ports, shared by all valves for stacking.
+        self.edge_host_index = valve_host.EdgeHostIndex()
+        self._packet_in_flush_pending = set()
+        self._route_update_flush_pending = set()
         self.config_hashes, valve_dps = dp_parser(
             self.config_file, self.logname)
         for valve_dp in valve_dps:
@@ -110,12 +129,20 @@ class Faucet(app_manager.RyuApp):
                 self.logger.error(
                     'Hardware type not supported for DP: %s', valve_dp.name)
             else:
-                self.valves[valve_dp.dp_id] = valve(valve_dp, self.logname)
+                self.valves[valve_dp.dp_id] = valve(
+                    valve_dp, self.logname,
+                    edge_host_index=self.edge_host_index)
 
         self.gateway_resolve_request_thread = hub.spawn(
             self.gateway_resolve_request)
         self.host_expire_request_thread = hub.spawn(
             self.host_expire_request)
+        # If set, reload when config files change, without a SIGHUP.
+        self.config_stat_reload = float(
+            os.getenv('FAUCET_CONFIG_STAT_RELOAD', 0))
+        if self.config_stat_reload:
+            self.config_stat_reload_thread = hub.spawn(
+                self.config_stat_reload_request)
 
         self.dp_bgp_speakers = {}
         self._reset_bgp()
@@ -139,14 +166,21 @@ class Faucet(app_manager.RyuApp):
                     self.logger.error(
                         'BGP nexthop %s for prefix %s cannot be us',
                         nexthop, prefix)
-                elif withdraw:
+                    return
+                if withdraw:
                     self.logger.info(
                         'BGP withdraw %s nexthop %s',
                         prefix, nexthop)
-                    flowmods = valve.del_route(vlan, prefix)
+                    ip_gw = None
                 else:
                     self.logger.info(
                         'BGP add %s nexthop %s', prefix, nexthop)
+                    ip_gw = nexthop
+                if valve.queue_route_update(vlan, ip_gw, prefix):
+                    self._schedule_route_update_flush(valve)
+                elif withdraw:
+                    flowmods = valve.del_route(vlan, prefix)
+                else:
                     flowmods = valve.add_route(vlan, nexthop, prefix)
                 if flowmods:
                     self._send_flow_msgs(ryudp, flowmods)
@@ -155,6 +189,20 @@ class Faucet(app_manager.RyuApp):
             'BGP nexthop %s for prefix %s is not a connected network',
             nexthop, prefix)
 
+    def _schedule_route_update_flush(self, valve):
+        """Program a datapath's queued route updates after an interval.
+
+        Args:
+            valve (Valve): valve with queued route updates.
+        """
+        dp_id = valve.dp.dp_id
+        if dp_id not in self._route_update_flush_pending:
+            self._route_update_flush_pending.add(dp_id)
+            hub.spawn_after(
+                valve.dp.route_update_interval,
+                self.send_event,
+                'Faucet', EventFaucetRouteUpdateFlush(dp_id))
+
     def _create_bgp_speaker_for_vlan(self, vlan):
         """Set up BGP speaker for an individual VLAN if required.
 
@@ -206,27 +254,81 @@ class Faucet(app_manager.RyuApp):
             self.send_event('Faucet', EventFaucetResolveGateways())
             hub.sleep(2)
 
+    def _host_expire_interval(self):
+        """Return how often to expire hosts, to suit all datapaths."""
+        intervals = [
+            valve.dp.host_expire_interval for valve in self.valves.itervalues()]
+        if intervals:
+            return min(intervals)
+        return 5
+
     def host_expire_request(self):
         """Trigger expiration of host state in controller."""
         while True:
             self.send_event('Faucet', EventFaucetHostExpire())
-            hub.sleep(5)
+            hub.sleep(self._host_expire_interval())
+
+    def config_stat_reload_request(self):
+        """Trigger a reload when config files have changed."""
+        while True:
+            hub.sleep(self.config_stat_reload)
+            new_config_file = os.getenv('FAUCET_CONFIG', self.config_file)
+            if self._config_changed(new_config_file):
+                self.send_event('Faucet', EventFaucetReconfigure())
 
     def _send_flow_msgs(self, ryu_dp, flow_msgs):
         """Send OpenFlow messages to a connected datapath.
 
+        Messages are serialized into as few writes as possible, each no
+        larger than the datapath's max_flow_msg_batch_bytes (unless a single
+        message is larger). Every message is given a new xid, even if it
+        was sent before, so xids are not reused.
+
         Args:
-            ryu_db (ryu.controller.controller.Datapath): datapath.
+            ryu_dp (ryu.controller.controller.Datapath): datapath.
             flow_msgs (list): OpenFlow messages to send.
         """
         dp_id = ryu_dp.id
         if dp_id not in self.valves:
             self.logger.error('send_flow_msgs: unknown %s', dpid_log(dp_id))
             return
-        self.valves[dp_id].ofchannel_log(flow_msgs)
+        valve = self.valves[dp_id]
+        valve.ofchannel_log(flow_msgs)
+        max_batch_bytes = valve.dp.max_flow_msg_batch_bytes
+        max_xid = ryu_dp.ofproto.MAX_XID
+        xid = ryu_dp.xid
+        batches = []
+        buf = bytearray()
+        batch_msgs = 0
         for flow_msg in flow_msgs:
             flow_msg.datapath = ryu_dp
-            ryu_dp.send_msg(flow_msg)
+            xid = (xid + 1) & max_xid
+            flow_msg.xid = xid
+            flow_msg.serialize()
+            if buf and len(buf) + len(flow_msg.buf) > max_batch_bytes:
+                batches.append((buf, batch_msgs))
+                buf = bytearray()
+                batch_msgs = 0
+            buf += flow_msg.buf
+            batch_msgs += 1
+        if buf:
+            batches.append((buf, batch_msgs))
+        ryu_dp.xid = xid
+        for buf, batch_msgs in batches:
+            ryu_dp.send(bytes(buf))
+            self.logger.debug(
+                '%s sent %u OpenFlow messages, %u bytes',
+                dpid_log(dp_id), batch_msgs, len(buf))
+
+    def _flush_packet_in_batch(self, ryu_dp):
+        """Process a datapath's batched packet ins and send resulting flows.
+
+        Args:
+            ryu_dp (ryu.controller.controller.Datapath): datapath.
+        """
+        flowmods = self.valves[ryu_dp.id].flush_packet_in_batch(
+            ryu_dp.id, self.valves)
+        self._send_flow_msgs(ryu_dp, flowmods)
 
     # pylint: disable=unused-argument
     def signal_handler(self, sigid, frame):
@@ -274,8 +376,15 @@ class Faucet(app_manager.RyuApp):
         if not self._config_changed(new_config_file):
             self.logger.info('configuration is unchanged, not reloading')
             return
+        result = dp_parser(
+            new_config_file, self.logname,
+            [valve.dp for valve in self.valves.itervalues()])
+        if result is None:
+            self.logger.error(
+                'configuration %s is invalid, not reloading', new_config_file)
+            return
         self.config_file = new_config_file
-        self.config_hashes, new_dps = dp_parser(new_config_file, self.logname)
+        self.config_hashes, new_dps = result
         for new_dp in new_dps:
             # pylint: disable=no-member
             flowmods = self.valves[new_dp.dp_id].reload_config(new_dp)
@@ -326,25 +435,72 @@ class Faucet(app_manager.RyuApp):
         valve = self.valves[dp_id]
         valve.ofchannel_log([msg])
 
-        pkt = packet.Packet(msg.data)
-        eth_pkt = pkt.get_protocols(ethernet.ethernet)[0]
-        eth_type = eth_pkt.ethertype
+        # Slice the Ethernet/802.1Q header out of the packet - the rest of
+        # the packet is parsed only if the control plane needs it.
+        pkt_meta = valve_packet.parse_packet_in_pkt(msg.data)
+        if pkt_meta is None:
+            return
 
         # Packet ins, can only come when a VLAN header has already been pushed
         # (ie. when we have progressed past the VLAN table). This gaurantees
         # a VLAN header will always be present, so we know which VLAN the packet
         # belongs to.
-        if eth_type == ether.ETH_TYPE_8021Q:
-            # tagged packet
-            vlan_proto = pkt.get_protocols(ryu_vlan.vlan)[0]
-            vlan_vid = vlan_proto.vid
-        else:
+        vlan_vid = pkt_meta.vid
+        if vlan_vid is None:
             return
 
         in_port = msg.match['in_port']
-        flowmods = valve.rcv_packet(dp_id, self.valves, in_port, vlan_vid, pkt)
+        if valve.batch_packet_in(dp_id, in_port, vlan_vid, pkt_meta):
+            if valve.packet_in_batch_full():
+                self._flush_packet_in_batch(ryu_dp)
+            elif dp_id not in self._packet_in_flush_pending:
+                self._packet_in_flush_pending.add(dp_id)
+                hub.spawn_after(
+                    valve.dp.packet_in_batch_interval,
+                    self.send_event,
+                    'Faucet', EventFaucetPacketInFlush(dp_id))
+            return
+        flowmods = valve.rcv_packet(
+            dp_id, self.valves, in_port, vlan_vid, pkt_meta)
         self._send_flow_msgs(ryu_dp, flowmods)
 
+    @set_ev_cls(EventFaucetPacketInFlush, MAIN_DISPATCHER)
+    @kill_on_exception(exc_logname)
+    def packet_in_flush(self, ryu_event):
+        """Handle a request to process a datapath's batched packet ins.
+
+        Args:
+            ryu_event (EventFaucetPacketInFlush): triggering event.
+        """
+        dp_id = ryu_event.dp_id
+        self._packet_in_flush_pending.discard(dp_id)
+        ryu_dp = self.dpset.get(dp_id)
+        if dp_id in self.valves and ryu_dp is not None:
+            self._flush_packet_in_batch(ryu_dp)
+
+    @set_ev_cls(EventFaucetRouteUpdateFlush, MAIN_DISPATCHER)
+    @kill_on_exception(exc_logname)
+    def route_update_flush(self, ryu_event):
+        """Handle a request to program a batch of a datapath's queued routes.
+
+        Routes are added to the RIB even if the datapath is not connected.
+        Another batch is scheduled while route updates remain queued.
+
+        Args:
+            ryu_event (EventFaucetRouteUpdateFlush): triggering event.
+        """
+        dp_id = ryu_event.dp_id
+        self._route_update_flush_pending.discard(dp_id)
+        if dp_id not in self.valves:
+            return
+        valve = self.valves[dp_id]
+        flowmods = valve.flush_route_updates()
+        ryu_dp = self.dpset.get(dp_id)
+        if ryu_dp is not None:
+            self._send_flow_msgs(ryu_dp, flowmods)
+        if valve.route_update_queue_depth():
+            self._schedule_route_update_flush(valve)
+
     @set_ev_cls(ofp_event.EventOFPErrorMsg, MAIN_DISPATCHER) # pylint: disable=no-member
     @kill_on_exception(exc_logname)
     def _error_handler(self, ryu_event):
@@ -430,6 +586,26 @@ class Faucet(app_manager.RyuApp):
         else:
             self.logger.error('handler_datapath: unknown %s', dpid_log(dp_id))
 
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER) # pylint: disable=no-member
+    @kill_on_exception(exc_logname)
+    def flow_stats_reply_handler(self, ryu_event):
+        """Handle a flow stats reply, to reconcile flows on connect.
+
+        Args:
+            ryu_event (ryu.controller.ofp_event.EventOFPFlowStatsReply): trigger.
+        """
+        msg = ryu_event.msg
+        ryu_dp = msg.datapath
+        dp_id = ryu_dp.id
+        if dp_id not in self.valves:
+            self.logger.error(
+                'flow_stats_reply_handler: unknown %s', dpid_log(dp_id))
+            return
+        more = bool(msg.flags & ryu_dp.ofproto.OFPMPF_REPLY_MORE)
+        flowmods = self.valves[dp_id].flow_stats_reply(
+            dp_id, msg.xid, msg.body, more)
+        self._send_flow_msgs(ryu_dp, flowmods)
+
     @set_ev_cls(ofp_event.EventOFPPortStatus, MAIN_DISPATCHER) # pylint: disable=no-member
     @kill_on_exception(exc_logname)
     def port_status_handler(self, ryu_event):
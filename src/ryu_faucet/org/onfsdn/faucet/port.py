@@ -28,6 +28,8 @@ class Port(Conf):
     tagged_vlans = []
     acl_in = None
     stack = None
+    packet_in_rate = None
+    packet_in_burst = None
 
     defaults = {
         'number': None,
@@ -42,6 +44,10 @@ class Port(Conf):
         'tagged_vlans': None,
         'acl_in': None,
         'stack': None,
+        # Packet ins per second admitted for learning (0 is unlimited).
+        'packet_in_rate': 0,
+        # Packet ins that may be admitted in a burst (default packet_in_rate).
+        'packet_in_burst': None,
         }
 
     def __init__(self, _id, conf=None):
@@ -71,15 +77,8 @@ class Port(Conf):
     def running(self):
         return self.enabled and self.phys_up
 
-    def __eq__(self, other):
-        return hash(self) == hash(other)
-
-    def __hash__(self):
-        items = [(k,v) for k, v in self.__dict__.iteritems() if 'dyn' not in k]
-        return hash(frozenset(map(str, items)))
-
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    def conf_ref(self):
+        return ('Port', self.number)
 
     def __str__(self):
         return self.name
@@ -20,7 +20,7 @@ import logging
 import time
 import os
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 import ipaddr
 
@@ -30,6 +30,7 @@ import valve_flood
 import valve_host
 import valve_of
 import valve_packet
+import valve_ratelimit
 import valve_route
 import util
 
@@ -71,37 +72,72 @@ class Valve(object):
 
     FAUCET_MAC = '0e:00:00:00:00:01'
     TABLE_MATCH_TYPES = {}
+    # Number of recently used OpenFlow matches to keep.
+    MATCH_CACHE_SIZE = 4096
 
-    def __init__(self, dp, logname, *args, **kwargs):
+    def __init__(self, dp, logname, edge_host_index=None, *args, **kwargs):
         self.dp = dp
+        if edge_host_index is None:
+            edge_host_index = valve_host.EdgeHostIndex()
+        self.edge_host_index = edge_host_index
         self.logger = logging.getLogger(logname + '.valve')
         self.ofchannel_logger = None
-        self._packet_in_count_sec = 0
-        self._last_packet_in_sec = 0
+        self.packet_in_rate_limiter = None
+        self._packet_in_drops_logged = None
+        self._reset_packet_in_rate_limiter()
+        self._packet_in_batch = OrderedDict()
+        # Queued route updates (nexthop, or None to delete), by VID and
+        # prefix, and when the queue last became non empty.
+        self._route_update_queue = OrderedDict()
+        self._route_update_queue_start = None
+        # Seconds taken for the last queue of route updates to be
+        # programmed, since the first update was queued.
+        self.route_update_convergence_time = None
+        # Flow request sent on connect, and flows received so far, if
+        # reconciling flows.
+        self._reconcile_request = None
+        self._reconcile_flow_stats = []
+        self._match_cache = OrderedDict()
         self._register_table_match_types()
+        # Groups for resolved nexthops, kept across configuration reloads.
+        self.nexthop_groups = valve_route.NextHopGroups()
+        self._create_flow_managers()
+
+    def _create_flow_managers(self):
+        """Create flow managers that depend on the DP's configuration."""
         # TODO: functional flow managers require too much state.
         # Should interface with a common composer class.
+        nexthop_groups = None
+        if self.dp.group_table_routing:
+            nexthop_groups = self.nexthop_groups
         self.ipv4_route_manager = valve_route.ValveIPv4RouteManager(
             self.logger, self.FAUCET_MAC, self.dp.arp_neighbor_timeout,
             self.dp.ipv4_fib_table, self.dp.eth_src_table, self.dp.eth_dst_table,
             self.dp.highest_priority,
             self.valve_in_match, self.valve_flowdel, self.valve_flowmod,
-            self.valve_flowcontroller)
+            self.valve_flowcontroller, nexthop_groups,
+            self.dp.fib_aggregation, self.dp.max_resolve_backoff_time,
+            self.dp.max_hosts_per_resolve_cycle, self.dp.ports)
         self.ipv6_route_manager = valve_route.ValveIPv6RouteManager(
             self.logger, self.FAUCET_MAC, self.dp.arp_neighbor_timeout,
             self.dp.ipv6_fib_table, self.dp.eth_src_table, self.dp.eth_dst_table,
             self.dp.highest_priority,
             self.valve_in_match, self.valve_flowdel, self.valve_flowmod,
-            self.valve_flowcontroller)
+            self.valve_flowcontroller, nexthop_groups,
+            self.dp.fib_aggregation, self.dp.max_resolve_backoff_time,
+            self.dp.max_hosts_per_resolve_cycle, self.dp.ports)
         self.flood_manager = valve_flood.ValveFloodManager(
             self.dp.flood_table, self.dp.low_priority,
             self.valve_in_match, self.valve_flowmod,
-            self.dp.stack, self.dp.ports, self.dp.shortest_path_to_root)
+            self.dp.stack, self.dp.ports, self.dp.shortest_path_to_root,
+            self.dp.group_table)
         self.host_manager = valve_host.ValveHostManager(
             self.logger, self.dp.eth_src_table, self.dp.eth_dst_table,
-            self.dp.timeout, self.dp.low_priority, self.dp.highest_priority,
+            self.dp.timeout, self.dp.cache_update_guard_time,
+            self.dp.host_expire_precision,
+            self.dp.low_priority, self.dp.highest_priority,
             self.valve_in_match, self.valve_flowmod, self.valve_flowdel,
-            self.valve_flowdrop)
+            self.valve_flowdrop, self.dp.dp_id, self.edge_host_index)
 
     def _register_table_match_types(self):
         # TODO: functional flow managers should be able to register
@@ -127,6 +163,12 @@ class Valve(object):
             self.dp.flood_table: (
                 'in_port', 'vlan_vid', 'eth_dst'),
         }
+        self._table_match_types = dict(
+            (table_id, frozenset(match_types))
+            for table_id, match_types in self.TABLE_MATCH_TYPES.iteritems())
+        # ACL tables may match on anything.
+        self._table_match_types[self.dp.port_acl_table] = None
+        self._table_match_types[self.dp.vlan_acl_table] = None
 
     def _in_port_tables(self):
         """Return list of tables that specify in_port as a match."""
@@ -172,20 +214,40 @@ class Valve(object):
                        eth_dst=None, eth_dst_mask=None,
                        ipv6_nd_target=None, icmpv6_type=None,
                        nw_proto=None, nw_src=None, nw_dst=None):
-        """Compose an OpenFlow match rule."""
+        """Compose an OpenFlow match rule.
+
+        Matches are immutable once built, so recently used matches are
+        cached and shared between flows.
+        """
+        vid = None
+        if vlan is not None:
+            vid = vlan.vid
+        match_key = (
+            table_id, in_port, vid, eth_type, eth_src,
+            eth_dst, eth_dst_mask,
+            valve_of.ipnet_key(ipv6_nd_target), icmpv6_type,
+            nw_proto, valve_of.ipnet_key(nw_src), valve_of.ipnet_key(nw_dst))
+        match_cache = self._match_cache
+        if match_key in match_cache:
+            match = match_cache.pop(match_key)
+            match_cache[match_key] = match
+            return match
         match_dict = valve_of.build_match_dict(
             in_port, vlan, eth_type, eth_src,
             eth_dst, eth_dst_mask, ipv6_nd_target, icmpv6_type,
             nw_proto, nw_src, nw_dst)
-        if table_id != self.dp.port_acl_table\
-                and table_id != self.dp.vlan_acl_table:
-            assert table_id in self.TABLE_MATCH_TYPES,\
-                '%u table not registered' % table_id
+        assert table_id in self._table_match_types,\
+            '%u table not registered' % table_id
+        table_match_types = self._table_match_types[table_id]
+        if table_match_types is not None:
             for match_type in match_dict.iterkeys():
-                assert match_type in self.TABLE_MATCH_TYPES[table_id],\
+                assert match_type in table_match_types,\
                     '%s match not registered for table %u' % (
                         match_type, table_id)
         match = valve_of.match(match_dict)
+        match_cache[match_key] = match
+        if len(match_cache) > self.MATCH_CACHE_SIZE:
+            match_cache.popitem(last=False)
         return match
 
     def _ignore_dpid(self, dp_id):
@@ -286,6 +348,10 @@ class Valve(object):
         for table_id in self._in_port_tables():
             in_port_match = self.valve_in_match(table_id, in_port=port.number)
             ofmsgs.extend(self.valve_flowdel(table_id, in_port_match))
+        self.flood_manager.flush_port_from_flood_cache(port)
+        # Hosts learned on this port must be relearned.
+        self.host_manager.flush_port_from_host_cache(
+            port, self.dp.vlans.itervalues())
         return ofmsgs
 
     def _add_default_drop_flows(self):
@@ -366,10 +432,29 @@ class Valve(object):
             priority=self.dp.low_priority,
             inst=[valve_of.goto_table(self.dp.eth_dst_table)])]
 
+    def _delete_all_groups(self):
+        """Return a group mod to delete all groups, if groups are used.
+
+        Flows that use the groups are also deleted by the datapath, so
+        nexthops routed via groups are forgotten, to be resolved again.
+        """
+        if not (self.flood_manager.use_group_table or
+                self.dp.group_table_routing):
+            return []
+        self.flood_manager.flush_flood_cache()
+        self.nexthop_groups.flush()
+        if self.dp.group_table_routing:
+            for vlan in self.dp.vlans.itervalues():
+                vlan.arp_cache = {}
+                vlan.nd_cache = {}
+        return [valve_of.groupdel()]
+
     def _add_default_flows(self):
         """Configure datapath with necessary default tables and rules."""
         ofmsgs = []
         ofmsgs.extend(self._delete_all_valve_flows())
+        self.flood_manager.flush_flood_cache()
+        ofmsgs.extend(self._delete_all_groups())
         ofmsgs.extend(self._add_default_drop_flows())
         ofmsgs.extend(self._add_vlan_flood_flow())
         ofmsgs.extend(self._add_controller_learn_flow())
@@ -384,6 +469,12 @@ class Valve(object):
         # add mirror destination ports.
         for port in vlan.mirror_destination_ports():
             all_port_nums.add(port.number)
+        ofmsgs.extend(self._vlan_flows(vlan))
+        return ofmsgs
+
+    def _vlan_flows(self, vlan):
+        """Return flows to configure a VLAN."""
+        ofmsgs = []
         # install eth_dst_table flood ofmsgs
         ofmsgs.extend(self.flood_manager.build_flood_rules(vlan))
         # add acl rules
@@ -440,7 +531,12 @@ class Valve(object):
         """
         if self._ignore_dpid(dp_id):
             return []
+        if self.dp.reconcile_flows:
+            return self._reconcile_connect(discovered_up_port_nums)
         self.logger.info('Configuring %s', util.dpid_log(dp_id))
+        # All flows will be deleted, so all hosts must be relearned.
+        for vlan in self.dp.vlans.itervalues():
+            vlan.host_cache = {}
         ofmsgs = []
         ofmsgs.extend(self._add_default_flows())
         changed_ports = set([])
@@ -448,6 +544,10 @@ class Valve(object):
             if valve_of.ignore_port(port_no):
                 continue
             changed_ports.add(port_no)
+        # Ports are running when VLANs are added, so are flooded to.
+        for port in self.dp.ports.itervalues():
+            port.phys_up = (
+                port.number in changed_ports or port.stack is not None)
         changed_vlans = self.dp.vlans.iterkeys()
         changes = ([], changed_ports, [], changed_vlans)
         ofmsgs.extend(self._apply_config_changes(self.dp, changes))
@@ -455,6 +555,194 @@ class Valve(object):
         self.dp.running = True
         return ofmsgs
 
+    def _reconcile_connect(self, discovered_up_port_nums):
+        """Request the datapath's flows, to reconcile them on connect.
+
+        Flows are not deleted. Once all flows with this DP's cookie are
+        received (see flow_stats_reply()), only flows that differ from the
+        configuration are changed.
+
+        Args:
+            discovered_up_port_nums (list): datapath ports that are up as ints.
+        Returns:
+            list: OpenFlow messages to send to datapath.
+        """
+        self.logger.info(
+            'Reconciling flows on %s', util.dpid_log(self.dp.dp_id))
+        up_port_nums = set([
+            port_num for port_num in discovered_up_port_nums
+            if not valve_of.ignore_port(port_num)])
+        for port in self.dp.ports.itervalues():
+            # Stack ports are always configured, as on a full connect.
+            port.phys_up = (
+                port.number in up_port_nums or port.stack is not None)
+        self._reconcile_flow_stats = []
+        self._reconcile_request = valve_of.flow_stats_request(self.dp.cookie)
+        return [self._reconcile_request]
+
+    def flow_stats_reply(self, dp_id, xid, flow_stats, more):
+        """Handle a reply to the flow request sent on connect.
+
+        Args:
+            dp_id (int): datapath ID.
+            xid (int): transaction ID of reply.
+            flow_stats (list): ryu.ofproto.ofproto_v1_3_parser.OFPFlowStats.
+            more (bool): True if more replies are to follow.
+        Returns:
+            list: OpenFlow messages to reconcile flows, once all are received.
+        """
+        if self._ignore_dpid(dp_id):
+            return []
+        # Replies may also be for other applications' requests.
+        if (self._reconcile_request is None or
+                xid != self._reconcile_request.xid):
+            return []
+        self._reconcile_flow_stats.extend(flow_stats)
+        if more:
+            return []
+        flow_stats = self._reconcile_flow_stats
+        self._reconcile_request = None
+        self._reconcile_flow_stats = []
+        ofmsgs = self._reconcile_flows(flow_stats)
+        self.dp.running = True
+        return ofmsgs
+
+    def _learned_flow_valid(self, flow_stat):
+        """Return True if a flow is as learned for a host on a port in its VLAN.
+
+        Only flows the host manager would install now, when learning the
+        host with the learn timeout, are valid.
+
+        Args:
+            flow_stat (ryu.ofproto.ofproto_v1_3_parser.OFPFlowStats): flow.
+        Returns:
+            bool: True if the flow may be kept.
+        """
+        table_id = flow_stat.table_id
+        match = flow_stat.match
+        if table_id == self.dp.eth_src_table:
+            match_fields = ['eth_src', 'in_port', 'vlan_vid']
+        elif table_id == self.dp.eth_dst_table:
+            match_fields = ['eth_dst', 'vlan_vid']
+        else:
+            return False
+        if sorted([field for field, _ in match.items()]) != match_fields:
+            return False
+        vid = match['vlan_vid']
+        if isinstance(vid, tuple):
+            return False
+        vlan = self.dp.vlans.get(vid & ~ofp.OFPVID_PRESENT, None)
+        if vlan is None:
+            return False
+        if table_id == self.dp.eth_src_table:
+            port_num = match['in_port']
+            eth_src = match['eth_src']
+        else:
+            port_num = valve_of.instructions_output_port(
+                flow_stat.instructions)
+            eth_src = match['eth_dst']
+        port = self.dp.ports.get(port_num, None)
+        if port is None or port not in vlan.get_ports():
+            return False
+        learn_timeout = self.host_manager.learn_timeout
+        if port.permanent_learn or not learn_timeout:
+            return False
+        src_flowmod, dst_flowmod = self.host_manager.host_learn_flows(
+            port, vlan, eth_src, learn_timeout)
+        if table_id == self.dp.eth_src_table:
+            learn_flowmod = src_flowmod
+        else:
+            learn_flowmod = dst_flowmod
+        return (
+            flow_stat.priority == learn_flowmod.priority and
+            flow_stat.hard_timeout == learn_flowmod.hard_timeout and
+            flow_stat.idle_timeout == learn_flowmod.idle_timeout and
+            valve_of.match_key(match) ==
+            valve_of.match_key(learn_flowmod.match) and
+            valve_of.instructions_key(flow_stat.instructions) ==
+            valve_of.instructions_key(learn_flowmod.instructions))
+
+    def _reconcile_flows(self, flow_stats):
+        """Return flowmods to change installed flows to the configuration.
+
+        Installed flows that are not wanted are deleted, except flows for
+        hosts learned on ports that are still in the host's VLAN, which are
+        left to time out or be updated as usual. Flows for routes via
+        nexthops still in the neighbor cache are wanted, so routing is not
+        interrupted by a reconnect. Other route flows are deleted, and
+        added once their nexthops are resolved.
+
+        Args:
+            flow_stats (list): ryu.ofproto.ofproto_v1_3_parser.OFPFlowStats.
+        Returns:
+            list: OpenFlow messages.
+        """
+        # Installed groups are not known, so all are replaced. Flows
+        # that use them are also deleted, and so are added again.
+        groupmods = []
+        replace_groups = (
+            self.flood_manager.use_group_table or self.dp.group_table_routing)
+        if replace_groups:
+            self.flood_manager.flush_flood_cache()
+            groupmods.append(valve_of.groupdel())
+        wanted_flowmods = self._static_flows().values()
+        groupmods.extend(self.flood_manager.flood_group_changes({}))
+        for vlan in self.dp.vlans.itervalues():
+            if not (vlan.ipv4_routes or vlan.ipv6_routes):
+                # No routes are known, as after a restart.
+                vlan.arp_cache = {}
+                vlan.nd_cache = {}
+                self.nexthop_groups.remove_vlan(vlan.vid)
+                continue
+            for route_manager in (
+                    self.ipv4_route_manager, self.ipv6_route_manager):
+                for ofmsg in route_manager.resolved_route_flows(vlan):
+                    if valve_of.is_groupmod(ofmsg):
+                        groupmods.append(ofmsg)
+                    else:
+                        wanted_flowmods.append(ofmsg)
+        wanted_flows = {}
+        for flowmod in wanted_flowmods:
+            flow_key = (
+                flowmod.table_id, flowmod.priority,
+                valve_of.match_key(flowmod.match))
+            wanted_flows[flow_key] = flowmod
+        installed_flows = {}
+        flowdels = []
+        for flow_stat in flow_stats:
+            flow_key = (
+                flow_stat.table_id, flow_stat.priority,
+                valve_of.match_key(flow_stat.match))
+            if (replace_groups and
+                    valve_of.instructions_use_group(flow_stat.instructions)):
+                continue
+            installed_flows[flow_key] = flow_stat
+            if flow_key in wanted_flows:
+                continue
+            if self._learned_flow_valid(flow_stat):
+                continue
+            flowdels.append(self.valve_flowmod(
+                flow_stat.table_id,
+                match=flow_stat.match,
+                priority=flow_stat.priority,
+                command=ofp.OFPFC_DELETE_STRICT,
+                out_port=ofp.OFPP_ANY,
+                out_group=ofp.OFPG_ANY))
+        flowmods = []
+        for flow_key, flowmod in wanted_flows.iteritems():
+            flow_stat = installed_flows.get(flow_key, None)
+            if (flow_stat is not None and
+                    flow_stat.hard_timeout == flowmod.hard_timeout and
+                    flow_stat.idle_timeout == flowmod.idle_timeout and
+                    valve_of.instructions_key(flow_stat.instructions) ==
+                    valve_of.instructions_key(flowmod.instructions)):
+                continue
+            flowmods.append(flowmod)
+        self.logger.info(
+            'reconcile: %u flows installed, %u deleted, %u added/modified',
+            len(flow_stats), len(flowdels), len(flowmods))
+        return valve_of.valve_flowreorder(flowdels + groupmods + flowmods)
+
     def datapath_disconnect(self, dp_id):
         """Handle Ryu datapath disconnection event.
 
@@ -463,6 +751,9 @@ class Valve(object):
         """
         if not self._ignore_dpid(dp_id):
             self.dp.running = False
+            self._packet_in_batch = OrderedDict()
+            self._reconcile_request = None
+            self._reconcile_flow_stats = []
             self.logger.warning('%s down', util.dpid_log(dp_id))
 
     def _port_add_acl(self, port_num):
@@ -531,11 +822,13 @@ class Valve(object):
         untagged_vlans_with_port = [
             vlan for vlan in vlans if port in vlan.untagged]
         for vlan in tagged_vlans_with_port:
-            ofmsgs.extend(self.flood_manager.build_flood_rules(vlan))
+            ofmsgs.extend(self.flood_manager.build_flood_rules(
+                vlan, modify=True))
             ofmsgs.extend(self._port_add_vlan_tagged(
                 port, vlan, self._find_forwarding_table(vlan), mirror_act))
         for vlan in untagged_vlans_with_port:
-            ofmsgs.extend(self.flood_manager.build_flood_rules(vlan))
+            ofmsgs.extend(self.flood_manager.build_flood_rules(
+                vlan, modify=True))
             ofmsgs.extend(self._port_add_vlan_untagged(
                 port, vlan, self._find_forwarding_table(vlan), mirror_act))
         return ofmsgs
@@ -579,6 +872,13 @@ class Valve(object):
         # Delete all flows previously matching this port
         ofmsgs.extend(self._delete_all_port_match_flows(port))
 
+        ofmsgs.extend(self._port_add_flows(port))
+        return ofmsgs
+
+    def _port_add_flows(self, port):
+        """Return flows to configure a running port."""
+        port_num = port.number
+        ofmsgs = []
         # Port is a mirror destination; drop all input packets
         if port.mirror_destination:
             ofmsgs.append(self.valve_flowdrop(
@@ -599,7 +899,8 @@ class Valve(object):
                 priority=self.dp.low_priority,
                 inst=[valve_of.goto_table(self.dp.eth_src_table)]))
             for vlan in self.dp.vlans.values():
-                ofmsgs.extend(self.flood_manager.build_flood_rules(vlan))
+                ofmsgs.extend(self.flood_manager.build_flood_rules(
+                    vlan, modify=True))
         else:
             mirror_act = []
             # Add mirroring if any
@@ -646,6 +947,18 @@ class Valve(object):
 
         return ofmsgs
 
+    def _control_plane_pkt(self, vlan, pkt_meta):
+        """Return True if a packet may need FAUCET's route managers.
+
+        Args:
+            vlan (vlan): vlan of the port the packet was received on.
+            pkt_meta (valve_packet.PacketMeta): packet received.
+        Returns:
+            bool: True if the packet should be fully parsed.
+        """
+        return (bool(vlan.controller_ips) and
+                pkt_meta.eth_type in valve_packet.CONTROL_PLANE_ETH_TYPES)
+
     def control_plane_handler(self, in_port, vlan, eth_src, eth_dst, pkt):
         """Handle a packet probably destined to FAUCET's route managers.
 
@@ -656,7 +969,7 @@ class Valve(object):
             vlan (vlan): vlan of the port the packet was received on.
             eth_src (str): source Ethernet MAC address.
             eth_dst (str): destination Ethernet MAC address.
-            pkt (ryu.lib.packet.ethernet): packet received.
+            pkt (valve_packet.PacketMeta): packet received.
         Returns:
             list: OpenFlow messages, if any.
         """
@@ -682,19 +995,31 @@ class Valve(object):
             return True
         return False
 
-    def _rate_limit_packet_ins(self):
-        """Return True if too many packet ins this second."""
-        now_sec = int(time.time())
-        if self._last_packet_in_sec != now_sec:
-            self._last_packet_in_sec = now_sec
-            self._packet_in_count_sec = 0
-        self._packet_in_count_sec += 1
-        if self.dp.ignore_learn_ins:
-            if self._packet_in_count_sec % self.dp.ignore_learn_ins == 0:
-                return True
-        return False
+    def _rate_limit_packet_ins(self, port, vlan):
+        """Return True if a packet in should be ignored for learning.
 
-    def _learn_host(self, valves, dp_id, vlan, port, pkt, eth_src):
+        Args:
+            port (Port): port packet was received on.
+            vlan (VLAN): VLAN packet was received on.
+        Returns:
+            tuple: (bool, list): True if rate limited, and OpenFlow messages
+                to ban packet ins from the port if it is persistently over
+                its rate.
+        """
+        if self.packet_in_rate_limiter.admit(port, vlan):
+            return False, []
+        ofmsgs = []
+        if (self.dp.packet_in_port_ban_time and
+                self.packet_in_rate_limiter.port_ban_due(port)):
+            ofmsgs.append(self.host_manager.temp_ban_packet_ins_on_port(
+                port, self.dp.packet_in_port_ban_time))
+            self.logger.info(
+                'port %u over packet in rate %s, ' +
+                'temporarily banning packet ins from this port',
+                port.number, port.packet_in_rate)
+        return True, ofmsgs
+
+    def _learn_host(self, valves, dp_id, vlan, port, pkt_meta, eth_src):
         """Possibly learn a host on a port."""
         ofmsgs = []
         # ban learning new hosts if max_hosts reached on a VLAN.
@@ -721,19 +1046,10 @@ class Valve(object):
                 # for packet in.
                 # TODO: edge DPs could use a different forwarding algorithm
                 # (for example, just default switch to a neighbor).
-                host_learned_other_dp = None
                 # Find port that forwards closer to destination DP that
                 # has already learned this host (if any).
-                for other_dpid, other_valve in valves.iteritems():
-                    if other_dpid == dp_id:
-                        continue
-                    other_dp = other_valve.dp
-                    other_dp_host_cache = other_dp.vlans[vlan.vid].host_cache
-                    if eth_src in other_dp_host_cache:
-                        host = other_dp_host_cache[eth_src]
-                        if host.edge:
-                            host_learned_other_dp = other_dp
-                            break
+                host_learned_other_dp = self.edge_host_index.edge_dp(
+                    valves, vlan.vid, eth_src, dp_id)
                 # No edge DP may have learned this host yet.
                 if host_learned_other_dp is None:
                     return ofmsgs
@@ -746,19 +1062,25 @@ class Valve(object):
 
             # TODO: it would be good to be able to notify an external
             # system upon re/learning a host.
-            ofmsgs.extend(self.host_manager.learn_host_on_vlan_port(
-                learn_port, vlan, eth_src))
+            learn_ofmsgs = self.host_manager.learn_host_on_vlan_port(
+                learn_port, vlan, eth_src)
+            ofmsgs.extend(learn_ofmsgs)
+            if learn_ofmsgs:
+                for route_manager in (
+                        self.ipv4_route_manager, self.ipv6_route_manager):
+                    ofmsgs.extend(route_manager.nexthop_host_learned(
+                        vlan, eth_src, learn_port.number))
             # Add FIB entries, if routing is active.
-            for route_manager in (
-                    self.ipv4_route_manager, self.ipv6_route_manager):
-                if route_manager:
-                    route_manager.add_host_fib_route_from_pkt(vlan, pkt)
+            if self._control_plane_pkt(vlan, pkt_meta):
+                for route_manager in (
+                        self.ipv4_route_manager, self.ipv6_route_manager):
+                    route_manager.add_host_fib_route_from_pkt(vlan, pkt_meta)
             self.logger.info(
                 'learned %u hosts on vlan %u',
                 len(vlan.host_cache), vlan.vid)
         return ofmsgs
 
-    def rcv_packet(self, dp_id, valves, in_port, vlan_vid, pkt):
+    def rcv_packet(self, dp_id, valves, in_port, vlan_vid, pkt_meta):
         """Handle a packet from the dataplane (eg to re/learn a host).
 
         The packet may be sent to us also in response to FAUCET
@@ -770,7 +1092,7 @@ class Valve(object):
             valves (dict): all datapaths, indexed by datapath ID.
             in_port (int): port packet was received on.
             vlan_vid (int): VLAN VID of port packet was received on.
-            pkt (ryu.lib.packet.packet): packet received.
+            pkt_meta (valve_packet.PacketMeta): packet received.
         Return:
             list: OpenFlow messages, if any.
         """
@@ -778,9 +1100,8 @@ class Valve(object):
             return []
 
         ofmsgs = []
-        eth_pkt = valve_packet.parse_pkt(pkt)
-        eth_src = eth_pkt.src
-        eth_dst = eth_pkt.dst
+        eth_src = pkt_meta.eth_src
+        eth_dst = pkt_meta.eth_dst
         vlan = self.dp.vlans[vlan_vid]
         port = self.dp.ports[in_port]
 
@@ -789,16 +1110,97 @@ class Valve(object):
                 'Packet_in %s src:%s in_port:%d vid:%s',
                 util.dpid_log(dp_id), eth_src, in_port, vlan_vid)
 
-            ofmsgs.extend(self.control_plane_handler(
-                in_port, vlan, eth_src, eth_dst, pkt))
+            # Only parse the whole packet if the control plane needs it.
+            if self._control_plane_pkt(vlan, pkt_meta):
+                ofmsgs.extend(self.control_plane_handler(
+                    in_port, vlan, eth_src, eth_dst, pkt_meta))
 
-        if self._rate_limit_packet_ins():
+        rate_limited, ban_ofmsgs = self._rate_limit_packet_ins(port, vlan)
+        if rate_limited:
+            ofmsgs.extend(ban_ofmsgs)
             return ofmsgs
 
         ofmsgs.extend(
-            self._learn_host(valves, dp_id, vlan, port, pkt, eth_src))
+            self._learn_host(valves, dp_id, vlan, port, pkt_meta, eth_src))
         return ofmsgs
 
+    def batch_packet_in(self, dp_id, in_port, vlan_vid, pkt_meta):
+        """Queue a packet in for learning, to be processed in a batch.
+
+        Packet ins that may need the control plane are never batched.
+        Batched packet ins from the same host on the same VLAN are
+        coalesced, the most recent one being kept.
+
+        Args:
+            dp_id (int): datapath ID.
+            in_port (int): port packet was received on.
+            vlan_vid (int): VLAN VID of port packet was received on.
+            pkt_meta (valve_packet.PacketMeta): packet received.
+        Returns:
+            bool: True if queued, False if packet in should be processed now.
+        """
+        if not self.dp.packet_in_batch_size:
+            return False
+        if not self._known_up_dpid_and_port(dp_id, in_port):
+            return False
+        vlan = self.dp.vlans.get(vlan_vid, None)
+        if vlan is None or self._control_plane_pkt(vlan, pkt_meta):
+            return False
+        self._packet_in_batch[(vlan_vid, pkt_meta.eth_src)] = (
+            in_port, pkt_meta)
+        return True
+
+    def packet_in_batch_full(self):
+        """Return True if the packet in batch should be processed now."""
+        return len(self._packet_in_batch) >= self.dp.packet_in_batch_size
+
+    def flush_packet_in_batch(self, dp_id, valves):
+        """Process all batched packet ins.
+
+        Args:
+            dp_id (int): datapath ID.
+            valves (dict): all datapaths, indexed by datapath ID.
+        Returns:
+            list: OpenFlow messages, with flow deletes first and one barrier.
+        """
+        packet_in_batch = self._packet_in_batch
+        self._packet_in_batch = OrderedDict()
+        ofmsgs = []
+        for batch_key, batch_value in packet_in_batch.iteritems():
+            vlan_vid, _ = batch_key
+            in_port, pkt_meta = batch_value
+            ofmsgs.extend(self.rcv_packet(
+                dp_id, valves, in_port, vlan_vid, pkt_meta))
+        if packet_in_batch:
+            self.logger.debug(
+                'processed batch of %u packet ins, %u OpenFlow messages',
+                len(packet_in_batch), len(ofmsgs))
+        return valve_of.valve_flowreorder(ofmsgs)
+
+    def _reset_packet_in_rate_limiter(self):
+        """Start rate limiting packet ins with the current configuration."""
+        if self.packet_in_rate_limiter is not None:
+            self._log_packet_in_drops()
+        self.packet_in_rate_limiter = valve_ratelimit.ValvePacketInRateLimiter(
+            self.dp)
+        self._packet_in_drops_logged = None
+
+    def _log_packet_in_drops(self):
+        """Log packet ins dropped by rate limiting, if more since last logged."""
+        stats = self.packet_in_rate_limiter.stats()
+        dropped = []
+        if stats['dp'] is not None and stats['dp'][1]:
+            dropped.append('DP: %u' % stats['dp'][1])
+        for name, key in (('VLAN', 'vlans'), ('port', 'ports')):
+            for conf_id, (_, conf_dropped) in sorted(stats[key].iteritems()):
+                if conf_dropped:
+                    dropped.append('%s %s: %u' % (name, conf_id, conf_dropped))
+        if dropped and dropped != self._packet_in_drops_logged:
+            self._packet_in_drops_logged = dropped
+            self.logger.info(
+                'packet ins dropped for learning by rate limit, %s',
+                ', '.join(dropped))
+
     def host_expire(self):
         """Expire hosts not recently re/learned.
 
@@ -810,59 +1212,7 @@ class Valve(object):
         now = time.time()
         for vlan in self.dp.vlans.itervalues():
             self.host_manager.expire_hosts_from_vlan(vlan, now)
-
-    def _get_config_changes(self, new_dp):
-        """Detect any config changes.
-
-        Args:
-            new_dp (DP): new dataplane configuration.
-        Returns:
-            changes (tuple) of:
-                deleted_ports (set): deleted port numbers.
-                changed_ports (set): changed/added port numbers.
-                deleted_vlans (set): deleted VLAN IDs.
-                changed_vlans (set): changed/added VLAN IDs.
-        """
-        changed_acls = {}
-        for acl_id, new_acl in new_dp.acls.iteritems():
-            if acl_id not in self.dp.acls:
-                changed_acls[acl_id] = new_acl
-            else:
-                if new_acl != self.dp.acls[acl_id]:
-                    changed_acls[acl_id] = new_acl
-
-        changed_ports = set([])
-        for port_no, new_port in new_dp.ports.iteritems():
-            if port_no not in self.dp.ports:
-                # Detected a newly configured port
-                changed_ports.add(port_no)
-            else:
-                if new_port != self.dp.ports[port_no]:
-                    # An existing port has configs changed
-                    changed_ports.add(port_no)
-                elif new_port.acl_in in changed_acls:
-                    # If the port has its ACL changed
-                    changed_ports.add(port_no)
-
-        deleted_vlans = set([])
-        for vid in self.dp.vlans.iterkeys():
-            if vid not in new_dp.vlans:
-                deleted_vlans.add(vid)
-
-        changed_vlans = set([])
-        for vid, new_vlan in new_dp.vlans.iteritems():
-            if vid not in self.dp.vlans or new_vlan != self.dp.vlans[vid]:
-                changed_vlans.add(vid)
-            for port in new_vlan.get_ports():
-                changed_ports.add(port.number)
-
-        deleted_ports = set([])
-        for port_no in self.dp.ports.iterkeys():
-            if port_no not in new_dp.ports:
-                deleted_ports.add(port_no)
-
-        changes = (deleted_ports, changed_ports, deleted_vlans, changed_vlans)
-        return changes
+        self._log_packet_in_drops()
 
     def _apply_config_changes(self, new_dp, changes):
         """Apply any detected configuration changes.
@@ -892,6 +1242,7 @@ class Valve(object):
 
         self.dp = new_dp
         self.dp.running = True
+        self._reset_packet_in_rate_limiter()
 
         for vid in changed_vlans:
             self.logger.info('VLANs changed/added: %s', changed_vlans)
@@ -902,15 +1253,209 @@ class Valve(object):
             ofmsgs.extend(self.port_add(self.dp.dp_id, port_no, True))
         return ofmsgs
 
+    def _static_flows(self):
+        """Return flows installed for the current configuration.
+
+        These are all flows installed when the datapath connects, for ports
+        that are currently running. Learned hosts and routes are excluded.
+        The flood manager records these flood flows as installed, and the
+        groups they use (which are installed using flood_group_changes()).
+
+        Returns:
+            dict: flowmods, keyed by table, priority and match.
+        """
+        self.flood_manager.flush_flood_cache()
+        ofmsgs = []
+        ofmsgs.extend(self._add_default_drop_flows())
+        ofmsgs.extend(self._add_vlan_flood_flow())
+        ofmsgs.extend(self._add_controller_learn_flow())
+        for vlan in self.dp.vlans.itervalues():
+            ofmsgs.extend(self._vlan_flows(vlan))
+        for port in self.dp.ports.itervalues():
+            if port.running():
+                ofmsgs.extend(self._port_add_flows(port))
+        static_flows = {}
+        for ofmsg in ofmsgs:
+            if valve_of.is_flowadd(ofmsg):
+                static_flows[valve_of.flow_key(ofmsg)] = ofmsg
+        return static_flows
+
+    @staticmethod
+    def _port_forwarding_conf(port, vlans):
+        """Return the configuration learned host flows on a port depend on."""
+        return (
+            port.enabled, port.permanent_learn, port.mirror,
+            port.stack is None,
+            tuple(sorted(
+                (vlan.vid, vlan.port_is_tagged(port.number))
+                for vlan in vlans.itervalues() if port in vlan.get_ports())))
+
+    def _del_vlan_nexthop_groups(self, vid):
+        """Return group mods to delete the groups of a VLAN's nexthops."""
+        return [
+            valve_of.groupdel(group_id)
+            for group_id in self.nexthop_groups.remove_vlan(vid)]
+
+    @staticmethod
+    def _vlan_routing_conf(vlan):
+        """Return the configuration routes on a VLAN depend on."""
+        return (sorted(map(str, vlan.controller_ips)), str(vlan.routes))
+
+    def _diff_static_flows(self, old_flows, new_flows):
+        """Return flowmods to change installed flows to the new flows.
+
+        Args:
+            old_flows (dict): installed flowmods, by table, priority and match.
+            new_flows (dict): wanted flowmods, by table, priority and match.
+        Returns:
+            tuple: (list, list): flow deletes, and flow adds/modifies.
+        """
+        flowdels = []
+        flowmods = []
+        for flow_key, old_flowmod in old_flows.iteritems():
+            if flow_key not in new_flows:
+                flowdels.append(self.valve_flowmod(
+                    old_flowmod.table_id,
+                    match=old_flowmod.match,
+                    priority=old_flowmod.priority,
+                    command=ofp.OFPFC_DELETE_STRICT,
+                    out_port=ofp.OFPP_ANY,
+                    out_group=ofp.OFPG_ANY))
+        for flow_key, new_flowmod in new_flows.iteritems():
+            if flow_key in old_flows:
+                old_flowmod = old_flows[flow_key]
+                if (valve_of.serialize_offline(old_flowmod) ==
+                        valve_of.serialize_offline(new_flowmod)):
+                    continue
+                if (old_flowmod.cookie == new_flowmod.cookie and
+                        old_flowmod.hard_timeout == new_flowmod.hard_timeout and
+                        old_flowmod.idle_timeout == new_flowmod.idle_timeout):
+                    # Only instructions differ, so keep the flow's counters.
+                    new_flowmod.command = ofp.OFPFC_MODIFY_STRICT
+            flowmods.append(new_flowmod)
+        return flowdels, flowmods
+
+    def _reload_config_diff(self, new_dp):
+        """Change the datapath's flows to the new configuration.
+
+        Flows are added, modified or deleted only where they differ between
+        the old and new configuration. Hosts learned on ports and VLANs whose
+        forwarding is unchanged keep their flows; routes are kept on VLANs
+        whose routing is unchanged.
+
+        Args:
+            new_dp (DP): new dataplane configuration.
+        Returns:
+            list: OpenFlow messages.
+        """
+        old_dp = self.dp
+        for port_no, new_port in new_dp.ports.iteritems():
+            if port_no in old_dp.ports:
+                new_port.phys_up = old_dp.ports[port_no].phys_up
+            else:
+                # Assume new ports are up, as ports are when added.
+                new_port.phys_up = True
+
+        old_flood_groups = dict(self.flood_manager.flood_groups)
+        old_flows = self._static_flows()
+        old_host_manager = self.host_manager
+        self.dp = new_dp
+        self.dp.running = True
+        self._match_cache = OrderedDict()
+        self._register_table_match_types()
+        self._create_flow_managers()
+        self.host_manager.learn_cache_hits = old_host_manager.learn_cache_hits
+        self.host_manager.learn_cache_misses = (
+            old_host_manager.learn_cache_misses)
+        self._reset_packet_in_rate_limiter()
+        new_flows = self._static_flows()
+        # The new flood manager has the groups for the new configuration.
+        groupmods = self.flood_manager.flood_group_changes(old_flood_groups)
+        # Flows using deleted groups are deleted with them by the datapath,
+        # so must be added again rather than modified.
+        deleted_group_ids = (
+            set(old_flood_groups) - set(self.flood_manager.flood_groups))
+        for flow_key, old_flowmod in old_flows.items():
+            if deleted_group_ids.intersection(
+                    valve_of.instructions_group_ids(
+                        old_flowmod.instructions)):
+                del old_flows[flow_key]
+
+        host_flowdels = []
+        changed_ports = set()
+        fib_conf_changed = (
+            old_dp.group_table_routing != new_dp.group_table_routing or
+            old_dp.fib_aggregation != new_dp.fib_aggregation)
+        for port_no, old_port in old_dp.ports.iteritems():
+            if (port_no not in new_dp.ports or
+                    self._port_forwarding_conf(old_port, old_dp.vlans) !=
+                    self._port_forwarding_conf(
+                        new_dp.ports[port_no], new_dp.vlans)):
+                changed_ports.add(port_no)
+                self.logger.info('port %s forwarding changed', old_port)
+                host_flowdels.extend(self.valve_flowdel(
+                    self.dp.eth_src_table,
+                    self.valve_in_match(self.dp.eth_src_table, in_port=port_no)))
+                host_flowdels.extend(self.valve_flowdel(
+                    self.dp.eth_dst_table, out_port=port_no))
+        for vid, old_vlan in old_dp.vlans.iteritems():
+            if vid not in new_dp.vlans:
+                self.logger.info('VLAN %s deleted', old_vlan)
+                for table_id in (
+                        self.dp.eth_src_table, self.dp.eth_dst_table,
+                        self.dp.ipv4_fib_table, self.dp.ipv6_fib_table):
+                    host_flowdels.extend(self.valve_flowdel(
+                        table_id, self.valve_in_match(table_id, vlan=old_vlan)))
+                groupmods.extend(self._del_vlan_nexthop_groups(vid))
+                continue
+            new_vlan = new_dp.vlans[vid]
+            new_vlan.host_cache = dict(
+                (eth_src, entry)
+                for eth_src, entry in old_vlan.host_cache.iteritems()
+                if entry.port.number not in changed_ports)
+            for entry in new_vlan.host_cache.itervalues():
+                entry.port = new_dp.ports[entry.port.number]
+            self.host_manager.schedule_expiry_for_vlan(new_vlan)
+            if (not fib_conf_changed and
+                    self._vlan_routing_conf(old_vlan) ==
+                    self._vlan_routing_conf(new_vlan)):
+                # Routes (eg. from BGP, or learned hosts) keep their flows.
+                new_vlan.ipv4_routes = old_vlan.ipv4_routes
+                new_vlan.ipv6_routes = old_vlan.ipv6_routes
+                new_vlan.arp_cache = old_vlan.arp_cache
+                new_vlan.nd_cache = old_vlan.nd_cache
+            else:
+                self.logger.info('VLAN %s routing changed', new_vlan)
+                groupmods.extend(self._del_vlan_nexthop_groups(vid))
+                for table_id in (
+                        self.dp.ipv4_fib_table, self.dp.ipv6_fib_table):
+                    host_flowdels.extend(self.valve_flowdel(
+                        table_id, self.valve_in_match(table_id, vlan=new_vlan)))
+                    # Flows just deleted must be re-added, even if unchanged.
+                    for flow_key, old_flowmod in old_flows.items():
+                        if (old_flowmod.table_id == table_id and
+                                old_flowmod.match.get('vlan_vid', None) ==
+                                valve_of.vid_present(vid)):
+                            del old_flows[flow_key]
+        # Hosts learned on changed ports need to be relearned.
+        for vlan in old_dp.vlans.itervalues():
+            for eth_src, entry in vlan.host_cache.iteritems():
+                if entry.port.number in changed_ports:
+                    self.edge_host_index.forget(
+                        self.dp.dp_id, vlan.vid, eth_src)
+
+        flowdels, flowmods = self._diff_static_flows(old_flows, new_flows)
+        self.logger.info(
+            'reload: %u flows deleted, %u flows added/modified',
+            len(flowdels), len(flowmods))
+        return valve_of.valve_flowreorder(
+            flowdels + host_flowdels + groupmods + flowmods)
+
     def reload_config(self, new_dp):
         """Reload configuration new_dp.
 
-        Following config changes are currently supported:
-            - Port config: support all available configs (e.g. native_vlan, acl_in)
-                & change operations (add, delete, modify) a port
-            - ACL config:support any modification, currently reload all rules
-                belonging to an ACL
-            - VLAN config: enable, disable routing, etc...
+        Only flows that differ between the old and new configuration are
+        changed (see _reload_config_diff).
 
         Args:
             new_dp (DP): new dataplane configuration.
@@ -918,9 +1463,10 @@ class Valve(object):
             list: OpenFlow messages.
         """
         if self.dp.running:
-            return self._apply_config_changes(
-                new_dp,
-                self._get_config_changes(new_dp))
+            if new_dp.conf_digest() == self.dp.conf_digest():
+                self.logger.info('configuration is unchanged')
+                return []
+            return self._reload_config_diff(new_dp)
         else:
             return []
 
@@ -953,6 +1499,83 @@ class Valve(object):
         else:
             return self.ipv4_route_manager.del_route(vlan, ip_dst)
 
+    def queue_route_update(self, vlan, ip_gw, ip_dst):
+        """Queue a route update, to be programmed in a batch.
+
+        Updates to the same prefix are coalesced, the most recent being
+        kept, and cancel out if they leave the route as it is.
+
+        Args:
+            vlan (vlan): VLAN containing the route.
+            ip_gw (ipaddr.IPAddress): IP address of nexthop (None to delete).
+            ip_dst (ipaddr.IPNetwork): destination IP network.
+        Returns:
+            bool: True if queued, False if the update should be made now.
+        """
+        if not self.dp.route_update_interval:
+            return False
+        if ip_dst.version == 6:
+            routes = vlan.ipv6_routes
+        else:
+            routes = vlan.ipv4_routes
+        update_key = (vlan.vid, ip_dst)
+        if routes.get(ip_dst, None) == ip_gw:
+            self._route_update_queue.pop(update_key, None)
+        else:
+            self._route_update_queue[update_key] = ip_gw
+        if not self._route_update_queue:
+            self._route_update_queue_start = None
+        elif self._route_update_queue_start is None:
+            self._route_update_queue_start = time.time()
+        return True
+
+    def route_update_queue_depth(self):
+        """Return the number of queued route updates."""
+        return len(self._route_update_queue)
+
+    def flush_route_updates(self):
+        """Make queued route updates, up to route_update_max_flowmods.
+
+        Returns:
+            list: OpenFlow messages, with flow deletes first and one barrier.
+        """
+        ofmsgs = []
+        updates = 0
+        while (self._route_update_queue and
+               len(ofmsgs) < self.dp.route_update_max_flowmods):
+            update_key, ip_gw = self._route_update_queue.popitem(last=False)
+            vid, ip_dst = update_key
+            vlan = self.dp.vlans.get(vid, None)
+            if vlan is None:
+                continue
+            if ip_gw is None:
+                ofmsgs.extend(self.del_route(vlan, ip_dst))
+            else:
+                ofmsgs.extend(self.add_route(vlan, ip_gw, ip_dst))
+            updates += 1
+        if updates:
+            self.logger.debug(
+                'made %u route updates, %u OpenFlow messages, %u queued',
+                updates, len(ofmsgs), len(self._route_update_queue))
+        if (not self._route_update_queue and
+                self._route_update_queue_start is not None):
+            self.route_update_convergence_time = (
+                time.time() - self._route_update_queue_start)
+            self._route_update_queue_start = None
+            self.logger.info(
+                'route updates converged in %.3fs, %u FIB flows saved',
+                self.route_update_convergence_time, self.fib_flows_saved())
+        return valve_of.valve_flowreorder(ofmsgs)
+
+    def fib_flows_saved(self):
+        """Return how many routes are left out of the FIB by aggregation."""
+        flows_saved = 0
+        for vlan in self.dp.vlans.itervalues():
+            for route_manager in (
+                    self.ipv4_route_manager, self.ipv6_route_manager):
+                flows_saved += route_manager.fib_flows_saved(vlan)
+        return flows_saved
+
     def resolve_gateways(self):
         """Call route managers to re/resolve gateways.
 
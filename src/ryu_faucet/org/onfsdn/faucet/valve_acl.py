@@ -15,23 +15,15 @@
 # limitations under the License.
 
 import valve_of
+from conf import Conf
 
-class ACL(object):
+class ACL(Conf):
 
     def __init__(self, id_, rule_conf):
 
         self._id = id_
         self.rules = [x['rule'] for x in rule_conf]
 
-    def __hash__(self):
-        return hash(frozenset(map(str, self.__dict__.iteritems())))
-
-    def __eq__(self, other):
-        return hash(self) == hash(other)
-
-    def __ne__(self, other):
-        return not self.__eq__(other)
-
 # TODO: change this, maybe this can be rewritten easily
 # possibly replace with a class for ACLs
 def build_acl_entry(rule_conf, acl_allow_inst, port_num=None, vlan_vid=None):
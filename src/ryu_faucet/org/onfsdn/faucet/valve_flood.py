@@ -34,9 +34,15 @@ class ValveFloodManager(object):
         (False, mac.BROADCAST_STR, None), # flood on ethernet broadcasts
     )
 
+    # With groups, a VLAN floods to all its ports with the group having the
+    # VLAN's VID as its ID, and unknown unicast destinations to ports with
+    # unicast flooding enabled with the group with this offset added.
+    UNICAST_FLOOD_GROUP_OFFSET = 4096
+
     def __init__(self, flood_table, flood_priority,
                  valve_in_match, valve_flowmod,
-                 dp_stack, dp_ports, dp_shortest_path_to_root):
+                 dp_stack, dp_ports, dp_shortest_path_to_root,
+                 use_group_table=False):
         self.flood_table = flood_table
         self.flood_priority = flood_priority
         self.valve_in_match = valve_in_match
@@ -54,25 +60,35 @@ class ValveFloodManager(object):
                 self.away_from_root_stack_ports.append(port)
             elif peer_root_distance < my_root_distance:
                 self.towards_root_stack_ports.append(port)
+        # Groups are only used on standalone datapaths, as on a stacked
+        # datapath, where packets are flooded depends on the input port.
+        self.use_group_table = use_group_table and self.stack is None
+        # Ports of the groups installed on the datapath, by group ID.
+        self.flood_groups = {}
+        # Actions of the flood flows installed on the datapath, by VID and
+        # then by flow (priority, in_port, eth_dst, eth_dst_mask).
+        self.flood_flows = {}
+        # Flood actions for packets from a port, and the ports they flood
+        # to, by VID, exclude_unicast, in_port and whether mirrored.
+        self._flood_actions_cache = {}
 
-    def _build_flood_port_outputs(self, ports, exclude_port):
+    def _build_flood_port_outputs(self, port_nums, exclude_port_num):
         flood_acts = []
-        for port in ports:
-            if port == exclude_port:
+        for port_num in port_nums:
+            if port_num == exclude_port_num:
                 continue
-            flood_acts.append(valve_of.output_port(port.number))
+            flood_acts.append(valve_of.output_port(port_num))
         return flood_acts
 
-    def _build_flood_local_rule_actions(self, vlan, exclude_unicast, in_port):
+    def _build_flood_local_rule_actions(self, flood_ports, in_port):
+        tagged_port_nums, untagged_port_nums = flood_ports
         flood_acts = []
-        tagged_ports = vlan.tagged_flood_ports(exclude_unicast)
         flood_acts.extend(self._build_flood_port_outputs(
-            tagged_ports, in_port))
-        untagged_ports = vlan.untagged_flood_ports(exclude_unicast)
-        if untagged_ports:
+            tagged_port_nums, in_port.number))
+        if untagged_port_nums:
             flood_acts.append(valve_of.pop_vlan())
             flood_acts.extend(self._build_flood_port_outputs(
-                untagged_ports, in_port))
+                untagged_port_nums, in_port.number))
         return flood_acts
 
     def _port_is_dp_local(self, port):
@@ -84,7 +100,7 @@ class ValveFloodManager(object):
     def _dp_is_root(self):
         return self.stack is not None and 'priority' in self.stack
 
-    def _build_flood_rule_actions(self, vlan, exclude_unicast, in_port):
+    def _build_flood_rule_actions(self, flood_ports, in_port):
         """Calculate flooding destinations based on this DP's position.
 
         If a standalone switch, then flood to local VLAN ports.
@@ -133,15 +149,17 @@ class ValveFloodManager(object):
         5: 1 2 3 4
         """
         local_flood_actions = self._build_flood_local_rule_actions(
-            vlan, exclude_unicast, in_port)
+            flood_ports, in_port)
         # If we're a standalone switch, then flood local VLAN
         if self.stack is None:
             return local_flood_actions
 
         away_flood_actions = self._build_flood_port_outputs(
-            self.away_from_root_stack_ports, in_port)
+            [port.number for port in self.away_from_root_stack_ports],
+            in_port.number)
         toward_flood_actions = self._build_flood_port_outputs(
-            self.towards_root_stack_ports, in_port)
+            [port.number for port in self.towards_root_stack_ports],
+            in_port.number)
         flood_all_except_self = local_flood_actions + away_flood_actions
 
         # If we're the root of a distributed switch..
@@ -163,69 +181,197 @@ class ValveFloodManager(object):
             else:
                 return toward_flood_actions
 
-    def _build_flood_rule_for_port(self, vlan, eth_dst, eth_dst_mask,
-                                   exclude_unicast, command, flood_priority,
-                                   port, preflood_acts):
-        ofmsgs = []
-        match = self.valve_in_match(
-            self.flood_table, vlan=vlan, in_port=port.number,
-            eth_dst=eth_dst, eth_dst_mask=eth_dst_mask)
-        flood_acts = self._build_flood_rule_actions(
-            vlan, exclude_unicast, port)
-        ofmsgs.append(self.valve_flowmod(
-            self.flood_table,
-            match=match,
-            command=command,
-            inst=[valve_of.apply_actions(preflood_acts + flood_acts)],
-            priority=flood_priority))
-        return ofmsgs
+    @staticmethod
+    def _flood_ports(vlan, exclude_unicast):
+        """Return numbers of the tagged and untagged ports a VLAN floods to."""
+        return (
+            tuple([port.number for port in vlan.tagged_flood_ports(
+                exclude_unicast)]),
+            tuple([port.number for port in vlan.untagged_flood_ports(
+                exclude_unicast)]))
 
-    def _build_unmirrored_flood_rules(self, vlan, eth_dst, eth_dst_mask,
-                                      exclude_unicast, command, flood_priority):
-        ofmsgs = []
-        vlan_all_ports = []
-        vlan_all_ports.extend(vlan.flood_ports(vlan.get_ports(), exclude_unicast))
-        vlan_all_ports.extend(self.away_from_root_stack_ports)
-        vlan_all_ports.extend(self.towards_root_stack_ports)
-        for port in vlan_all_ports:
-            ofmsgs.extend(self._build_flood_rule_for_port(
-                vlan, eth_dst, eth_dst_mask,
-                exclude_unicast, command, flood_priority,
-                port, []))
-        return ofmsgs
+    def _port_flood_actions(self, vlan, exclude_unicast, flood_ports,
+                            port, mirrored):
+        """Return actions to flood packets from a port.
 
-    def _build_mirrored_flood_rules(self, vlan, eth_dst, eth_dst_mask,
-                                    exclude_unicast, command, flood_priority):
-        ofmsgs = []
-        mirrored_ports = vlan.mirrored_ports()
-        for port in mirrored_ports:
-            mirror_acts = [valve_of.output_port(port.mirror)]
-            ofmsgs.extend(self._build_flood_rule_for_port(
-                vlan, eth_dst, eth_dst_mask,
-                exclude_unicast, command, flood_priority,
-                port, mirror_acts))
-        return ofmsgs
+        Actions are cached, until the ports the VLAN floods to change.
+        """
+        cache_key = (vlan.vid, exclude_unicast, port.number, mirrored)
+        cached = self._flood_actions_cache.get(cache_key, None)
+        if cached is not None and cached[0] == flood_ports:
+            return cached[1]
+        flood_acts = self._build_flood_rule_actions(flood_ports, port)
+        if mirrored:
+            flood_acts = [valve_of.output_port(port.mirror)] + flood_acts
+        self._flood_actions_cache[cache_key] = (flood_ports, flood_acts)
+        return flood_acts
 
-    def build_flood_rules(self, vlan, modify=False):
-        """Add flows to flood packets to unknown destinations on a VLAN."""
-        # TODO: not all vendors implement groups well.
-        # That means we need flood rules for each input port, outputting
-        # to all ports except the input port. When all vendors implement
-        # groups correctly we can use them.
-        command = ofp.OFPFC_ADD
-        if modify:
-            command = ofp.OFPFC_MODIFY_STRICT
+    def _build_vlan_flood_actions(self, vlan):
+        """Return the actions of each of a VLAN's flood flows.
+
+        Returns:
+            list: ((priority, in_port, eth_dst, eth_dst_mask), actions).
+        """
         flood_priority = self.flood_priority
-        ofmsgs = []
+        flows = []
         for unicast_eth_dst, eth_dst, eth_dst_mask in self.FLOOD_DSTS:
             if unicast_eth_dst and not vlan.unicast_flood:
                 continue
-            ofmsgs.extend(self._build_unmirrored_flood_rules(
-                vlan, eth_dst, eth_dst_mask,
-                unicast_eth_dst, command, flood_priority))
-            flood_priority += 1
-            ofmsgs.extend(self._build_mirrored_flood_rules(
-                vlan, eth_dst, eth_dst_mask,
-                unicast_eth_dst, command, flood_priority))
-            flood_priority += 1
+            mirrored_priority = flood_priority + 1
+            if self.use_group_table:
+                group_act = valve_of.group_act(
+                    self._flood_group_id(vlan, unicast_eth_dst))
+                if unicast_eth_dst:
+                    # Only ports with unicast flooding enabled flood
+                    # unknown unicast, so there is a flow per port.
+                    for port in vlan.flood_ports(vlan.get_ports(), True):
+                        flows.append((
+                            (flood_priority, port.number,
+                             eth_dst, eth_dst_mask),
+                            [group_act]))
+                else:
+                    flows.append((
+                        (flood_priority, None, eth_dst, eth_dst_mask),
+                        [group_act]))
+                for port in vlan.mirrored_ports():
+                    flows.append((
+                        (mirrored_priority, port.number, eth_dst, eth_dst_mask),
+                        [valve_of.output_port(port.mirror), group_act]))
+            else:
+                flood_ports = self._flood_ports(vlan, unicast_eth_dst)
+                in_ports = []
+                in_ports.extend(
+                    vlan.flood_ports(vlan.get_ports(), unicast_eth_dst))
+                in_ports.extend(self.away_from_root_stack_ports)
+                in_ports.extend(self.towards_root_stack_ports)
+                for port in in_ports:
+                    flows.append((
+                        (flood_priority, port.number, eth_dst, eth_dst_mask),
+                        self._port_flood_actions(
+                            vlan, unicast_eth_dst, flood_ports, port, False)))
+                for port in vlan.mirrored_ports():
+                    flows.append((
+                        (mirrored_priority, port.number, eth_dst, eth_dst_mask),
+                        self._port_flood_actions(
+                            vlan, unicast_eth_dst, flood_ports, port, True)))
+            flood_priority += 2
+        return flows
+
+    def _flood_group_id(self, vlan, exclude_unicast):
+        if exclude_unicast:
+            return vlan.vid + self.UNICAST_FLOOD_GROUP_OFFSET
+        return vlan.vid
+
+    @staticmethod
+    def _flood_groupmod(group_id, group_ports, installed_ports):
+        """Return a group mod to add or change a flood group.
+
+        The group is an ALL group with a bucket for each port, which
+        the datapath will not apply to a packet's input port.
+        """
+        tagged_port_nums, untagged_port_nums = group_ports
+        buckets = []
+        for port_num in tagged_port_nums:
+            buckets.append(valve_of.bucket(
+                [valve_of.output_port(port_num)]))
+        for port_num in untagged_port_nums:
+            buckets.append(valve_of.bucket(
+                [valve_of.pop_vlan(), valve_of.output_port(port_num)]))
+        if installed_ports is None:
+            return valve_of.groupadd(group_id, buckets)
+        return valve_of.groupmod(group_id, buckets)
+
+    def _build_flood_group(self, vlan, exclude_unicast):
+        """Return a group mod if a VLAN's flood group needs changing."""
+        group_id = self._flood_group_id(vlan, exclude_unicast)
+        group_ports = self._flood_ports(vlan, exclude_unicast)
+        installed_ports = self.flood_groups.get(group_id, None)
+        if installed_ports == group_ports:
+            return []
+        self.flood_groups[group_id] = group_ports
+        return [self._flood_groupmod(group_id, group_ports, installed_ports)]
+
+    def flush_flood_cache(self):
+        """Forget the installed flood flows and groups.
+
+        Used when they are to be deleted, or are not known.
+        """
+        self.flood_flows = {}
+        self.flood_groups = {}
+
+    def flush_port_from_flood_cache(self, port):
+        """Forget installed flood flows matching a port, once deleted."""
+        for installed_flows in self.flood_flows.itervalues():
+            for flow in installed_flows.keys():
+                if flow[1] == port.number:
+                    del installed_flows[flow]
+
+    def flood_group_changes(self, installed_groups):
+        """Return group mods to change installed groups to this manager's.
+
+        Args:
+            installed_groups (dict): ports of installed groups, by group ID
+                (the flood_groups of the manager that installed them).
+        Returns:
+            list: OpenFlow group mods.
+        """
+        ofmsgs = []
+        for group_id, group_ports in sorted(self.flood_groups.iteritems()):
+            installed_ports = installed_groups.get(group_id, None)
+            if installed_ports != group_ports:
+                ofmsgs.append(self._flood_groupmod(
+                    group_id, group_ports, installed_ports))
+        for group_id in sorted(installed_groups):
+            if group_id not in self.flood_groups:
+                ofmsgs.append(valve_of.groupdel(group_id))
+        return ofmsgs
+
+    @staticmethod
+    def _actions_key(actions):
+        return tuple([
+            (action.type, getattr(action, 'port', None),
+             getattr(action, 'group_id', None))
+            for action in actions])
+
+    def build_flood_rules(self, vlan, modify=False):
+        """Add flows to flood packets to unknown destinations on a VLAN.
+
+        Args:
+            vlan (VLAN): VLAN to flood.
+            modify (bool): if True, only flows that are not installed, or
+                whose actions have changed (eg. as a port changed), are
+                added or modified.
+        Returns:
+            list: OpenFlow messages.
+        """
+        # Not all vendors implement groups well, so by default there are
+        # flood rules for each input port, outputting to all ports except
+        # the input port.
+        ofmsgs = []
+        if self.use_group_table:
+            # Groups must be added before flows that use them.
+            ofmsgs.extend(self._build_flood_group(vlan, False))
+            if vlan.unicast_flood:
+                ofmsgs.extend(self._build_flood_group(vlan, True))
+        installed_flows = self.flood_flows.setdefault(vlan.vid, {})
+        for flow, flood_acts in self._build_vlan_flood_actions(vlan):
+            command = ofp.OFPFC_ADD
+            if modify:
+                installed_acts = installed_flows.get(flow, None)
+                if installed_acts is not None:
+                    if (installed_acts is flood_acts or
+                            self._actions_key(installed_acts) ==
+                            self._actions_key(flood_acts)):
+                        continue
+                    command = ofp.OFPFC_MODIFY_STRICT
+            installed_flows[flow] = flood_acts
+            priority, in_port_num, eth_dst, eth_dst_mask = flow
+            ofmsgs.append(self.valve_flowmod(
+                self.flood_table,
+                match=self.valve_in_match(
+                    self.flood_table, vlan=vlan, in_port=in_port_num,
+                    eth_dst=eth_dst, eth_dst_mask=eth_dst_mask),
+                command=command,
+                inst=[valve_of.apply_actions(flood_acts)],
+                priority=priority))
         return ofmsgs
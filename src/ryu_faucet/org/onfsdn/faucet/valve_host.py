@@ -14,6 +14,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import heapq
+import math
 import time
 
 import valve_of
@@ -21,28 +23,155 @@ import valve_of
 
 class HostCacheEntry(object):
 
-    def __init__(self, eth_src, edge, permanent, now):
+    __slots__ = ('eth_src', 'port', 'edge', 'permanent', 'cache_time')
+
+    def __init__(self, eth_src, port, edge, permanent, now):
         self.eth_src = eth_src
+        self.port = port
         self.edge = edge
         self.permanent = permanent
         self.cache_time = now
 
 
+class EdgeHostIndex(object):
+    """Controller wide index of hosts learned on edge ports of any DP.
+
+    Shared by all Valves, so that a DP learning a host via a stack port can
+    find the DP that learned that host on an edge port, without searching
+    the host caches of every DP.
+    """
+
+    def __init__(self):
+        # Host cache entries of hosts learned on edge ports, by
+        # (vid, eth_src) and then by DP ID.
+        self._hosts = {}
+
+    def learn(self, dp_id, vid, host_cache_entry):
+        """Record a host learned by dp_id, if learned on an edge port."""
+        if host_cache_entry.edge:
+            key = (vid, host_cache_entry.eth_src)
+            self._hosts.setdefault(key, {})[dp_id] = host_cache_entry
+        else:
+            self.forget(dp_id, vid, host_cache_entry.eth_src)
+
+    def forget(self, dp_id, vid, eth_src):
+        """Forget a host, if learned on an edge port of dp_id."""
+        key = (vid, eth_src)
+        dp_hosts = self._hosts.get(key, None)
+        if dp_hosts is not None:
+            dp_hosts.pop(dp_id, None)
+            if not dp_hosts:
+                del self._hosts[key]
+
+    def edge_dp(self, valves, vid, eth_src, exclude_dp_id=None):
+        """Return a DP that has learned a host on an edge port, if any.
+
+        If more than one DP has, the one with the lowest ID is returned.
+
+        Args:
+            valves (dict): all datapaths, indexed by datapath ID.
+            vid (int): VLAN VID host was learned on.
+            eth_src (str): MAC address of host.
+            exclude_dp_id (int): DP ID not to return (eg. the caller's).
+        Returns:
+            DP: DP that learned the host, or None.
+        """
+        dp_hosts = self._hosts.get((vid, eth_src), None)
+        if dp_hosts is None:
+            return None
+        for dp_id in sorted(dp_hosts):
+            if dp_id == exclude_dp_id:
+                continue
+            host_cache_entry = dp_hosts[dp_id]
+            if dp_id in valves:
+                edge_dp = valves[dp_id].dp
+                # The DP may have since forgotten the host without expiring
+                # it (eg. reconnected or reloaded), so confirm it is cached.
+                if vid in edge_dp.vlans:
+                    host_cache = edge_dp.vlans[vid].host_cache
+                    if host_cache.get(eth_src, None) is host_cache_entry:
+                        return edge_dp
+            self.forget(dp_id, vid, eth_src)
+        return None
+
+
+class HostExpiryWheel(object):
+    """Hosts on a VLAN, bucketed by when they are due to expire.
+
+    Hosts are placed in slots, each precision seconds wide, so that expiry
+    only visits hosts in slots that are due, rather than every host.
+    """
+
+    def __init__(self, precision):
+        self.precision = precision
+        self._slots = {}
+        self._host_slot = {}
+        self._due_slots = []
+
+    def schedule(self, eth_src, expire_time):
+        """Schedule a host to be checked for expiry at expire_time."""
+        slot = int(math.ceil(expire_time / self.precision))
+        old_slot = self._host_slot.get(eth_src, None)
+        if old_slot == slot:
+            return
+        if old_slot is not None:
+            self._slots[old_slot].discard(eth_src)
+        if slot not in self._slots:
+            self._slots[slot] = set()
+            heapq.heappush(self._due_slots, slot)
+        self._slots[slot].add(eth_src)
+        self._host_slot[eth_src] = slot
+
+    def unschedule(self, eth_src):
+        """Stop checking a host for expiry."""
+        slot = self._host_slot.pop(eth_src, None)
+        if slot is not None:
+            self._slots[slot].discard(eth_src)
+
+    def pop_due(self, now):
+        """Return hosts whose slots are due at time now."""
+        due_hosts = []
+        while self._due_slots and self._due_slots[0] * self.precision <= now:
+            slot = heapq.heappop(self._due_slots)
+            for eth_src in self._slots.pop(slot):
+                del self._host_slot[eth_src]
+                due_hosts.append(eth_src)
+        return due_hosts
+
+    def __len__(self):
+        return len(self._host_slot)
+
+
 class ValveHostManager(object):
 
     def __init__(self, logger, eth_src_table, eth_dst_table,
-                 learn_timeout, low_priority, host_priority,
-                 valve_in_match, valve_flowmod, valve_flowdel, valve_flowdrop):
+                 learn_timeout, cache_update_guard_time, expire_precision,
+                 low_priority, host_priority,
+                 valve_in_match, valve_flowmod, valve_flowdel, valve_flowdrop,
+                 dp_id, edge_host_index):
         self.logger = logger
         self.eth_src_table = eth_src_table
         self.eth_dst_table = eth_dst_table
         self.learn_timeout = learn_timeout
+        self.cache_update_guard_time = cache_update_guard_time
+        self.expire_precision = expire_precision
+        # Hosts due to expire, per VLAN VID.
+        self.expiry_wheels = {}
+        # Serialized learn flowmods, per table, priority, timeout and action
+        # shape. The cookie is serialized too, so they are only valid for
+        # this host manager, which is replaced when the DP's config changes.
+        self.learn_flowmod_templates = {}
         self.low_priority = low_priority
         self.host_priority = host_priority
         self.valve_in_match = valve_in_match
         self.valve_flowmod = valve_flowmod
         self.valve_flowdel = valve_flowdel
         self.valve_flowdrop = valve_flowdrop
+        self.dp_id = dp_id
+        self.edge_host_index = edge_host_index
+        # Count of relearns suppressed/not suppressed by the guard time.
+        self.learn_cache_hits = 0
+        self.learn_cache_misses = 0
 
     def temp_ban_host_learning_on_vlan(self, vlan):
         return self.valve_flowdrop(
@@ -51,17 +180,14 @@ class ValveHostManager(object):
             priority=(self.low_priority + 1),
             hard_timeout=self.host_priority)
 
-    def build_port_out_inst(self, vlan, port):
-        dst_act = []
-        if not vlan.port_is_tagged(port.number) and port.stack is None:
-            dst_act.append(valve_of.pop_vlan())
-        dst_act.append(valve_of.output_port(port.number))
-
-        if port.mirror is not None:
-            mirror_acts = [valve_of.output_port(port.mirror)]
-            dst_act.extend(mirror_acts)
-
-        return [valve_of.apply_actions(dst_act)]
+    def temp_ban_packet_ins_on_port(self, port, ban_time):
+        """Forward packets from unlearned hosts on a port without packet ins."""
+        return self.valve_flowmod(
+            self.eth_src_table,
+            self.valve_in_match(self.eth_src_table, in_port=port.number),
+            priority=(self.low_priority + 1),
+            inst=[valve_of.goto_table(self.eth_dst_table)],
+            hard_timeout=ban_time)
 
     def delete_host_from_vlan(self, eth_src, vlan):
         ofmsgs = []
@@ -81,25 +207,164 @@ class ValveHostManager(object):
 
         return ofmsgs
 
+    def _expiry_wheel(self, vlan):
+        if vlan.vid not in self.expiry_wheels:
+            self.expiry_wheels[vlan.vid] = HostExpiryWheel(
+                self.expire_precision)
+        return self.expiry_wheels[vlan.vid]
+
+    def schedule_expiry_for_vlan(self, vlan):
+        """Schedule expiry of all hosts cached on a VLAN (eg. on reload)."""
+        expiry_wheel = self._expiry_wheel(vlan)
+        for eth_src, host_cache_entry in vlan.host_cache.iteritems():
+            if host_cache_entry.permanent:
+                expiry_wheel.unschedule(eth_src)
+            else:
+                expiry_wheel.schedule(
+                    eth_src, host_cache_entry.cache_time + self.learn_timeout)
+
     def expire_hosts_from_vlan(self, vlan, now):
         expired_hosts = []
-        for eth_src, host_cache_entry in vlan.host_cache.iteritems():
+        expiry_wheel = self._expiry_wheel(vlan)
+        for eth_src in expiry_wheel.pop_due(now):
+            # The host may since have been forgotten (eg. port went down).
+            if eth_src not in vlan.host_cache:
+                continue
+            host_cache_entry = vlan.host_cache[eth_src]
             if not host_cache_entry.permanent:
                 host_cache_entry_age = now - host_cache_entry.cache_time
                 if host_cache_entry_age > self.learn_timeout:
                     expired_hosts.append(eth_src)
+                else:
+                    expiry_wheel.schedule(
+                        eth_src, host_cache_entry.cache_time + self.learn_timeout)
         if expired_hosts:
             for eth_src in expired_hosts:
                 del vlan.host_cache[eth_src]
+                self.edge_host_index.forget(self.dp_id, vlan.vid, eth_src)
                 self.logger.info(
                     'expiring host %s from vlan %u', eth_src, vlan.vid)
             self.logger.info(
                 '%u recently active hosts on vlan %u',
                 len(vlan.host_cache), vlan.vid)
 
+    def flush_port_from_host_cache(self, port, vlans):
+        """Forget hosts learned on a port, whose flows have been deleted."""
+        for vlan in vlans:
+            port_hosts = [
+                eth_src for eth_src, host_cache_entry in vlan.host_cache.iteritems()
+                if host_cache_entry.port.number == port.number]
+            expiry_wheel = self._expiry_wheel(vlan)
+            for eth_src in port_hosts:
+                del vlan.host_cache[eth_src]
+                expiry_wheel.unschedule(eth_src)
+                self.edge_host_index.forget(self.dp_id, vlan.vid, eth_src)
+
+    def _recently_learned_on_port(self, port, vlan, eth_src, now):
+        """Return True if host was learned on this port within the guard time.
+
+        A packet in racing the installation of flows for a host just
+        learned, would otherwise cause a needless delete/add of those flows.
+        """
+        if eth_src in vlan.host_cache:
+            host_cache_entry = vlan.host_cache[eth_src]
+            cache_age = now - host_cache_entry.cache_time
+            if (host_cache_entry.port.number == port.number and
+                    cache_age < self.cache_update_guard_time):
+                self.learn_cache_hits += 1
+                return True
+        self.learn_cache_misses += 1
+        return False
+
+    def _src_rule_template(self, learn_timeout):
+        template_key = (
+            self.eth_src_table, self.host_priority - 1, learn_timeout)
+        if template_key not in self.learn_flowmod_templates:
+            def build_src_rule(in_port, vlan, eth_src):
+                return self.valve_flowmod(
+                    self.eth_src_table,
+                    self.valve_in_match(
+                        self.eth_src_table, in_port=in_port,
+                        vlan=vlan, eth_src=eth_src),
+                    priority=(self.host_priority - 1),
+                    inst=[valve_of.goto_table(self.eth_dst_table)],
+                    hard_timeout=learn_timeout)
+
+            self.learn_flowmod_templates[template_key] = (
+                valve_of.FlowModTemplate(build_src_rule, {
+                    'in_port': valve_of.PORT_FIELD,
+                    'vlan': valve_of.VLAN_FIELD,
+                    'eth_src': valve_of.MAC_FIELD}))
+        return self.learn_flowmod_templates[template_key]
+
+    def _dst_rule_template(self, learn_timeout, pop_vlan, mirror):
+        template_key = (
+            self.eth_dst_table, self.host_priority, learn_timeout,
+            pop_vlan, mirror)
+        if template_key not in self.learn_flowmod_templates:
+            def build_dst_rule(vlan, eth_dst, port, mirror=None):
+                dst_act = valve_of.output_host_actions(port, pop_vlan, mirror)
+                return self.valve_flowmod(
+                    self.eth_dst_table,
+                    self.valve_in_match(
+                        self.eth_dst_table, vlan=vlan, eth_dst=eth_dst),
+                    priority=self.host_priority,
+                    inst=[valve_of.apply_actions(dst_act)],
+                    idle_timeout=learn_timeout)
+
+            fields = {
+                'vlan': valve_of.VLAN_FIELD,
+                'eth_dst': valve_of.MAC_FIELD,
+                'port': valve_of.PORT_FIELD}
+            if mirror:
+                fields['mirror'] = valve_of.PORT_FIELD
+            self.learn_flowmod_templates[template_key] = (
+                valve_of.FlowModTemplate(build_dst_rule, fields))
+        return self.learn_flowmod_templates[template_key]
+
+    def host_learn_flows(self, port, vlan, eth_src, learn_timeout):
+        """Return the flows forwarding from and to a host learned on a port.
+
+        Args:
+            port (Port): port host was learned on.
+            vlan (VLAN): VLAN host was learned on.
+            eth_src (str): MAC address of host.
+            learn_timeout (int): seconds before the flows time out (0 never).
+        Returns:
+            list: eth_src table and eth_dst table flowmods.
+        """
+        in_port = port.number
+        # Update datapath to no longer send packets from this mac to controller
+        # note the use of hard_timeout here and idle_timeout for the dst table
+        # this is to ensure that the source rules will always be deleted before
+        # any rules on the dst table. Otherwise if the dst table rule expires
+        # but the src table rule is still being hit intermittantly the switch
+        # will flood packets to that dst and not realise it needs to relearn
+        # the rule
+        # NB: Must be lower than highest priority otherwise it can match
+        # flows destined to controller
+        src_flowmod = self._src_rule_template(learn_timeout).flowmod(
+            in_port=in_port, vlan=vlan, eth_src=eth_src)
+
+        # update datapath to output packets to this mac via the associated port
+        pop_vlan = valve_of.output_pops_vlan(vlan, port)
+        dst_fields = {'vlan': vlan, 'eth_dst': eth_src, 'port': in_port}
+        if port.mirror is not None:
+            dst_fields['mirror'] = port.mirror
+        dst_flowmod = self._dst_rule_template(
+            learn_timeout, pop_vlan, port.mirror is not None).flowmod(
+                **dst_fields)
+        return [src_flowmod, dst_flowmod]
+
     def learn_host_on_vlan_port(self, port, vlan, eth_src):
         ofmsgs = []
-        in_port = port.number
+        now = time.time()
+        # Share one copy of the MAC between the host cache, the expiry
+        # wheel and the edge host index, however many times it is relearned.
+        eth_src = intern(eth_src)
+
+        if self._recently_learned_on_port(port, vlan, eth_src, now):
+            return ofmsgs
 
         # hosts learned on this port never relearned
         if port.permanent_learn:
@@ -115,37 +380,19 @@ class ValveHostManager(object):
             learn_timeout = self.learn_timeout
             ofmsgs.extend(self.delete_host_from_vlan(eth_src, vlan))
 
-        # Update datapath to no longer send packets from this mac to controller
-        # note the use of hard_timeout here and idle_timeout for the dst table
-        # this is to ensure that the source rules will always be deleted before
-        # any rules on the dst table. Otherwise if the dst table rule expires
-        # but the src table rule is still being hit intermittantly the switch
-        # will flood packets to that dst and not realise it needs to relearn
-        # the rule
-        # NB: Must be lower than highest priority otherwise it can match
-        # flows destined to controller
-        ofmsgs.append(self.valve_flowmod(
-            self.eth_src_table,
-            self.valve_in_match(
-                self.eth_src_table, in_port=in_port,
-                vlan=vlan, eth_src=eth_src),
-            priority=(self.host_priority - 1),
-            inst=[valve_of.goto_table(self.eth_dst_table)],
-            hard_timeout=learn_timeout))
-
-        # update datapath to output packets to this mac via the associated port
-        ofmsgs.append(self.valve_flowmod(
-            self.eth_dst_table,
-            self.valve_in_match(
-                self.eth_dst_table, vlan=vlan, eth_dst=eth_src),
-            priority=self.host_priority,
-            inst=self.build_port_out_inst(vlan, port),
-            idle_timeout=learn_timeout))
+        ofmsgs.extend(
+            self.host_learn_flows(port, vlan, eth_src, learn_timeout))
 
         host_cache_entry = HostCacheEntry(
             eth_src,
+            port,
             port.stack is None,
             port.permanent_learn,
-            time.time())
+            now)
         vlan.host_cache[eth_src] = host_cache_entry
+        if learn_timeout:
+            self._expiry_wheel(vlan).schedule(eth_src, now + learn_timeout)
+        else:
+            self._expiry_wheel(vlan).unschedule(eth_src)
+        self.edge_host_index.learn(self.dp_id, vlan.vid, host_cache_entry)
         return ofmsgs
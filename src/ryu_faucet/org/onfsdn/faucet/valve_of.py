@@ -16,6 +16,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import binascii
+import struct
+
 from collections import namedtuple
 
 from ryu.lib import ofctl_v1_3 as ofctl
@@ -47,6 +50,9 @@ def apply_actions(actions):
     return parser.OFPInstructionActions(ofp.OFPIT_APPLY_ACTIONS, actions)
 
 
+_GOTO_TABLE_INSTS = {}
+
+
 def goto_table(table_id):
     """Return instruction to goto table.
 
@@ -55,7 +61,9 @@ def goto_table(table_id):
     Returns:
         ryu.ofproto.ofproto_v1_3_parser.OFPInstruction: goto instruction.
     """
-    return parser.OFPInstructionGotoTable(table_id)
+    if table_id not in _GOTO_TABLE_INSTS:
+        _GOTO_TABLE_INSTS[table_id] = parser.OFPInstructionGotoTable(table_id)
+    return _GOTO_TABLE_INSTS[table_id]
 
 
 def set_eth_src(eth_src):
@@ -114,13 +122,16 @@ def dec_ip_ttl():
     return parser.OFPActionDecNwTtl()
 
 
+_POP_VLAN_ACT = parser.OFPActionPopVlan()
+
+
 def pop_vlan():
     """Return OpenFlow action to pop outermost Ethernet 802.1Q VLAN header.
 
     Returns:
         ryu.ofproto.ofproto_v1_3_parser.OFPActionPopVlan: Pop VLAN.
     """
-    return parser.OFPActionPopVlan()
+    return _POP_VLAN_ACT
 
 
 def output_port(port_num, max_len=0):
@@ -144,13 +155,162 @@ def output_in_port():
     return output_port(ofp.OFPP_IN_PORT)
 
 
+def output_pops_vlan(vlan, port):
+    """Return True if packets on a VLAN are output to a port untagged.
+
+    Packets output to stack ports keep their tag, for the next datapath.
+
+    Args:
+        vlan (VLAN): VLAN of packets.
+        port (Port): port to output to.
+    Returns:
+        bool: True if the VLAN header must be popped before output.
+    """
+    return not vlan.port_is_tagged(port.number) and port.stack is None
+
+
+def output_host_actions(port_num, untagged, mirror=None):
+    """Return OpenFlow actions to output to a host learned on a port.
+
+    Args:
+        port_num (int): port host was learned on.
+        untagged (bool): True to pop the VLAN header before output.
+        mirror (int): port to mirror the output to (None if not mirrored).
+    Returns:
+        list: OpenFlow actions.
+    """
+    actions = []
+    if untagged:
+        actions.append(pop_vlan())
+    actions.append(output_port(port_num))
+    if mirror is not None:
+        actions.append(output_port(mirror))
+    return actions
+
+
+_OUTPUT_CONTROLLER_ACT = parser.OFPActionOutput(
+    ofp.OFPP_CONTROLLER, max_len=256)
+
+
 def output_controller():
     """Return OpenFlow action to packet in to the controller (max 256 bytes).
 
     Returns:
         ryu.ofproto.ofproto_v1_3_parser.OFPActionOutput: packet in action.
     """
-    return output_port(ofp.OFPP_CONTROLLER, 256)
+    return _OUTPUT_CONTROLLER_ACT
+
+
+def group_act(group_id):
+    """Return OpenFlow action to process a packet with a group.
+
+    Args:
+        group_id (int): group to process packet with.
+    Returns:
+        ryu.ofproto.ofproto_v1_3_parser.OFPActionGroup: group action.
+    """
+    return parser.OFPActionGroup(group_id)
+
+
+def bucket(actions):
+    """Return an OpenFlow group bucket.
+
+    Args:
+        actions (list): actions to apply to the bucket's copy of a packet.
+    Returns:
+        ryu.ofproto.ofproto_v1_3_parser.OFPBucket: bucket.
+    """
+    return parser.OFPBucket(
+        weight=0, watch_port=ofp.OFPP_ANY, watch_group=ofp.OFPG_ANY,
+        actions=actions)
+
+
+def groupmod(group_id, buckets, command=ofp.OFPGC_MODIFY,
+             group_type=ofp.OFPGT_ALL):
+    """Return OpenFlow group mod.
+
+    Args:
+        group_id (int): group to change.
+        buckets (list): ryu.ofproto.ofproto_v1_3_parser.OFPBucket.
+        command (int): OFPGC_ADD, OFPGC_MODIFY or OFPGC_DELETE.
+        group_type (int): OFPGT_ALL by default (all buckets are applied).
+    Returns:
+        ryu.ofproto.ofproto_v1_3_parser.OFPGroupMod: group mod.
+    """
+    return parser.OFPGroupMod(
+        datapath=None,
+        command=command,
+        type_=group_type,
+        group_id=group_id,
+        buckets=buckets)
+
+
+def groupadd(group_id, buckets, group_type=ofp.OFPGT_ALL):
+    """Return OpenFlow group mod to add a group.
+
+    Args:
+        group_id (int): group to add.
+        buckets (list): ryu.ofproto.ofproto_v1_3_parser.OFPBucket.
+        group_type (int): OFPGT_ALL by default (all buckets are applied).
+    Returns:
+        ryu.ofproto.ofproto_v1_3_parser.OFPGroupMod: group mod.
+    """
+    return groupmod(group_id, buckets, ofp.OFPGC_ADD, group_type)
+
+
+def groupdel(group_id=ofp.OFPG_ALL):
+    """Return OpenFlow group mod to delete a group (default all groups).
+
+    Flows that use a deleted group are also deleted by the datapath.
+
+    Args:
+        group_id (int): group to delete.
+    Returns:
+        ryu.ofproto.ofproto_v1_3_parser.OFPGroupMod: group mod.
+    """
+    return groupmod(group_id, [], ofp.OFPGC_DELETE)
+
+
+def instructions_group_ids(instructions):
+    """Return the IDs of the groups instructions process packets with.
+
+    Args:
+        instructions (list): ryu.ofproto.ofproto_v1_3_parser instructions.
+    Returns:
+        set: group IDs of the group actions.
+    """
+    group_ids = set()
+    for instruction in instructions:
+        for action in getattr(instruction, 'actions', []):
+            if action.type == ofp.OFPAT_GROUP:
+                group_ids.add(action.group_id)
+    return group_ids
+
+
+def instructions_use_group(instructions):
+    """Return True if instructions process packets with a group.
+
+    Args:
+        instructions (list): ryu.ofproto.ofproto_v1_3_parser instructions.
+    Returns:
+        bool: True if any instruction has a group action.
+    """
+    return bool(instructions_group_ids(instructions))
+
+
+def instructions_output_port(instructions):
+    """Return the first port instructions output packets to.
+
+    Args:
+        instructions (list): ryu.ofproto.ofproto_v1_3_parser instructions.
+    Returns:
+        int: port number, or None if packets are not output to a port.
+    """
+    for instruction in instructions:
+        for action in getattr(instruction, 'actions', []):
+            if action.type == ofp.OFPAT_OUTPUT:
+                return action.port
+    return None
 
 
 def packetout(port_num, data):
@@ -179,6 +339,152 @@ def barrier():
     return parser.OFPBarrierRequest(None)
 
 
+def is_flowdel(ofmsg):
+    """Return True if flow message is a delete.
+
+    Args:
+        ofmsg: ryu.ofproto.ofproto_v1_3_parser message.
+    Returns:
+        bool: True if is a FlowMod delete/strict.
+    """
+    if (isinstance(ofmsg, parser.OFPFlowMod) and
+            (ofmsg.command == ofp.OFPFC_DELETE or
+             ofmsg.command == ofp.OFPFC_DELETE_STRICT)):
+        return True
+    return False
+
+
+def is_flowadd(ofmsg):
+    """Return True if flow message is an add.
+
+    Args:
+        ofmsg: ryu.ofproto.ofproto_v1_3_parser message.
+    Returns:
+        bool: True if is a FlowMod add.
+    """
+    return (isinstance(ofmsg, parser.OFPFlowMod) and
+            ofmsg.command == ofp.OFPFC_ADD)
+
+
+def flow_key(flowmod):
+    """Return a key identifying the flow a flowmod adds, within a datapath.
+
+    Args:
+        flowmod (ryu.ofproto.ofproto_v1_3_parser.OFPFlowMod): flowmod.
+    Returns:
+        tuple: table ID, priority and match fields.
+    """
+    return (
+        flowmod.table_id,
+        flowmod.priority,
+        tuple(sorted(flowmod.match.items())))
+
+
+def _mask_value(value, mask):
+    if isinstance(value, (int, long)):
+        return value & mask
+    return ''.join(
+        chr(ord(value_byte) & ord(mask_byte))
+        for value_byte, mask_byte in zip(value, mask))
+
+
+def match_key(match):
+    """Return a key for match fields, the same however the match was built.
+
+    Matches built by FAUCET and matches parsed from a datapath's flow
+    stats may represent the same fields differently (e.g. case of MAC
+    addresses, or order of fields), so fields are compared in wire format.
+
+    Args:
+        match (ryu.ofproto.ofproto_v1_3_parser.OFPMatch): match.
+    Returns:
+        tuple: sorted (OXM field, value, mask).
+    """
+    fields = []
+    for field, value in match.items():
+        oxm_field, value, mask = ofp.oxm_from_user(field, value)
+        if mask is not None:
+            value = _mask_value(value, mask)
+        fields.append((oxm_field, value, mask))
+    return tuple(sorted(fields))
+
+
+def instructions_key(instructions):
+    """Return instructions serialized, to compare installed instructions.
+
+    Args:
+        instructions (list): ryu.ofproto.ofproto_v1_3_parser instructions.
+    Returns:
+        str: serialized instructions.
+    """
+    buf = bytearray()
+    for instruction in instructions:
+        instruction.serialize(buf, len(buf))
+    return str(buf)
+
+
+def flow_stats_request(cookie):
+    """Return a request for all of a datapath's flows with a cookie.
+
+    Args:
+        cookie (int): cookie of flows to request.
+    Returns:
+        ryu.ofproto.ofproto_v1_3_parser.OFPFlowStatsRequest: request.
+    """
+    return parser.OFPFlowStatsRequest(
+        datapath=None,
+        table_id=ofp.OFPTT_ALL,
+        out_port=ofp.OFPP_ANY,
+        out_group=ofp.OFPG_ANY,
+        cookie=cookie,
+        cookie_mask=0xffffffffffffffff,
+        match=parser.OFPMatch())
+
+
+def is_barrier(ofmsg):
+    """Return True if message is a barrier request.
+
+    Args:
+        ofmsg: ryu.ofproto.ofproto_v1_3_parser message.
+    Returns:
+        bool: True if is a barrier request.
+    """
+    return isinstance(ofmsg, parser.OFPBarrierRequest)
+
+
+def is_groupmod(ofmsg):
+    """Return True if message is a group mod.
+
+    Args:
+        ofmsg: ryu.ofproto.ofproto_v1_3_parser message.
+    Returns:
+        bool: True if is a GroupMod.
+    """
+    return isinstance(ofmsg, parser.OFPGroupMod)
+
+
+def valve_flowreorder(ofmsgs):
+    """Return flow messages with deletes first, followed by a single barrier.
+
+    Args:
+        ofmsgs (list): OpenFlow messages, possibly separated by barriers.
+    Returns:
+        list: OpenFlow messages, with all deletes before all other messages.
+    """
+    flowdels = []
+    others = []
+    for ofmsg in ofmsgs:
+        if is_barrier(ofmsg):
+            continue
+        if is_flowdel(ofmsg):
+            flowdels.append(ofmsg)
+        else:
+            others.append(ofmsg)
+    if flowdels:
+        return flowdels + [barrier()] + others
+    return others
+
+
 def table_features(body):
     return parser.OFPTableFeaturesStatsRequest(
         datapath=None, body=body)
@@ -202,6 +508,22 @@ def match_from_dict(match_dict):
     return acl_match
 
 
+def ipnet_key(ipnet):
+    """Return a hashable key for an IP network, including its host bits.
+
+    ipaddr networks compare equal if their network and netmask are equal,
+    but matches are built from the address including any host bits.
+
+    Args:
+        ipnet (ipaddr.IPNetwork): IP network, or None.
+    Returns:
+        tuple: (address, netmask) or None.
+    """
+    if ipnet is None:
+        return None
+    return (ipnet.ip, ipnet.netmask)
+
+
 def build_match_dict(in_port=None, vlan=None,
                      eth_type=None, eth_src=None,
                      eth_dst=None, eth_dst_mask=None,
@@ -258,3 +580,171 @@ def flowmod(cookie, command, table_id, priority, out_port, out_group,
         instructions=inst,
         hard_timeout=hard_timeout,
         idle_timeout=idle_timeout)
+
+
+class _NullDatapath(object):
+    """Enough of a datapath to serialize messages without a connection."""
+
+    ofproto = ofp
+    ofproto_parser = parser
+
+
+def pack_port(port_num):
+    """Return a port number, packed as in an OpenFlow message."""
+    return struct.pack('!I', port_num)
+
+
+def pack_vlan_vid(vlan):
+    """Return a VLAN's VID, packed as in an OpenFlow match."""
+    return struct.pack('!H', vid_present(vlan.vid))
+
+
+def pack_mac(mac):
+    """Return an Ethernet MAC address, packed as in an OpenFlow match."""
+    return binascii.unhexlify(mac.replace(':', ''))
+
+
+# How to pack a templated field, and two values to find it with, that
+# differ in every byte once packed.
+TemplateField = namedtuple('TemplateField', ('pack', 'proto', 'alt'))
+_ProtoVLAN = namedtuple('_ProtoVLAN', ('vid',))
+
+PORT_FIELD = TemplateField(pack_port, 0x01010101, 0x02020202)
+VLAN_FIELD = TemplateField(pack_vlan_vid, _ProtoVLAN(0x101), _ProtoVLAN(0x202))
+MAC_FIELD = TemplateField(
+    pack_mac, '01:01:01:01:01:01', '02:02:02:02:02:02')
+
+
+def serialize_offline(ofmsg):
+    """Return an OpenFlow message serialized with xid 0, without a datapath.
+
+    Args:
+        ofmsg: ryu.ofproto.ofproto_v1_3_parser message.
+    Returns:
+        bytearray: serialized message.
+    """
+    datapath, xid = ofmsg.datapath, ofmsg.xid
+    ofmsg.datapath = _NullDatapath
+    ofmsg.xid = 0
+    ofmsg.serialize()
+    ofmsg.datapath, ofmsg.xid = datapath, xid
+    return bytearray(ofmsg.buf)
+
+
+class FlowModTemplate(object):
+    """A flowmod serialized once, into which per flow fields are patched.
+
+    The offset of each field in the serialized flowmod is found by
+    serializing prototypes that differ only in that field. The rest of the
+    flowmod (cookie, table, priority, timeouts, and shape of the match and
+    instructions) must be the same for all flows built from the template.
+    """
+
+    # Attributes of a flowmod that are not the same for every flowmod
+    # built from a template.
+    _PER_FLOWMOD_ATTRS = frozenset(
+        ['datapath', 'xid', 'buf', 'match', 'instructions'])
+
+    def __init__(self, build_flowmod, fields):
+        """Serialize a template flowmod.
+
+        Args:
+            build_flowmod (callable): returns an OFPFlowMod given fields as
+                keyword arguments.
+            fields (dict): TemplateField for each field, keyed by name.
+        """
+        self.build_flowmod = build_flowmod
+        proto_fields = dict(
+            (name, field.proto) for name, field in fields.iteritems())
+        proto_flowmod = build_flowmod(**proto_fields)
+        self.buf = serialize_offline(proto_flowmod)
+        # Attributes (cookie, priority, etc) of every flowmod from this
+        # template, as serialized.
+        self.flowmod_attrs = dict(
+            (name, value)
+            for name, value in proto_flowmod.__dict__.iteritems()
+            if name not in self._PER_FLOWMOD_ATTRS)
+        self.field_offsets = {}
+        for name, field in fields.iteritems():
+            alt_fields = dict(proto_fields)
+            alt_fields[name] = field.alt
+            alt_buf = serialize_offline(build_flowmod(**alt_fields))
+            assert len(alt_buf) == len(self.buf), (
+                '%s changes length of flowmod' % name)
+            diffs = [
+                i for i in range(len(self.buf)) if self.buf[i] != alt_buf[i]]
+            packed = field.pack(field.proto)
+            offset = diffs[0]
+            assert (self.buf[offset:offset + len(packed)] == packed and
+                    diffs[-1] < offset + len(packed)), (
+                        '%s not found in flowmod' % name)
+            self.field_offsets[name] = (offset, field.pack)
+
+    def flowmod(self, **fields):
+        """Return a flowmod that serializes from this template.
+
+        Args:
+            fields: value for each templated field.
+        Returns:
+            TemplatedFlowMod: flowmod.
+        """
+        return TemplatedFlowMod(self, fields)
+
+    def serialize(self, xid, fields):
+        """Return a serialized flowmod with xid and fields patched in.
+
+        Args:
+            xid (int): OpenFlow transaction ID.
+            fields (dict): value for each templated field.
+        Returns:
+            bytearray: serialized flowmod.
+        """
+        buf = bytearray(self.buf)
+        struct.pack_into('!I', buf, 4, xid)
+        for name, (offset, pack) in self.field_offsets.iteritems():
+            packed = pack(fields[name])
+            buf[offset:offset + len(packed)] = packed
+        return buf
+
+
+class TemplatedFlowMod(parser.OFPFlowMod):
+    """OFPFlowMod that serializes by patching a FlowModTemplate.
+
+    The match and instructions are only built (as for any other flowmod)
+    if they are inspected, not to send the flowmod.
+    """
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, template, fields):
+        self.__dict__.update(template.flowmod_attrs)
+        self.datapath = None
+        self.xid = None
+        self.buf = None
+        self.template = template
+        self.template_fields = fields
+        self._flowmod = None
+
+    def _built_flowmod(self):
+        if self._flowmod is None:
+            self._flowmod = self.template.build_flowmod(**self.template_fields)
+        return self._flowmod
+
+    @property
+    def match(self):
+        return self._built_flowmod().match
+
+    @property
+    def instructions(self):
+        return self._built_flowmod().instructions
+
+    def stringify_attrs(self):
+        # Log as the equivalent flowmod.
+        return self._built_flowmod().stringify_attrs()
+
+    def serialize(self):
+        if self.xid is None:
+            self.xid = 0
+        self.version = ofp.OFP_VERSION
+        self.msg_type = self.cls_msg_type
+        self.buf = self.template.serialize(self.xid, self.template_fields)
+        self.msg_len = len(self.buf)
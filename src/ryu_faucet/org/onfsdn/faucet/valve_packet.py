@@ -16,9 +16,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import struct
+
 import ipaddr
 
-from ryu.lib import mac
+from ryu.lib import addrconv, mac
 from ryu.lib.packet import arp, ethernet, icmp, icmpv6, ipv4, ipv6, packet, vlan
 from ryu.ofproto import ether
 from ryu.ofproto import inet
@@ -36,15 +38,72 @@ def mac_addr_is_unicast(mac_addr):
     return msb[-1] in '02468aAcCeE'
 
 
-def parse_pkt(pkt):
-    """Return parsed Ethernet packet.
+ETH_HEADER = struct.Struct('!6s6sH')
+ETH_VLAN_HEADER = struct.Struct('!HH')
+# EtherTypes that may need to be handled by FAUCET's control plane.
+CONTROL_PLANE_ETH_TYPES = frozenset((
+    ether.ETH_TYPE_ARP, ether.ETH_TYPE_IP, ether.ETH_TYPE_IPV6))
+
+
+class PacketMeta(object):
+    """Ethernet/802.1Q header fields of a packet received from the dataplane.
+
+    The header fields are sliced directly out of the raw packet. The full
+    packet is only parsed by ryu, if an upper layer protocol is requested.
+    """
+
+    def __init__(self, data, eth_src, eth_dst, vid, eth_type):
+        self.data = data
+        self.eth_src = eth_src
+        self.eth_dst = eth_dst
+        self.vid = vid
+        self.eth_type = eth_type
+        self._pkt = None
+
+    @property
+    def pkt(self):
+        """ryu.lib.packet.packet: fully parsed packet."""
+        if self._pkt is None:
+            self._pkt = packet.Packet(self.data)
+        return self._pkt
+
+    def get_protocol(self, protocol):
+        """Return first protocol of a type in the packet, parsing if needed.
+
+        Args:
+            protocol (ryu.lib.packet.packet_base.PacketBase): protocol class.
+        Returns:
+            ryu.lib.packet.packet_base.PacketBase: protocol, or None.
+        """
+        if self.eth_type not in CONTROL_PLANE_ETH_TYPES:
+            return None
+        return self.pkt.get_protocol(protocol)
+
+
+def parse_packet_in_pkt(data):
+    """Return Ethernet header fields of a packet, without a full parse.
 
     Args:
-        pkt (ryu.lib.packet.packet): packet received from dataplane.
+        data (str): raw packet received from dataplane.
     Returns:
-        ryu.lib.packet.ethernet: Ethernet packet.
+        PacketMeta: packet header fields, or None if packet is truncated.
     """
-    return pkt.get_protocol(ethernet.ethernet)
+    view = memoryview(data)
+    if len(view) < ETH_HEADER.size:
+        return None
+    eth_dst, eth_src, eth_type = ETH_HEADER.unpack_from(view)
+    vid = None
+    if eth_type == ether.ETH_TYPE_8021Q:
+        if len(view) < ETH_HEADER.size + ETH_VLAN_HEADER.size:
+            return None
+        tci, eth_type = ETH_VLAN_HEADER.unpack_from(view, ETH_HEADER.size)
+        vid = tci & 0x0fff
+    return PacketMeta(
+        data,
+        addrconv.mac.bin_to_text(eth_src),
+        addrconv.mac.bin_to_text(eth_dst),
+        vid,
+        eth_type)
 
 
 def build_pkt_header(eth_src, eth_dst, vid, dl_type):
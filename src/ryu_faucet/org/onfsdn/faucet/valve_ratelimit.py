@@ -0,0 +1,167 @@
+"""Packet in admission control for Valve."""
+
+# Copyright (C) 2013 Nippon Telegraph and Telephone Corporation.
+# Copyright (C) 2015 Brad Cowie, Christopher Lorier and Joe Stringer.
+# Copyright (C) 2015 Research and Education Advanced Network New Zealand Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASISo
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+try:
+    from time import monotonic
+except ImportError:
+    try:
+        from monotonic import monotonic
+    except ImportError:
+        from time import time as monotonic
+
+
+class TokenBucket(object):
+    """Admit events at a sustained rate, allowing for a burst."""
+
+    def __init__(self, rate, burst, now):
+        """Create a full token bucket.
+
+        Args:
+            rate (float): tokens added per second.
+            burst (float): maximum tokens the bucket holds.
+            now (float): current monotonic time.
+        """
+        self.rate = float(rate)
+        self.burst = float(max(burst, 1))
+        self.tokens = self.burst
+        self.last_refill = now
+        self.admitted = 0
+        self.dropped = 0
+
+    def refill(self, now):
+        """Add the tokens accumulated since the last refill."""
+        elapsed = now - self.last_refill
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.last_refill = now
+
+    def has_token(self):
+        """Return True if the bucket can admit an event."""
+        return self.tokens >= 1
+
+    def take(self):
+        """Consume a token for an admitted event."""
+        self.tokens -= 1
+        self.admitted += 1
+
+
+class ValvePacketInRateLimiter(object):
+    """Limit packet ins admitted for learning, per port, VLAN and datapath.
+
+    Each of the port, VLAN and datapath may configure packet_in_rate
+    (packet ins per second) and packet_in_burst (defaults to one second's
+    worth of packet ins). A packet in is admitted only if every configured
+    bucket it passes through has a token, so one busy port cannot exhaust
+    the budget of its VLAN or datapath for the other ports.
+    """
+
+    def __init__(self, dp):
+        self.dp = dp
+        now = monotonic()
+        self.dp_bucket = self._new_bucket(
+            dp.packet_in_rate, dp.packet_in_burst, now)
+        self.vlan_buckets = {}
+        self.port_buckets = {}
+        # Consecutive drops per port, attributable to that port's own bucket.
+        self._port_over_limit = {}
+
+    @staticmethod
+    def _new_bucket(rate, burst, now):
+        if not rate:
+            return None
+        if burst is None:
+            burst = rate
+        return TokenBucket(rate, burst, now)
+
+    def _conf_bucket(self, buckets, key, conf, now):
+        if key not in buckets:
+            buckets[key] = self._new_bucket(
+                conf.packet_in_rate, conf.packet_in_burst, now)
+        return buckets[key]
+
+    def admit(self, port, vlan, now=None):
+        """Return True if a packet in may be processed for learning.
+
+        Args:
+            port (Port): port the packet in was received on.
+            vlan (VLAN): VLAN the packet in was received on.
+            now (float): current monotonic time.
+        Returns:
+            bool: True if admitted, False if it should be ignored.
+        """
+        if now is None:
+            now = monotonic()
+        port_bucket = self._conf_bucket(
+            self.port_buckets, port.number, port, now)
+        vlan_bucket = self._conf_bucket(
+            self.vlan_buckets, vlan.vid, vlan, now)
+        buckets = [
+            bucket for bucket in (port_bucket, vlan_bucket, self.dp_bucket)
+            if bucket is not None]
+        for bucket in buckets:
+            bucket.refill(now)
+            if not bucket.has_token():
+                bucket.dropped += 1
+                if bucket is port_bucket:
+                    self._port_over_limit[port.number] = (
+                        self._port_over_limit.get(port.number, 0) + 1)
+                return False
+        for bucket in buckets:
+            bucket.take()
+        self._port_over_limit[port.number] = 0
+        return True
+
+    def port_ban_due(self, port):
+        """Return True if a port has persistently exceeded its packet in rate.
+
+        A port is considered persistently over its limit, once it has had
+        another burst's worth of packet ins dropped with no packet in
+        admitted in between. The count is restarted once this returns True.
+
+        Args:
+            port (Port): port the packet in was received on.
+        Returns:
+            bool: True if packet ins from the port should be banned.
+        """
+        port_bucket = self.port_buckets.get(port.number, None)
+        if port_bucket is None:
+            return False
+        if self._port_over_limit.get(port.number, 0) < port_bucket.burst:
+            return False
+        self._port_over_limit[port.number] = 0
+        return True
+
+    def stats(self):
+        """Return packet in admitted/dropped counts.
+
+        Returns:
+            dict: (admitted, dropped) for the datapath, and per VLAN and port.
+        """
+        def bucket_stats(buckets):
+            return dict(
+                (key, (bucket.admitted, bucket.dropped))
+                for key, bucket in buckets.iteritems() if bucket is not None)
+
+        dp_stats = None
+        if self.dp_bucket is not None:
+            dp_stats = (self.dp_bucket.admitted, self.dp_bucket.dropped)
+        return {
+            'dp': dp_stats,
+            'vlans': bucket_stats(self.vlan_buckets),
+            'ports': bucket_stats(self.port_buckets),
+        }
@@ -0,0 +1,257 @@
+"""Longest prefix match routing table for Valve."""
+
+# Copyright (C) 2013 Nippon Telegraph and Telephone Corporation.
+# Copyright (C) 2015 Brad Cowie, Christopher Lorier and Joe Stringer.
+# Copyright (C) 2015 Research and Education Advanced Network New Zealand Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import MutableMapping
+
+import ipaddr
+
+
+class _TrieNode(object):
+    """A prefix in the trie, which is a route if it has a nexthop."""
+
+    __slots__ = ['bits', 'prefixlen', 'ip_dst', 'ip_gw', 'children']
+
+    def __init__(self, bits, prefixlen, ip_dst=None, ip_gw=None):
+        self.bits = bits
+        self.prefixlen = prefixlen
+        self.ip_dst = ip_dst
+        self.ip_gw = ip_gw
+        self.children = [None, None]
+
+
+class RIB(MutableMapping):
+    """Routes for one IP version, from destination network to nexthop.
+
+    Routes are kept in a path compressed binary trie, for longest prefix
+    match and to find the routes covering or covered by a network. They
+    are also indexed by destination, for exact lookups, and by nexthop.
+    """
+
+    def __init__(self, version, routes=None):
+        """Create a RIB.
+
+        Args:
+            version (int): IP version (4 or 6).
+            routes (dict): initial routes, nexthop by destination network.
+        """
+        if version == 6:
+            self.max_prefixlen = ipaddr.IPV6LENGTH
+        else:
+            self.max_prefixlen = ipaddr.IPV4LENGTH
+        self._root = _TrieNode(0, 0)
+        # Trie nodes that are routes, by destination.
+        self._nodes = {}
+        # Destinations routed via each nexthop (the reverse of the routes).
+        self.nexthops = {}
+        if routes:
+            self.update(routes)
+
+    def _bits(self, ip_dst):
+        """Return the network bits and prefix length of a network."""
+        return int(ip_dst.network), ip_dst.prefixlen
+
+    def _bit(self, bits, index):
+        """Return the bit at index (from the most significant) of bits."""
+        return (bits >> (self.max_prefixlen - 1 - index)) & 1
+
+    def _common_prefixlen(self, bits_a, bits_b, prefixlen):
+        """Return how many leading bits, up to prefixlen, are the same."""
+        diff = (bits_a ^ bits_b) >> (self.max_prefixlen - prefixlen)
+        return prefixlen - diff.bit_length()
+
+    def _mask(self, bits, prefixlen):
+        host_bits = self.max_prefixlen - prefixlen
+        return (bits >> host_bits) << host_bits
+
+    def _path(self, bits, prefixlen):
+        """Return the nodes from the root, that cover a prefix.
+
+        The last node is the prefix itself, if it is in the trie.
+        """
+        path = [self._root]
+        node = self._root
+        while node.prefixlen < prefixlen:
+            node = node.children[self._bit(bits, node.prefixlen)]
+            if (node is None or node.prefixlen > prefixlen or
+                    self._common_prefixlen(
+                        node.bits, bits, node.prefixlen) != node.prefixlen):
+                break
+            path.append(node)
+        return path
+
+    def __getitem__(self, ip_dst):
+        return self._nodes[ip_dst].ip_gw
+
+    def get(self, ip_dst, default=None):
+        node = self._nodes.get(ip_dst, None)
+        if node is None:
+            return default
+        return node.ip_gw
+
+    def __contains__(self, ip_dst):
+        return ip_dst in self._nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _route_nodes(self):
+        """Iterate over nodes that are routes, covering networks first."""
+        nodes = [self._root]
+        while nodes:
+            node = nodes.pop()
+            if node.ip_gw is not None:
+                yield node
+            for child in reversed(node.children):
+                if child is not None:
+                    nodes.append(child)
+
+    def __iter__(self):
+        for node in self._route_nodes():
+            yield node.ip_dst
+
+    def iteritems(self):
+        for node in self._route_nodes():
+            yield (node.ip_dst, node.ip_gw)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __setitem__(self, ip_dst, ip_gw):
+        node = self._nodes.get(ip_dst, None)
+        if node is not None:
+            self._unindex(node.ip_gw, node.ip_dst)
+            node.ip_gw = ip_gw
+            self.nexthops.setdefault(ip_gw, set()).add(node.ip_dst)
+            return
+        bits, prefixlen = self._bits(ip_dst)
+        parent = self._path(bits, prefixlen)[-1]
+        if parent.prefixlen == prefixlen:
+            node = parent
+        else:
+            node = _TrieNode(bits, prefixlen)
+            branch = self._bit(bits, parent.prefixlen)
+            child = parent.children[branch]
+            if child is not None:
+                common_prefixlen = self._common_prefixlen(
+                    child.bits, bits, min(child.prefixlen, prefixlen))
+                if common_prefixlen == prefixlen:
+                    # The new prefix covers the child.
+                    node.children[self._bit(child.bits, prefixlen)] = child
+                else:
+                    # Join the new prefix and the child, with a prefix
+                    # that covers both.
+                    join = _TrieNode(
+                        self._mask(bits, common_prefixlen), common_prefixlen)
+                    join.children[self._bit(
+                        child.bits, common_prefixlen)] = child
+                    join.children[self._bit(bits, common_prefixlen)] = node
+                    node = join
+            parent.children[branch] = node
+            if node.prefixlen != prefixlen:
+                node = node.children[self._bit(bits, node.prefixlen)]
+        node.ip_dst = ip_dst
+        node.ip_gw = ip_gw
+        self._nodes[ip_dst] = node
+        self.nexthops.setdefault(ip_gw, set()).add(ip_dst)
+
+    def __delitem__(self, ip_dst):
+        node = self._nodes.pop(ip_dst)
+        self._unindex(node.ip_gw, node.ip_dst)
+        bits, prefixlen = self._bits(ip_dst)
+        path = self._path(bits, prefixlen)
+        node.ip_dst = None
+        node.ip_gw = None
+        # Remove prefixes that are no longer needed to join others.
+        while node is not self._root and node.ip_gw is None:
+            parent = path[-2]
+            children = [child for child in node.children if child is not None]
+            if len(children) > 1:
+                break
+            branch = self._bit(node.bits, parent.prefixlen)
+            if children:
+                parent.children[branch] = children[0]
+                break
+            parent.children[branch] = None
+            path.pop()
+            node = parent
+
+    def _unindex(self, ip_gw, ip_dst):
+        ip_dsts = self.nexthops[ip_gw]
+        ip_dsts.discard(ip_dst)
+        if not ip_dsts:
+            del self.nexthops[ip_gw]
+
+    def longest_match(self, ip_addr):
+        """Return the most specific route to an IP address.
+
+        Args:
+            ip_addr (ipaddr.IPAddress): IP address.
+        Returns:
+            tuple: destination network and nexthop, or None if no route.
+        """
+        for node in reversed(self._path(int(ip_addr), self.max_prefixlen)):
+            if node.ip_gw is not None:
+                return (node.ip_dst, node.ip_gw)
+        return None
+
+    def covering_route(self, ip_dst):
+        """Return the most specific route covering (but not to) a network.
+
+        Args:
+            ip_dst (ipaddr.IPNetwork): destination network.
+        Returns:
+            tuple: destination network and nexthop, or None if no route.
+        """
+        bits, prefixlen = self._bits(ip_dst)
+        for node in reversed(self._path(bits, prefixlen)):
+            if node.prefixlen < prefixlen and node.ip_gw is not None:
+                return (node.ip_dst, node.ip_gw)
+        return None
+
+    def covered_routes(self, ip_dst):
+        """Return routes within a network, with no route between them.
+
+        These are the routes that would have ip_dst as their covering
+        route, were there a route to ip_dst.
+
+        Args:
+            ip_dst (ipaddr.IPNetwork): destination network.
+        Returns:
+            list: destination networks.
+        """
+        bits, prefixlen = self._bits(ip_dst)
+        node = self._path(bits, prefixlen)[-1]
+        if node.prefixlen != prefixlen:
+            # The network is not in the trie, but may cover a node in it.
+            node = node.children[self._bit(bits, node.prefixlen)]
+            if (node is None or node.prefixlen < prefixlen or
+                    self._common_prefixlen(
+                        node.bits, bits, prefixlen) != prefixlen):
+                return []
+            nodes = [node]
+        else:
+            nodes = [child for child in node.children if child is not None]
+        covered = []
+        while nodes:
+            node = nodes.pop()
+            if node.ip_gw is not None:
+                covered.append(node.ip_dst)
+            else:
+                nodes.extend(
+                    [child for child in node.children if child is not None])
+        return covered
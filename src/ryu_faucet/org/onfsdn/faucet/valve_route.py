@@ -16,6 +16,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import random
 import time
 
 import ipaddr
@@ -25,6 +26,7 @@ import valve_packet
 
 from ryu.lib.packet import arp, icmp, icmpv6, ipv4, ipv6
 from ryu.ofproto import ether
+from ryu.ofproto import ofproto_v1_3 as ofp
 from ryu.ofproto import inet
 
 
@@ -36,13 +38,111 @@ class LinkNeighbor(object):
         self.cache_time = now
 
 
+class NeighborResolveState(object):
+    """Describes resolution of a nexthop that is unresolved or stale."""
+
+    def __init__(self, now):
+        # Resolution attempts without a reply.
+        self.retries = 0
+        self.next_resolve_time = now
+        # Resolver packet data, by VID and controller IP.
+        self.resolver_pkts = {}
+
+
+class NextHopGroups(object):
+    """OpenFlow groups for resolved nexthops, by VID and nexthop IP.
+
+    Shared by a datapath's IPv4 and IPv6 route managers so group IDs are
+    unique, and kept across configuration reloads as are the groups
+    installed on the datapath.
+    """
+
+    # Above the group IDs used for flooding (see ValveFloodManager).
+    FIRST_GROUP_ID = 8192
+
+    def __init__(self):
+        # Group ID, and (eth_dst, port number) forwarded to, by (vid, ip_gw).
+        self.groups = {}
+        # Nexthop IPs with groups, by (vid, eth_dst).
+        self._nexthops_by_mac = {}
+        self._next_group_id = self.FIRST_GROUP_ID
+
+    def group_id(self, vid, ip_gw):
+        """Return the group ID for a nexthop, or None if there is no group."""
+        group = self.groups.get((vid, ip_gw), None)
+        if group is None:
+            return None
+        return group[0]
+
+    def nexthops_with_mac(self, vid, eth_dst):
+        """Return the nexthop IPs with groups forwarding to a MAC address."""
+        return list(self._nexthops_by_mac.get((vid, eth_dst), []))
+
+    def _index(self, vid, ip_gw, nexthop):
+        self._nexthops_by_mac.setdefault((vid, nexthop[0]), set()).add(ip_gw)
+
+    def _unindex(self, vid, ip_gw, nexthop):
+        mac_key = (vid, nexthop[0])
+        ip_gws = self._nexthops_by_mac[mac_key]
+        ip_gws.discard(ip_gw)
+        if not ip_gws:
+            del self._nexthops_by_mac[mac_key]
+
+    def update(self, vid, ip_gw, nexthop):
+        """Record where a nexthop's group forwards to, adding it if needed.
+
+        Args:
+            vid (int): VLAN VID.
+            ip_gw (ipaddr.IPAddress): IP address of nexthop.
+            nexthop (tuple): eth_dst and port number of nexthop.
+        Returns:
+            tuple: group ID, and nexthop previously forwarded to (None if
+                the group is new).
+        """
+        key = (vid, ip_gw)
+        if key in self.groups:
+            group_id, old_nexthop = self.groups[key]
+            self._unindex(vid, ip_gw, old_nexthop)
+        else:
+            group_id = self._next_group_id
+            self._next_group_id += 1
+            old_nexthop = None
+        self.groups[key] = (group_id, nexthop)
+        self._index(vid, ip_gw, nexthop)
+        return group_id, old_nexthop
+
+    def remove(self, vid, ip_gw):
+        """Forget a nexthop's group, returning its ID (None if no group)."""
+        group = self.groups.pop((vid, ip_gw), None)
+        if group is None:
+            return None
+        self._unindex(vid, ip_gw, group[1])
+        return group[0]
+
+    def remove_vlan(self, vid):
+        """Forget the groups of nexthops on a VLAN, returning their IDs."""
+        group_ids = []
+        for key in sorted(self.groups):
+            if key[0] == vid:
+                group_ids.append(self.remove(vid, key[1]))
+        return group_ids
+
+    def flush(self):
+        """Forget all groups, once deleted."""
+        self.groups = {}
+        self._nexthops_by_mac = {}
+        self._next_group_id = self.FIRST_GROUP_ID
+
+
 class ValveRouteManager(object):
     """Base class to implement RIB/FIB."""
 
     def __init__(self, logger, faucet_mac, arp_neighbor_timeout,
                  fib_table, eth_src_table, eth_dst_table, route_priority,
                  valve_in_match, valve_flowdel, valve_flowmod,
-                 valve_flowcontroller):
+                 valve_flowcontroller, nexthop_groups=None,
+                 fib_aggregation=False, max_resolve_backoff_time=32,
+                 max_hosts_per_resolve_cycle=32, dp_ports=None):
         self.logger = logger
         self.faucet_mac = faucet_mac
         self.arp_neighbor_timeout = arp_neighbor_timeout
@@ -54,6 +154,19 @@ class ValveRouteManager(object):
         self.valve_flowdel = valve_flowdel
         self.valve_flowmod = valve_flowmod
         self.valve_flowcontroller = valve_flowcontroller
+        # If not None, routes use a group per nexthop, so a nexthop
+        # changing needs only a group mod.
+        self.nexthop_groups = nexthop_groups
+        self.use_group_table = nexthop_groups is not None
+        # If True, routes with the same nexthop as their covering route
+        # are not added to the FIB.
+        self.fib_aggregation = fib_aggregation
+        self.max_resolve_backoff_time = max_resolve_backoff_time
+        self.max_hosts_per_resolve_cycle = max_hosts_per_resolve_cycle
+        # Ports nexthops are learned on, by number.
+        self.dp_ports = dp_ports
+        # Nexthops being resolved, by (vid, ip_gw).
+        self._resolve_state = {}
 
     def _vlan_vid(self, vlan, in_port):
         vid = None
@@ -68,65 +181,291 @@ class ValveRouteManager(object):
     def _vlan_routes(self, vlan):
         pass
 
+    def _vlan_nexthops(self, vlan):
+        pass
+
     def _vlan_neighbor_cache(self, vlan):
         pass
 
     def _neighbor_resolver_pkt(self, vid, controller_ip, ip_gw):
         pass
 
-    def _neighbor_resolver(self, ip_gw, controller_ip, vlan, ports):
+    def _neighbor_resolver(self, ip_gw, controller_ip, vlan, ports,
+                           resolve_state):
         ofmsgs = []
         if ports:
-            self.logger.info('Resolving %s', ip_gw)
             port_num = ports[0].number
             vid = self._vlan_vid(vlan, port_num)
-            resolver_pkt = self._neighbor_resolver_pkt(
-                vid, controller_ip, ip_gw)
+            key = (vid, controller_ip)
+            resolver_pkt_data = resolve_state.resolver_pkts.get(key, None)
+            if resolver_pkt_data is None:
+                resolver_pkt_data = self._neighbor_resolver_pkt(
+                    vid, controller_ip, ip_gw).data
+                resolve_state.resolver_pkts[key] = resolver_pkt_data
             for port in ports:
                 ofmsgs.append(valve_of.packetout(
-                    port.number, resolver_pkt.data))
+                    port.number, resolver_pkt_data))
+        return ofmsgs
+
+    def _nexthop_actions(self, eth_dst):
+        """Return actions to forward a routed packet to a nexthop."""
+        return [
+            valve_of.set_eth_src(self.faucet_mac),
+            valve_of.set_eth_dst(eth_dst),
+            valve_of.dec_ip_ttl()]
+
+    def _route_instructions(self, vlan, ip_gw, eth_dst):
+        """Return instructions for a FIB flow for a route via a nexthop."""
+        if self.use_group_table:
+            group_id = self.nexthop_groups.group_id(vlan.vid, ip_gw)
+            return [valve_of.apply_actions([valve_of.group_act(group_id)])]
+        return [
+            valve_of.apply_actions(self._nexthop_actions(eth_dst)),
+            valve_of.goto_table(self.eth_dst_table)]
+
+    def _nexthop_group_buckets(self, vlan, eth_dst, port_num):
+        """Return the bucket of a group forwarding to a nexthop on a port.
+
+        Packets are output as the eth_dst table flow for the nexthop's
+        MAC address would (see ValveHostManager.host_learn_flows()).
+        """
+        port = self.dp_ports[port_num]
+        actions = self._nexthop_actions(eth_dst)
+        actions.extend(valve_of.output_host_actions(
+            port_num, valve_of.output_pops_vlan(vlan, port), port.mirror))
+        return [valve_of.bucket(actions)]
+
+    def _update_nexthop_group(self, vlan, ip_gw, eth_dst, port_num):
+        """Return a group mod if a nexthop's group needs adding or changing.
+
+        The group is an indirect group that forwards to the nexthop,
+        on the port its MAC address was learned on.
+        """
+        nexthop = (eth_dst, port_num)
+        group_id, old_nexthop = self.nexthop_groups.update(
+            vlan.vid, ip_gw, nexthop)
+        if old_nexthop == nexthop:
+            return []
+        buckets = self._nexthop_group_buckets(vlan, eth_dst, port_num)
+        command = ofp.OFPGC_MODIFY
+        if old_nexthop is None:
+            command = ofp.OFPGC_ADD
+        return [valve_of.groupmod(
+            group_id, buckets, command, ofp.OFPGT_INDIRECT)]
+
+    def nexthop_host_learned(self, vlan, eth_src, port_num):
+        """Return group mods to forward to nexthops via where a host moved.
+
+        Nexthop groups output directly to a port, so when a nexthop's MAC
+        address is learned on another port, its groups must change too.
+
+        Args:
+            vlan (vlan): VLAN host was learned on.
+            eth_src (str): MAC address of host.
+            port_num (int): port host was learned on.
+        Returns:
+            list: OpenFlow messages.
+        """
+        if not self.use_group_table:
+            return []
+        ofmsgs = []
+        neighbor_cache = self._vlan_neighbor_cache(vlan)
+        for ip_gw in self.nexthop_groups.nexthops_with_mac(vlan.vid, eth_src):
+            # Groups are shared with the other IP version's route manager.
+            if ip_gw in neighbor_cache:
+                ofmsgs.extend(self._update_nexthop_group(
+                    vlan, ip_gw, eth_src, port_num))
+        return ofmsgs
+
+    def _del_nexthop_group(self, vlan, ip_gw):
+        """Return a group mod to delete a nexthop's group, once unused.
+
+        The nexthop is also forgotten, so it is resolved again (and its
+        group added) if used by a new route.
+        """
+        self._vlan_neighbor_cache(vlan).pop(ip_gw, None)
+        group_id = self.nexthop_groups.remove(vlan.vid, ip_gw)
+        if group_id is None:
+            return []
+        return [valve_of.groupdel(group_id)]
+
+    def _route_match(self, vlan, ip_dst):
+        return self.valve_in_match(
+            self.fib_table, vlan=vlan,
+            eth_type=self._eth_type(), nw_dst=ip_dst)
+
+    def _route_priority(self, ip_dst):
+        """Return FIB priority for a route, so longer prefixes match first."""
+        return self.route_priority + ipaddr.IPNetwork(ip_dst).prefixlen
+
+    def _del_route_flow(self, vlan, ip_dst):
+        """Return flow delete for a route's FIB flow.
+
+        Only the route's own flow is deleted, not those of more specific
+        routes which a non strict delete would also match.
+        """
+        return [
+            self.valve_flowmod(
+                self.fib_table,
+                self._route_match(vlan, ip_dst),
+                priority=self._route_priority(ip_dst),
+                command=ofp.OFPFC_DELETE_STRICT,
+                out_port=ofp.OFPP_ANY,
+                out_group=ofp.OFPG_ANY),
+            valve_of.barrier()]
+
+    def _route_aggregated(self, routes, ip_dst, ip_gw):
+        """Return True if a route is left out of the FIB by aggregation.
+
+        A route with the same nexthop as the route covering it needs no
+        flow, as the covering route's flow forwards its packets the same.
+        """
+        if not self.fib_aggregation:
+            return False
+        covering_route = routes.covering_route(ip_dst)
+        return covering_route is not None and covering_route[1] == ip_gw
+
+    def _fib_nexthop(self, vlan, routes, ip_dst):
+        """Return the nexthop a route's FIB flow forwards to.
+
+        Returns:
+            tuple: nexthop IP and MAC, or None if the route needs no flow.
+        """
+        ip_gw = routes.get(ip_dst, None)
+        if ip_gw is None:
+            return None
+        neighbor_cache = self._vlan_neighbor_cache(vlan)
+        if ip_gw not in neighbor_cache:
+            return None
+        if self._route_aggregated(routes, ip_dst, ip_gw):
+            return None
+        return (ip_gw, neighbor_cache[ip_gw].eth_src)
+
+    def _fib_nexthops(self, vlan, routes, ip_dst):
+        """Return FIB nexthops of routes that may change with one route.
+
+        With aggregation, these include the routes it covers directly.
+
+        Returns:
+            list: (ip_dst, FIB nexthop) for each route.
+        """
+        ip_dsts = [ip_dst]
+        if self.fib_aggregation:
+            ip_dsts.extend(routes.covered_routes(ip_dst))
+        return [
+            (changed_ip_dst, self._fib_nexthop(vlan, routes, changed_ip_dst))
+            for changed_ip_dst in ip_dsts]
+
+    def _update_fib(self, vlan, routes, old_fib_nexthops):
+        """Return flow changes for routes whose FIB nexthop has changed.
+
+        Args:
+            vlan (vlan): VLAN containing this RIB/FIB.
+            routes (valve_rib.RIB): RIB, once changed.
+            old_fib_nexthops (list): (ip_dst, FIB nexthop) before the change.
+        Returns:
+            list: OpenFlow messages.
+        """
+        ofmsgs = []
+        for ip_dst, old_fib_nexthop in old_fib_nexthops:
+            fib_nexthop = self._fib_nexthop(vlan, routes, ip_dst)
+            if fib_nexthop == old_fib_nexthop:
+                continue
+            if fib_nexthop is None:
+                ofmsgs.extend(self._del_route_flow(vlan, ip_dst))
+            else:
+                ip_gw, eth_dst = fib_nexthop
+                ofmsgs.extend(self._add_resolved_route(
+                    vlan, ip_gw, ip_dst, eth_dst, is_updated=False))
+        return ofmsgs
+
+    def fib_flows_saved(self, vlan):
+        """Return how many resolved routes are left out of the FIB.
+
+        Args:
+            vlan (vlan): VLAN containing this RIB/FIB.
+        Returns:
+            int: number of FIB flows saved by aggregation.
+        """
+        if not self.fib_aggregation:
+            return 0
+        routes = self._vlan_routes(vlan)
+        flows_saved = 0
+        for ip_gw in self._vlan_neighbor_cache(vlan):
+            for ip_dst in routes.nexthops.get(ip_gw, ()):
+                if self._route_aggregated(routes, ip_dst, ip_gw):
+                    flows_saved += 1
+        return flows_saved
+
+    def _route_flow(self, vlan, ip_gw, ip_dst, eth_dst):
+        """Return the FIB flow for a route via a resolved nexthop."""
+        return self.valve_flowmod(
+            self.fib_table,
+            self._route_match(vlan, ip_dst),
+            priority=self._route_priority(ip_dst),
+            inst=self._route_instructions(vlan, ip_gw, eth_dst))
+
+    def resolved_route_flows(self, vlan):
+        """Return messages to add the FIB of routes via resolved nexthops.
+
+        Used when reconciling flows on connect, so routed forwarding
+        continues while nexthops are still in the neighbor cache. All
+        groups are replaced then, so nexthop groups are added too.
+
+        Args:
+            vlan (vlan): VLAN containing this RIB/FIB.
+        Returns:
+            list: OpenFlow messages.
+        """
+        ofmsgs = []
+        routes = self._vlan_routes(vlan)
+        neighbor_cache = self._vlan_neighbor_cache(vlan)
+        for ip_gw in sorted(neighbor_cache.keys()):
+            ip_dsts = routes.nexthops.get(ip_gw, ())
+            eth_dst = neighbor_cache[ip_gw].eth_src
+            if self.use_group_table:
+                group = self.nexthop_groups.groups.get((vlan.vid, ip_gw), None)
+                if group is None or group[1][1] not in self.dp_ports:
+                    # Resolve the nexthop again, to add its group.
+                    del neighbor_cache[ip_gw]
+                    continue
+                group_id, (_, port_num) = group
+                ofmsgs.append(valve_of.groupadd(
+                    group_id,
+                    self._nexthop_group_buckets(vlan, eth_dst, port_num),
+                    ofp.OFPGT_INDIRECT))
+            for ip_dst in sorted(ip_dsts):
+                if self._route_aggregated(routes, ip_dst, ip_gw):
+                    continue
+                ofmsgs.append(self._route_flow(vlan, ip_gw, ip_dst, eth_dst))
         return ofmsgs
 
     def _add_resolved_route(self, vlan, ip_gw, ip_dst, eth_dst, is_updated=None):
         ofmsgs = []
         if is_updated is not None:
-            in_match = self.valve_in_match(
-                self.fib_table, vlan=vlan,
-                eth_type=self._eth_type(), nw_dst=ip_dst)
-            prefixlen = ipaddr.IPNetwork(ip_dst).prefixlen
-            priority = self.route_priority + prefixlen
             if is_updated:
                 self.logger.info(
                     'Updating next hop for route %s via %s (%s)',
                     ip_dst, ip_gw, eth_dst)
-                ofmsgs.extend(self.valve_flowdel(
-                    self.fib_table,
-                    in_match,
-                    priority=priority))
+                ofmsgs.extend(self._del_route_flow(vlan, ip_dst))
             else:
                 self.logger.info(
                     'Adding new route %s via %s (%s)',
                     ip_dst, ip_gw, eth_dst)
 
-            ofmsgs.append(self.valve_flowmod(
-                self.fib_table,
-                in_match,
-                priority=priority,
-                inst=[valve_of.apply_actions(
-                    [valve_of.set_eth_src(self.faucet_mac),
-                     valve_of.set_eth_dst(eth_dst),
-                     valve_of.dec_ip_ttl()])] +
-                [valve_of.goto_table(self.eth_dst_table)]))
+            ofmsgs.append(self._route_flow(vlan, ip_gw, ip_dst, eth_dst))
         now = time.time()
         link_neighbor = LinkNeighbor(eth_dst, now)
         neighbor_cache = self._vlan_neighbor_cache(vlan)
         neighbor_cache[ip_gw] = link_neighbor
         return ofmsgs
 
-    def _update_nexthop(self, vlan, eth_src, resolved_ip_gw):
+    def _update_nexthop(self, vlan, in_port, eth_src, resolved_ip_gw):
         ofmsgs = []
         is_updated = None
-        routes = self._vlan_routes(vlan)
+        ip_dsts = self._vlan_nexthops(vlan).get(resolved_ip_gw, None)
+        if not ip_dsts:
+            return ofmsgs
         neighbor_cache = self._vlan_neighbor_cache(vlan)
         if resolved_ip_gw in neighbor_cache:
             cached_eth_dst = neighbor_cache[resolved_ip_gw].eth_src
@@ -134,14 +473,79 @@ class ValveRouteManager(object):
                 is_updated = True
         else:
             is_updated = False
-        for ip_dst, ip_gw in routes.iteritems():
-            if ip_gw == resolved_ip_gw:
-                ofmsgs.extend(self._add_resolved_route(
-                    vlan, ip_gw, ip_dst, eth_src, is_updated))
+        if self.use_group_table:
+            ofmsgs.extend(self._update_nexthop_group(
+                vlan, resolved_ip_gw, eth_src, in_port))
+            if is_updated:
+                self.logger.info(
+                    'Updating next hop %s (%s)', resolved_ip_gw, eth_src)
+                # Routes use the nexthop's group, so need not change.
+                is_updated = None
+        neighbor_cache[resolved_ip_gw] = LinkNeighbor(eth_src, time.time())
+        self._resolve_state.pop((vlan.vid, resolved_ip_gw), None)
+        if is_updated is None:
+            # Only refresh the nexthop, as no routes need to change.
+            return ofmsgs
+        routes = self._vlan_routes(vlan)
+        for ip_dst in ip_dsts:
+            if self._route_aggregated(routes, ip_dst, resolved_ip_gw):
+                continue
+            ofmsgs.extend(self._add_resolved_route(
+                vlan, resolved_ip_gw, ip_dst, eth_src, is_updated))
         return ofmsgs
 
+    def _resolve_backoff(self, retries):
+        """Return seconds to wait before resolving a nexthop again.
+
+        The wait doubles with each attempt without a reply, up to
+        max_resolve_backoff_time, and is jittered so that nexthops
+        that fail together are not retried together.
+        """
+        backoff = min(2 ** retries, self.max_resolve_backoff_time)
+        return random.uniform(backoff / 2.0, backoff)
+
+    def _nexthops_to_resolve(self, vlan, now):
+        """Return nexthops due to be resolved, most overdue first.
+
+        Args:
+            vlan (vlan): VLAN containing this RIB/FIB.
+            now (float): seconds since epoch.
+        Returns:
+            list: tuples of nexthop IP and controller IP in its subnet.
+        """
+        due = []
+        nexthops = self._vlan_nexthops(vlan)
+        neighbor_cache = self._vlan_neighbor_cache(vlan)
+        for ip_gw in nexthops:
+            key = (vlan.vid, ip_gw)
+            if ip_gw in neighbor_cache:
+                cache_age = now - neighbor_cache[ip_gw].cache_time
+                if cache_age <= self.arp_neighbor_timeout:
+                    self._resolve_state.pop(key, None)
+                    continue
+            for controller_ip in vlan.controller_ips:
+                if ip_gw in controller_ip:
+                    if key not in self._resolve_state:
+                        self._resolve_state[key] = NeighborResolveState(now)
+                    resolve_state = self._resolve_state[key]
+                    if resolve_state.next_resolve_time <= now:
+                        due.append(
+                            (resolve_state.next_resolve_time,
+                             ip_gw, controller_ip))
+                    break
+        # Forget nexthops no longer used by routes.
+        for key in self._resolve_state.keys():
+            if key[0] == vlan.vid and key[1] not in nexthops:
+                del self._resolve_state[key]
+        due.sort()
+        return [(ip_gw, controller_ip) for _, ip_gw, controller_ip in due]
+
     def resolve_gateways(self, vlan, now):
-        """Re/resolve all gateways.
+        """Re/resolve gateways that are unresolved or stale.
+
+        Gateways not replying are retried with exponential backoff, and
+        up to max_hosts_per_resolve_cycle are resolved per call (the rest
+        on later calls), to spread resolution over time.
 
         Args:
             vlan (vlan): VLAN containing this RIB/FIB.
@@ -152,20 +556,23 @@ class ValveRouteManager(object):
         ofmsgs = []
         untagged_ports = vlan.untagged_flood_ports(False)
         tagged_ports = vlan.tagged_flood_ports(False)
-        routes = self._vlan_routes(vlan)
-        neighbor_cache = self._vlan_neighbor_cache(vlan)
-        for ip_gw in set(routes.values()):
-            for controller_ip in vlan.controller_ips:
-                if ip_gw in controller_ip:
-                    cache_age = None
-                    if ip_gw in neighbor_cache:
-                        cache_time = neighbor_cache[ip_gw].cache_time
-                        cache_age = now - cache_time
-                    if (cache_age is None or
-                            cache_age > self.arp_neighbor_timeout):
-                        for ports in untagged_ports, tagged_ports:
-                            ofmsgs.extend(self._neighbor_resolver(
-                                ip_gw, controller_ip, vlan, ports))
+        nexthops_to_resolve = self._nexthops_to_resolve(vlan, now)
+        if self.max_hosts_per_resolve_cycle:
+            nexthops_to_resolve = nexthops_to_resolve[
+                :self.max_hosts_per_resolve_cycle]
+        for ip_gw, controller_ip in nexthops_to_resolve:
+            resolve_state = self._resolve_state[(vlan.vid, ip_gw)]
+            if resolve_state.retries:
+                self.logger.info(
+                    'Resolving %s (retry %u)', ip_gw, resolve_state.retries)
+            else:
+                self.logger.info('Resolving %s', ip_gw)
+            for ports in untagged_ports, tagged_ports:
+                ofmsgs.extend(self._neighbor_resolver(
+                    ip_gw, controller_ip, vlan, ports, resolve_state))
+            resolve_state.retries += 1
+            resolve_state.next_resolve_time = now + self._resolve_backoff(
+                resolve_state.retries)
         return ofmsgs
 
     def add_route(self, vlan, ip_gw, ip_dst):
@@ -178,19 +585,10 @@ class ValveRouteManager(object):
         Returns:
             list: OpenFlow messages.
         """
-        ofmsgs = []
         routes = self._vlan_routes(vlan)
-        neighbor_cache = self._vlan_neighbor_cache(vlan)
-        routes[ip_dst] = ip_gw
-        if ip_gw in neighbor_cache:
-            eth_dst = neighbor_cache[ip_gw].eth_src
-            ofmsgs.extend(self._add_resolved_route(
-                vlan=vlan,
-                ip_gw=ip_gw,
-                ip_dst=ip_dst,
-                eth_dst=eth_dst,
-                is_updated=False))
-        return ofmsgs
+        old_fib_nexthops = self._fib_nexthops(vlan, routes, ip_dst)
+        vlan.add_route(ip_gw, ip_dst)
+        return self._update_fib(vlan, routes, old_fib_nexthops)
 
     def _add_host_fib_route(self, vlan, host_ip):
         """Add a host FIB route.
@@ -210,7 +608,7 @@ class ValveRouteManager(object):
 
         Args:
             vlan (vlan): VLAN containing this RIB.
-            pkt: ryu.lib.packet from host.
+            pkt (valve_packet.PacketMeta): packet from host.
         Returns:
             list: OpenFlow messages.
         """
@@ -227,15 +625,14 @@ class ValveRouteManager(object):
         Returns:
             list: OpenFlow messages.
         """
-        ofmsgs = []
         routes = self._vlan_routes(vlan)
-        if ip_dst in routes:
-            del routes[ip_dst]
-            route_match = self.valve_in_match(
-                self.fib_table, vlan=vlan,
-                eth_type=self._eth_type(), nw_dst=ip_dst)
-            ofmsgs.extend(self.valve_flowdel(
-                self.fib_table, route_match))
+        if ip_dst not in routes:
+            return []
+        old_fib_nexthops = self._fib_nexthops(vlan, routes, ip_dst)
+        ip_gw = vlan.del_route(ip_dst)
+        ofmsgs = self._update_fib(vlan, routes, old_fib_nexthops)
+        if self.use_group_table and ip_gw not in self._vlan_nexthops(vlan):
+            ofmsgs.extend(self._del_nexthop_group(vlan, ip_gw))
         return ofmsgs
 
     def control_plane_handler(self, in_port, vlan, eth_src, eth_dst, pkt):
@@ -251,6 +648,9 @@ class ValveIPv4RouteManager(ValveRouteManager):
     def _vlan_routes(self, vlan):
         return vlan.ipv4_routes
 
+    def _vlan_nexthops(self, vlan):
+        return vlan.ipv4_nexthops
+
     def _vlan_neighbor_cache(self, vlan):
         return vlan.arp_cache
 
@@ -321,7 +721,7 @@ class ValveIPv4RouteManager(ValveRouteManager):
               vlan.ip_in_controller_subnet(src_ip) and
               vlan.ip_in_controller_subnet(dst_ip)):
             self.logger.info('ARP response %s for %s', eth_src, src_ip)
-            ofmsgs.extend(self._update_nexthop(vlan, eth_src, src_ip))
+            ofmsgs.extend(self._update_nexthop(vlan, in_port, eth_src, src_ip))
         return ofmsgs
 
     def control_plane_icmp_handler(self, in_port, vlan, eth_src,
@@ -363,6 +763,9 @@ class ValveIPv6RouteManager(ValveRouteManager):
     def _vlan_routes(self, vlan):
         return vlan.ipv6_routes
 
+    def _vlan_nexthops(self, vlan):
+        return vlan.ipv6_nexthops
+
     def _vlan_neighbor_cache(self, vlan):
         return vlan.nd_cache
 
@@ -442,7 +845,8 @@ class ValveIPv6RouteManager(ValveRouteManager):
               vlan.ip_in_controller_subnet(src_ip)):
             resolved_ip_gw = ipaddr.IPv6Address(icmpv6_pkt.data.dst)
             self.logger.info('ND response %s for %s', eth_src, resolved_ip_gw)
-            ofmsgs.extend(self._update_nexthop(vlan, eth_src, resolved_ip_gw))
+            ofmsgs.extend(self._update_nexthop(
+                vlan, in_port, eth_src, resolved_ip_gw))
         elif icmpv6_type == icmpv6.ICMPV6_ECHO_REQUEST:
             icmpv6_echo_reply = valve_packet.icmpv6_echo_reply(
                 self.faucet_mac, eth_src, vid,
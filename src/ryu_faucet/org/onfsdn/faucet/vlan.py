@@ -16,6 +16,7 @@
 import ipaddr
 
 from conf import Conf
+from valve_rib import RIB
 
 class VLAN(Conf):
 
@@ -32,6 +33,8 @@ class VLAN(Conf):
     bgp_neighbour_as = None
     routes = None
     max_hosts = None
+    packet_in_rate = None
+    packet_in_burst = None
     unicast_flood = None
     acl_in = None
     # Define dynamic variables with prefix dyn_ to distinguish from variables set
@@ -57,6 +60,10 @@ class VLAN(Conf):
         'bgp_neighbor_as': None,
         'routes': None,
         'max_hosts': None,
+        # Packet ins per second admitted for learning (0 is unlimited).
+        'packet_in_rate': 0,
+        # Packet ins that may be admitted in a burst (default packet_in_rate).
+        'packet_in_burst': None,
         }
 
 
@@ -70,8 +77,8 @@ class VLAN(Conf):
         self._id = _id
         self.tagged = []
         self.untagged = []
-        self.dyn_ipv4_routes = {}
-        self.dyn_ipv6_routes = {}
+        self.dyn_ipv4_routes = RIB(4)
+        self.dyn_ipv6_routes = RIB(6)
         self.dyn_arp_cache = {}
         self.dyn_nd_cache = {}
         self.dyn_host_cache = {}
@@ -93,10 +100,7 @@ class VLAN(Conf):
                 ip_gw = ipaddr.IPAddress(route['ip_gw'])
                 ip_dst = ipaddr.IPNetwork(route['ip_dst'])
                 assert ip_gw.version == ip_dst.version
-                if ip_gw.version == 4:
-                    self.ipv4_routes[ip_dst] = ip_gw
-                else:
-                    self.ipv6_routes[ip_dst] = ip_gw
+                self.add_route(ip_gw, ip_dst)
 
     @property
     def ipv4_routes(self):
@@ -104,6 +108,8 @@ class VLAN(Conf):
 
     @ipv4_routes.setter
     def ipv4_routes(self, value):
+        if not isinstance(value, RIB):
+            value = RIB(4, value)
         self.dyn_ipv4_routes = value
 
     @property
@@ -112,8 +118,47 @@ class VLAN(Conf):
 
     @ipv6_routes.setter
     def ipv6_routes(self, value):
+        if not isinstance(value, RIB):
+            value = RIB(6, value)
         self.dyn_ipv6_routes = value
 
+    @property
+    def ipv4_nexthops(self):
+        return self.dyn_ipv4_routes.nexthops
+
+    @property
+    def ipv6_nexthops(self):
+        return self.dyn_ipv6_routes.nexthops
+
+    def _routes(self, ip_dst):
+        if ip_dst.version == 4:
+            return self.dyn_ipv4_routes
+        return self.dyn_ipv6_routes
+
+    def add_route(self, ip_gw, ip_dst):
+        """Add a route, replacing any route to the same destination.
+
+        Args:
+            ip_gw (ipaddr.IPAddress): IP address of nexthop.
+            ip_dst (ipaddr.IPNetwork): destination IP network.
+        Returns:
+            ipaddr.IPAddress: nexthop of the route replaced, or None.
+        """
+        routes = self._routes(ip_dst)
+        old_ip_gw = routes.get(ip_dst, None)
+        routes[ip_dst] = ip_gw
+        return old_ip_gw
+
+    def del_route(self, ip_dst):
+        """Delete the route to a destination.
+
+        Args:
+            ip_dst (ipaddr.IPNetwork): destination IP network.
+        Returns:
+            ipaddr.IPAddress: nexthop of the route deleted, or None.
+        """
+        return self._routes(ip_dst).pop(ip_dst, None)
+
     @property
     def arp_cache(self):
         return self.dyn_arp_cache
@@ -165,7 +210,7 @@ class VLAN(Conf):
     def flood_ports(self, configured_ports, exclude_unicast):
         ports = []
         for port in configured_ports:
-            if not port.running:
+            if not port.running():
                 continue
             if exclude_unicast:
                 if not port.unicast_flood:
@@ -197,12 +242,5 @@ class VLAN(Conf):
                 return True
         return False
 
-    def __hash__(self):
-        items = [(k,v) for k,v in self.__dict__.iteritems() if 'dyn' not in k]
-        return hash(frozenset(map(str, items)))
-
-    def __eq__(self, other):
-        return hash(self) == hash(other)
-
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    def conf_ref(self):
+        return ('VLAN', self.vid)
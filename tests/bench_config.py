@@ -0,0 +1,271 @@
+#!/usr/bin/python
+
+"""Benchmarks for loading and reloading FAUCET configuration.
+
+Run ./bench_config.py [benchmark ...] from the tests directory.
+"""
+
+# Copyright (C) 2015 Brad Cowie, Christopher Lorier and Joe Stringer.
+# Copyright (C) 2015 Research and Innovation Advanced Network New Zealand Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import glob
+import hashlib
+import os
+
+import yaml
+
+from bench_util import benchmark, main, report, timed, write_file
+
+from faucet import config_parser
+from faucet.config_parser import dp_parser
+from faucet.dp import DP
+
+VLAN_FILES = 40
+VLANS_PER_FILE = 100
+DP_FILES = 20
+DPS_PER_FILE = 10
+PORTS_PER_DP = 24
+
+
+def write_many_dps_config(config_dir):
+    """Write a config of 200 DPs and 4000 VLANs over 61 included files.
+
+    Returns:
+        str: path of the top level config file.
+    """
+    includes = []
+    for vlan_file in range(VLAN_FILES):
+        lines = ['vlans:']
+        first_vid = vlan_file * VLANS_PER_FILE + 1
+        for vid in range(first_vid, first_vid + VLANS_PER_FILE):
+            lines.extend([
+                '    %u:' % vid,
+                '        description: "vlan %u"' % vid,
+                '        max_hosts: 100'])
+        file_name = 'vlans%u.yaml' % vlan_file
+        write_file(config_dir, file_name, '\n'.join(lines) + '\n')
+        includes.append(file_name)
+    for dp_file in range(DP_FILES):
+        lines = ['dps:']
+        first_dp = dp_file * DPS_PER_FILE
+        for dp_num in range(first_dp, first_dp + DPS_PER_FILE):
+            lines.extend([
+                '    sw%u:' % dp_num,
+                '        dp_id: %u' % (dp_num + 1),
+                '        interfaces:'])
+            first_vid = dp_num * 20 + 1
+            for port in range(1, PORTS_PER_DP + 1):
+                native_vid = first_vid + port % 20
+                tagged_vid = first_vid
+                if tagged_vid == native_vid:
+                    tagged_vid += 1
+                lines.extend([
+                    '            %u:' % port,
+                    '                native_vlan: %u' % native_vid,
+                    '                tagged_vlans: [%u]' % tagged_vid,
+                    '                acl_in: acl1'])
+        file_name = 'dps%u.yaml' % dp_file
+        write_file(config_dir, file_name, '\n'.join(lines) + '\n')
+        includes.append(file_name)
+    write_file(config_dir, 'acls.yaml', '\n'.join([
+        'acls:',
+        '    acl1:',
+        '        - rule:',
+        '            dl_type: 0x800',
+        '            actions:',
+        '                allow: 1']) + '\n')
+    includes.append('acls.yaml')
+    return write_file(
+        config_dir, 'faucet.yaml',
+        'include:\n' + ''.join(['    - %s\n' % name for name in includes]))
+
+
+def clear_config_caches():
+    """Forget config files parsed before, as if FAUCET had just started."""
+    config_parser._config_file_cache.clear()
+    config_parser._config_file_stats.clear()
+    config_parser._config_file_contents.clear()
+
+
+@benchmark
+def many_dps(config_dir):
+    """Parse, then reload unchanged and with one DP file changed."""
+    config_file = write_many_dps_config(config_dir)
+    clear_config_caches()
+    (_, dps), parse_time = timed(dp_parser, config_file, 'bench')
+    vlans = sum([len(dp.vlans) for dp in dps])
+    report(
+        'cold parse (%u DPs, %u VLANs)' % (len(dps), vlans),
+        '%.2fs' % parse_time)
+    (_, reloaded_dps), reload_time = timed(
+        dp_parser, config_file, 'bench', dps)
+    report('reload, unchanged', '%.2fs' % reload_time)
+    with open(os.path.join(config_dir, 'dps3.yaml'), 'a') as dps_file:
+        dps_file.write(
+            '            25:\n'
+            '                native_vlan: 700\n')
+    (_, changed_dps), reload_time = timed(
+        dp_parser, config_file, 'bench', reloaded_dps)
+    reused_dps = set([id(dp) for dp in reloaded_dps])
+    rebuilt_dps = [dp for dp in changed_dps if id(dp) not in reused_dps]
+    report('reload, one DP file changed', '%.2fs (DPs rebuilt: %u)' % (
+        reload_time, len(rebuilt_dps)))
+
+
+@benchmark
+def yaml_load(config_dir):
+    """Cold parse with each YAML loader, and from a compiled cache."""
+    config_file = write_many_dps_config(config_dir)
+    config_files = glob.glob(os.path.join(config_dir, '*.yaml'))
+    loaders = [('SafeLoader', yaml.SafeLoader, '')]
+    if hasattr(yaml, 'CSafeLoader'):
+        loaders.append(('CSafeLoader', yaml.CSafeLoader, ''))
+    loaders.append(('compiled cache', config_parser._YAML_LOADER, '1'))
+    yaml_loader = config_parser._YAML_LOADER
+    compiled_cache = os.environ.get('FAUCET_CONFIG_CACHE', None)
+    try:
+        for label, loader, cache in loaders:
+            config_parser._YAML_LOADER = loader
+            os.environ['FAUCET_CONFIG_CACHE'] = cache
+            if cache:
+                # Write the compiled cache, as a previous start would have.
+                clear_config_caches()
+                for file_name in config_files:
+                    config_parser.read_config(file_name, 'bench')
+            clear_config_caches()
+            _, load_time = timed(lambda: [
+                config_parser.read_config(file_name, 'bench')
+                for file_name in config_files])
+            clear_config_caches()
+            _, parse_time = timed(dp_parser, config_file, 'bench')
+            report(
+                '%u files, %s' % (len(config_files), label),
+                'load %.3fs, dp_parser %.2fs' % (load_time, parse_time))
+    finally:
+        config_parser._YAML_LOADER = yaml_loader
+        if compiled_cache is None:
+            del os.environ['FAUCET_CONFIG_CACHE']
+        else:
+            os.environ['FAUCET_CONFIG_CACHE'] = compiled_cache
+
+
+def read_config_file_hash(config_file_name):
+    """Return the SHA256 hash of a config file, always reading it."""
+    with open(config_file_name, 'r') as config_file:
+        return hashlib.sha256(config_file.read()).hexdigest()
+
+
+@benchmark
+def config_changed(config_dir):
+    """Check whether any of the config files have changed."""
+    write_many_dps_config(config_dir)
+    config_files = glob.glob(os.path.join(config_dir, '*.yaml'))
+    checks = 100
+    for label, file_hash in (
+            ('reading and hashing', read_config_file_hash),
+            ('config_file_hash', config_parser.config_file_hash)):
+        for file_name in config_files:
+            file_hash(file_name)
+        _, check_time = timed(lambda: [
+            file_hash(file_name)
+            for _ in range(checks) for file_name in config_files])
+        report(
+            '%u unchanged files, %s' % (len(config_files), label),
+            '%.2fms per check' % (check_time / checks * 1e3))
+
+
+STACKED_DPS = 500
+
+
+def write_stacked_dps_config(config_dir):
+    """Write a config of stacked DPs, a binary tree plus sibling links.
+
+    Returns:
+        str: path of the config file.
+    """
+    stack_ports = dict([(dp_num, []) for dp_num in range(STACKED_DPS)])
+
+    def link(dp_a, dp_b):
+        port_a = len(stack_ports[dp_a]) + 5
+        port_b = len(stack_ports[dp_b]) + 5
+        stack_ports[dp_a].append((port_a, dp_b, port_b))
+        stack_ports[dp_b].append((port_b, dp_a, port_a))
+
+    for dp_num in range(1, STACKED_DPS):
+        link(dp_num, (dp_num - 1) // 2)
+        if dp_num % 2 == 0:
+            link(dp_num, dp_num - 1)
+    lines = ['vlans:', '    100:', '        description: "v100"', 'dps:']
+    for dp_num in range(STACKED_DPS):
+        lines.extend([
+            '    sw%u:' % dp_num,
+            '        dp_id: %u' % (dp_num + 1)])
+        if dp_num == 0:
+            lines.extend([
+                '        stack:',
+                '            priority: 1'])
+        lines.append('        interfaces:')
+        for port in range(1, 5):
+            lines.extend([
+                '            %u:' % port,
+                '                native_vlan: 100'])
+        for port, peer_dp_num, peer_port in stack_ports[dp_num]:
+            lines.extend([
+                '            %u:' % port,
+                '                stack:',
+                '                    dp: sw%u' % peer_dp_num,
+                '                    port: %u' % peer_port])
+    return write_file(config_dir, 'faucet.yaml', '\n'.join(lines) + '\n')
+
+
+@benchmark
+def stacked_dps(config_dir):
+    """Parse stacked DPs, that share one stack graph."""
+    config_file = write_stacked_dps_config(config_dir)
+    clear_config_caches()
+    (_, dps), parse_time = timed(dp_parser, config_file, 'bench')
+    report('parse (%u stacked DPs)' % len(dps), '%.2fs' % parse_time)
+
+
+def shortest_path_port_search(dp, dest_dp):
+    """Return the port towards dest_dp, searching the graph as before."""
+    shortest_path = dp.shortest_path(dest_dp)
+    for port in dp.stack_ports:
+        if port.stack['dp'].name == shortest_path[1]:
+            return port
+    return None
+
+
+@benchmark
+def stack_next_hop_ports(config_dir):
+    """Look up the port from a stacked DP towards other DPs."""
+    config_file = write_stacked_dps_config(config_dir)
+    _, dps = dp_parser(config_file, 'bench')
+    lookups = 5000
+    dp = dps[-1]
+    dest_dps = [dest_dp.name for dest_dp in dps if dest_dp is not dp]
+    dest_dps = (dest_dps * (lookups // len(dest_dps) + 1))[:lookups]
+    for label, port_lookup in (
+            ('searching the stack graph', shortest_path_port_search),
+            ('shortest_path_port', DP.shortest_path_port)):
+        ports, lookup_time = timed(lambda: [
+            port_lookup(dp, dest_dp) for dest_dp in dest_dps])
+        assert None not in ports
+        report('%u lookups, %s' % (lookups, label), '%.0fms' % (
+            lookup_time * 1e3))
+
+
+if __name__ == '__main__':
+    main()
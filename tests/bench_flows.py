@@ -0,0 +1,164 @@
+#!/usr/bin/python
+
+"""Benchmarks for building and sending flows to a datapath.
+
+Run ./bench_flows.py [benchmark ...] from the tests directory.
+"""
+
+# Copyright (C) 2015 Brad Cowie, Christopher Lorier and Joe Stringer.
+# Copyright (C) 2015 Research and Innovation Advanced Network New Zealand Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+from bench_util import benchmark, main, report, timed, valve_from_config
+
+from ryu.ofproto import ofproto_v1_3 as ofp
+from ryu.ofproto import ofproto_v1_3_parser as parser
+from faucet.faucet import Faucet
+
+
+class FakeDatapath(object):
+    """A Ryu datapath that counts the writes made to it."""
+
+    ofproto = ofp
+    ofproto_parser = parser
+
+    def __init__(self, dp_id):
+        self.id = dp_id
+        self.xid = 0
+        self.writes = 0
+        self.write_bytes = 0
+
+    def send(self, buf):
+        self.writes += 1
+        self.write_bytes += len(buf)
+
+    def send_msg(self, msg):
+        """Send one message, as ryu's Datapath.send_msg() does."""
+        msg.datapath = self
+        if msg.xid is None:
+            self.xid = (self.xid + 1) & ofp.MAX_XID
+            msg.xid = self.xid
+        msg.serialize()
+        self.send(msg.buf)
+
+
+def faucet_app(valve):
+    """Return a Faucet app, with just enough state to send flows."""
+    faucet = Faucet.__new__(Faucet)
+    faucet.logger = logging.getLogger('bench.faucet')
+    faucet.valves = {valve.dp.dp_id: valve}
+    return faucet
+
+
+def many_vlans_config(ports, vlans):
+    """Return a config for a DP with ports spread over VLANs."""
+    lines = [
+        'version: 2',
+        'dps:',
+        '    s1:',
+        '        dp_id: 1',
+        '        interfaces:']
+    for port in range(1, ports + 1):
+        lines.extend([
+            '            p%u:' % port,
+            '                number: %u' % port,
+            '                native_vlan: v%u' % (100 + port % vlans)])
+    lines.append('vlans:')
+    for vlan in range(vlans):
+        lines.extend([
+            '    v%u:' % (100 + vlan),
+            '        vid: %u' % (100 + vlan)])
+    return '\n'.join(lines) + '\n'
+
+
+@benchmark
+def send_flow_msgs(config_dir):
+    """Send the flows for connecting a 48 port, 10 VLAN DP."""
+    valve = valve_from_config(config_dir, many_vlans_config(48, 10))
+    faucet = faucet_app(valve)
+    for label, coalesced in (
+            ('one write per message', False),
+            ('coalesced writes', True)):
+        ofmsgs = valve.datapath_connect(valve.dp.dp_id, range(1, 49))
+        ryu_dp = FakeDatapath(valve.dp.dp_id)
+        if coalesced:
+            _, send_time = timed(faucet._send_flow_msgs, ryu_dp, ofmsgs)
+        else:
+            _, send_time = timed(lambda: [
+                ryu_dp.send_msg(ofmsg) for ofmsg in ofmsgs])
+        report(label, '%u messages, %uKB, %u writes, %.0fms' % (
+            len(ofmsgs), ryu_dp.write_bytes / 1024, ryu_dp.writes,
+            send_time * 1e3))
+
+
+def flood_flowmods(valve, ofmsgs):
+    """Return how many messages add or modify flood flows."""
+    return len([
+        ofmsg for ofmsg in ofmsgs
+        if isinstance(ofmsg, parser.OFPFlowMod) and
+        ofmsg.table_id == valve.dp.flood_table and
+        ofmsg.command in (ofp.OFPFC_ADD, ofp.OFPFC_MODIFY_STRICT)])
+
+
+@benchmark
+def port_flap(config_dir):
+    """Connect a 48 port, 3 VLAN DP, then take a port down and up."""
+    lines = [
+        'version: 2',
+        'dps:',
+        '    s1:',
+        '        dp_id: 1',
+        '        interfaces:']
+    for port in range(1, 49):
+        tagged_vid = 200
+        if port <= 8:
+            tagged_vid = 100 + (port + 1) % 2
+        lines.extend([
+            '            p%u:' % port,
+            '                number: %u' % port,
+            '                native_vlan: v%u' % (100 + port % 2),
+            '                tagged_vlans: [v%u]' % tagged_vid])
+    lines.extend([
+        'vlans:',
+        '    v100:',
+        '        vid: 100',
+        '    v101:',
+        '        vid: 101',
+        '    v200:',
+        '        vid: 200'])
+    # Connect with no ports up first, so that connecting is timed below.
+    valve = valve_from_config(config_dir, '\n'.join(lines) + '\n', ports=[])
+    dp_id = valve.dp.dp_id
+    ofmsgs, connect_time = timed(
+        valve.datapath_connect, dp_id, range(1, 49))
+    report('connect', '%u messages, %.2fs' % (len(ofmsgs), connect_time))
+    flaps = 20
+    down_flowmods = 0
+    up_flowmods = 0
+    flap_time = 0
+    for _ in range(flaps):
+        down_ofmsgs, down_time = timed(valve.port_delete, dp_id, 7)
+        up_ofmsgs, up_time = timed(valve.port_add, dp_id, 7)
+        down_flowmods += flood_flowmods(valve, down_ofmsgs)
+        up_flowmods += flood_flowmods(valve, up_ofmsgs)
+        flap_time += down_time + up_time
+    report('port down and up', '%.0fms' % (flap_time / flaps * 1e3))
+    report('flood flowmods, port down and up', '%u, %u' % (
+        down_flowmods / flaps, up_flowmods / flaps))
+
+
+if __name__ == '__main__':
+    main()
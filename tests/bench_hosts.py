@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+"""Benchmarks for learning and expiring hosts.
+
+Run ./bench_hosts.py [benchmark ...] from the tests directory.
+"""
+
+# Copyright (C) 2015 Brad Cowie, Christopher Lorier and Joe Stringer.
+# Copyright (C) 2015 Research and Innovation Advanced Network New Zealand Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import time
+
+from bench_util import benchmark, main, report, timed, valve_from_config
+
+from ryu.lib import addrconv
+from faucet import valve_host
+from faucet import valve_of
+from faucet.valve import Valve
+
+
+def host_mac(host):
+    """Return a MAC for a host, as a new string parsed from a packet in."""
+    return addrconv.mac.bin_to_text(
+        '\x0e\x00\x00' + chr(host >> 16) + chr((host >> 8) & 0xff) +
+        chr(host & 0xff))
+
+
+def host_cache_bytes(host_cache):
+    """Return the bytes used by a host cache, its entries and their MACs.
+
+    Allocator overhead, and the table of interned strings, are not counted.
+    """
+    objs = {}
+    for eth_src, entry in host_cache.iteritems():
+        objs[id(eth_src)] = eth_src
+        objs[id(entry)] = entry
+        objs[id(entry.eth_src)] = entry.eth_src
+        if hasattr(entry, '__dict__'):
+            objs[id(entry.__dict__)] = entry.__dict__
+    return sys.getsizeof(host_cache) + sum(
+        [sys.getsizeof(obj) for obj in objs.itervalues()])
+
+
+class UnslottedHostCacheEntry(object):
+    """A host cache entry with a __dict__, as before __slots__ were used."""
+
+    def __init__(self, eth_src, port, edge, permanent, now):
+        self.eth_src = eth_src
+        self.port = port
+        self.edge = edge
+        self.permanent = permanent
+        self.cache_time = now
+
+
+@benchmark
+def host_cache_memory(_):
+    """Bytes per cached host, counting the entry, its MACs and dict slot."""
+    hosts = 100000
+    now = time.time()
+    for label, entry_class, intern_mac in (
+            ('unslotted entries, MAC copies', UnslottedHostCacheEntry, False),
+            ('HostCacheEntry, interned MACs', valve_host.HostCacheEntry, True)):
+        host_cache = {}
+        for host in range(hosts):
+            # The key is the MAC from the packet in that first learned the
+            # host, and the entry has the MAC from the latest relearn.
+            key = host_mac(host)
+            mac = host_mac(host)
+            if intern_mac:
+                key = intern(key)
+                mac = intern(mac)
+            host_cache[key] = entry_class(mac, None, True, False, now)
+        report(label, '%u bytes/host' % (
+            host_cache_bytes(host_cache) / hosts))
+
+
+LEARN_CONFIG = """
+version: 2
+dps:
+    s1:
+        dp_id: 1
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: v100
+            p2:
+                number: 2
+                tagged_vlans: [v100]
+vlans:
+    v100:
+        vid: 0x100
+"""
+
+
+def learn_hosts(valve, macs, learns):
+    """Learn hosts alternately on two ports, and return seconds per learn."""
+    host_manager = valve.host_manager
+    vlan = valve.dp.vlans[0x100]
+    ports = [valve.dp.ports[1], valve.dp.ports[2]]
+    _, learn_time = timed(lambda: [
+        host_manager.learn_host_on_vlan_port(
+            ports[learn & 1], vlan, macs[learn % len(macs)])
+        for learn in xrange(learns)])
+    return learn_time / learns
+
+
+@benchmark
+def learn(config_dir):
+    """Learn hosts, with and without the match cache (flows not sent)."""
+    for cache_label, match_cache_size in (
+            ('no match cache', 0),
+            ('match cache', Valve.MATCH_CACHE_SIZE)):
+        for label, hosts in (
+                ('relearning 256 hosts', 256),
+                ('20000 distinct hosts', 20000)):
+            valve = valve_from_config(config_dir, LEARN_CONFIG)
+            valve.MATCH_CACHE_SIZE = match_cache_size
+            valve.host_manager.cache_update_guard_time = 0
+            macs = [host_mac(host) for host in range(hosts)]
+            learn_time = learn_hosts(valve, macs, 20000)
+            report('%s, %s' % (label, cache_label), '%.0fus per learn' % (
+                learn_time * 1e6))
+
+
+def expire_hosts_by_scan(host_manager, vlan, now):
+    """Expire hosts by checking every cached host, as before."""
+    expired_hosts = []
+    for eth_src, host_cache_entry in vlan.host_cache.iteritems():
+        if (not host_cache_entry.permanent and
+                now - host_cache_entry.cache_time > host_manager.learn_timeout):
+            expired_hosts.append(eth_src)
+    return expired_hosts
+
+
+@benchmark
+def host_expire(config_dir):
+    """Check 50000 hosts on one VLAN for expiry, with none due."""
+    hosts = 50000
+    valve = valve_from_config(config_dir, LEARN_CONFIG)
+    host_manager = valve.host_manager
+    vlan = valve.dp.vlans[0x100]
+    port = valve.dp.ports[1]
+    for host in range(hosts):
+        host_manager.learn_host_on_vlan_port(port, vlan, host_mac(host))
+    now = time.time()
+    ticks = 100
+    for label, expire_hosts in (
+            ('scanning the host cache', expire_hosts_by_scan),
+            ('expiry wheel',
+             valve_host.ValveHostManager.expire_hosts_from_vlan)):
+        _, expire_time = timed(lambda: [
+            expire_hosts(host_manager, vlan, now) for _ in range(ticks)])
+        assert len(vlan.host_cache) == hosts
+        report('%u hosts, %s' % (hosts, label), '%.3fms per tick' % (
+            expire_time / ticks * 1e3))
+
+
+SERIALIZE_CONFIG = LEARN_CONFIG.replace(
+    """                native_vlan: v100
+            p2:""",
+    """                native_vlan: v100
+                mirror: 3
+            p2:""").replace(
+    """                tagged_vlans: [v100]
+""",
+    """                tagged_vlans: [v100]
+            p3:
+                number: 3
+""")
+
+
+@benchmark
+def learn_serialize(config_dir):
+    """Relearn 256 hosts, and serialize the flowmods that add learn flows."""
+    learns = 20000
+    for label, templated in (
+            ('ryu flowmods', False),
+            ('templated flowmods', True)):
+        valve = valve_from_config(config_dir, SERIALIZE_CONFIG)
+        host_manager = valve.host_manager
+        host_manager.cache_update_guard_time = 0
+        vlan = valve.dp.vlans[0x100]
+        ports = [valve.dp.ports[1], valve.dp.ports[2]]
+        macs = [host_mac(host) for host in range(256)]
+
+        def learn_and_serialize():
+            flowmods = 0
+            for learn in xrange(learns):
+                for ofmsg in host_manager.learn_host_on_vlan_port(
+                        ports[learn & 1], vlan, macs[learn & 0xff]):
+                    if not valve_of.is_flowadd(ofmsg):
+                        continue
+                    if not templated:
+                        ofmsg = ofmsg.template.build_flowmod(
+                            **ofmsg.template_fields)
+                    ofmsg.datapath = valve_of._NullDatapath
+                    ofmsg.xid = learn
+                    ofmsg.serialize()
+                    flowmods += 1
+            return flowmods
+
+        flowmods, serialize_time = timed(learn_and_serialize)
+        report(label, '%u flowmods/s' % (flowmods / serialize_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/python
+
+"""Benchmarks for routing.
+
+Run ./bench_routes.py [benchmark ...] from the tests directory.
+"""
+
+# Copyright (C) 2015 Brad Cowie, Christopher Lorier and Joe Stringer.
+# Copyright (C) 2015 Research and Innovation Advanced Network New Zealand Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import time
+
+import ipaddr
+
+from bench_util import benchmark, main, report, timed, valve_from_config
+
+
+def route_config(dp_options=None, ports=2):
+    """Return a config for a DP routing on one VLAN.
+
+    Args:
+        dp_options (dict): DP options to set.
+        ports (int): number of ports in the VLAN.
+    Returns:
+        str: FAUCET config.
+    """
+    lines = [
+        'version: 2',
+        'dps:',
+        '    s1:',
+        '        dp_id: 1']
+    for option, value in sorted((dp_options or {}).iteritems()):
+        lines.append('        %s: %s' % (option, value))
+    lines.append('        interfaces:')
+    for port in range(1, ports + 1):
+        lines.extend([
+            '            %u:' % port,
+            '                native_vlan: v100'])
+    lines.extend([
+        'vlans:',
+        '    v100:',
+        '        vid: 100',
+        '        controller_ips: ["10.0.0.254/24"]'])
+    return '\n'.join(lines) + '\n'
+
+
+def prefix(route):
+    """Return a distinct /24 for each route number."""
+    return ipaddr.IPNetwork('20.%u.%u.0/24' % (route // 256, route % 256))
+
+
+def time_calls(func, calls):
+    """Return the average seconds taken by calling func."""
+    _, call_time = timed(lambda: [func() for _ in range(calls)])
+    return call_time / calls
+
+
+@benchmark
+def nexthop_index(config_dir):
+    """Resolve and update nexthops, with 50000 routes via 10 nexthops."""
+    valve = valve_from_config(config_dir, route_config())
+    vlan = valve.dp.vlans[100]
+    route_manager = valve.ipv4_route_manager
+    ip_gws = [ipaddr.IPAddress('10.0.0.%u' % host) for host in range(1, 11)]
+    routes = 50000
+    for route in range(routes):
+        valve.add_route(vlan, ip_gws[route % len(ip_gws)], prefix(route))
+    # Resolve one nexthop, so there are routes to update when it moves.
+    route_manager._update_nexthop(vlan, 1, '00:00:00:00:00:01', ip_gws[0])
+    report('resolve_gateways', '%.0fus' % (
+        time_calls(valve.resolve_gateways, 20) * 1e6))
+    report('reply, nexthop MAC unchanged', '%.0fus' % (time_calls(
+        lambda: route_manager._update_nexthop(
+            vlan, 1, '00:00:00:00:00:01', ip_gws[0]), 20) * 1e6))
+    unrouted_ip_gw = ipaddr.IPAddress('10.0.0.99')
+    report('reply, nexthop with no routes', '%.0fus' % (time_calls(
+        lambda: route_manager._update_nexthop(
+            vlan, 1, '00:00:00:00:00:01', unrouted_ip_gw), 20) * 1e6))
+    eth_srcs = ['00:00:00:00:00:01', '00:00:00:00:00:02']
+
+    def move_nexthop():
+        eth_srcs.reverse()
+        return route_manager._update_nexthop(
+            vlan, 1, eth_srcs[0], ip_gws[0])
+
+    report(
+        'reply, nexthop MAC changed (%u routes)' % (routes / len(ip_gws)),
+        '%.0fms' % (time_calls(move_nexthop, 4) * 1e3))
+
+
+@benchmark
+def nexthop_move(config_dir):
+    """Move a nexthop with 20000 routes, with and without group routing."""
+    routes = 20000
+    for group_table_routing in (False, True):
+        valve = valve_from_config(config_dir, route_config(
+            {'group_table_routing': group_table_routing}))
+        vlan = valve.dp.vlans[100]
+        route_manager = valve.ipv4_route_manager
+        ip_gw = ipaddr.IPAddress('10.0.0.1')
+        for route in range(routes):
+            valve.add_route(vlan, ip_gw, prefix(route))
+        route_manager._update_nexthop(vlan, 1, '00:00:00:00:00:01', ip_gw)
+        ofmsgs, move_time = timed(
+            route_manager._update_nexthop,
+            vlan, 2, '00:00:00:00:00:02', ip_gw)
+        report(
+            'group_table_routing=%s' % group_table_routing,
+            '%u messages, %.1fms' % (len(ofmsgs), move_time * 1e3))
+
+
+@benchmark
+def route_churn(config_dir):
+    """Add, withdraw and add 20000 routes, as after a BGP session reset."""
+    routes = 20000
+    for route_update_interval in (0, 1):
+        valve = valve_from_config(config_dir, route_config(
+            {'route_update_interval': route_update_interval}))
+        vlan = valve.dp.vlans[100]
+        ip_gw = ipaddr.IPAddress('10.0.0.1')
+        valve.add_route(vlan, ip_gw, ipaddr.IPNetwork('9.0.0.0/8'))
+        valve.ipv4_route_manager._update_nexthop(
+            vlan, 1, '00:00:00:00:00:01', ip_gw)
+        ip_dsts = [prefix(route) for route in range(routes)]
+        updates = (
+            [(ip_gw, ip_dst) for ip_dst in ip_dsts] +
+            [(None, ip_dst) for ip_dst in ip_dsts] +
+            [(ip_gw, ip_dst) for ip_dst in ip_dsts])
+
+        def update_routes():
+            sent_ofmsgs = []
+            for update_ip_gw, ip_dst in updates:
+                if valve.queue_route_update(vlan, update_ip_gw, ip_dst):
+                    continue
+                if update_ip_gw is None:
+                    sent_ofmsgs.append(valve.del_route(vlan, ip_dst))
+                else:
+                    sent_ofmsgs.append(
+                        valve.add_route(vlan, update_ip_gw, ip_dst))
+            while valve.route_update_queue_depth():
+                sent_ofmsgs.append(valve.flush_route_updates())
+            return sent_ofmsgs
+
+        sent_ofmsgs, update_time = timed(update_routes)
+        report(
+            'route_update_interval=%u' % route_update_interval,
+            '%u sends, %u messages, %.1fs' % (
+                len(sent_ofmsgs), sum([len(ofmsgs) for ofmsgs in sent_ofmsgs]),
+                update_time))
+
+
+@benchmark
+def fib_aggregation(config_dir):
+    """Load 2000 /16s each with 10 /24s, 70% sharing the /16's nexthop."""
+    for aggregate in (False, True):
+        valve = valve_from_config(config_dir, route_config(
+            {'fib_aggregation': aggregate}))
+        vlan = valve.dp.vlans[100]
+        ip_gws = [ipaddr.IPAddress('10.0.0.%u' % host) for host in range(1, 5)]
+        for host, ip_gw in enumerate(ip_gws):
+            valve.add_route(
+                vlan, ip_gw, ipaddr.IPNetwork('9.%u.0.0/16' % host))
+            valve.ipv4_route_manager._update_nexthop(
+                vlan, 1, '00:00:00:00:00:%02x' % (host + 1), ip_gw)
+        # The same routes, in the same order, for each run.
+        rand = random.Random(1)
+        routes = []
+        for route in range(2000):
+            octets = (20 + route // 256, route % 256)
+            ip_gw = rand.choice(ip_gws)
+            routes.append((ip_gw, ipaddr.IPNetwork('%u.%u.0.0/16' % octets)))
+            for subnet in range(10):
+                subnet_ip_gw = ip_gw
+                if rand.random() >= 0.7:
+                    subnet_ip_gw = rand.choice(ip_gws)
+                routes.append((subnet_ip_gw, ipaddr.IPNetwork(
+                    '%u.%u.%u.0/24' % (octets + (subnet,)))))
+        rand.shuffle(routes)
+        _, load_time = timed(lambda: [
+            valve.add_route(vlan, ip_gw, ip_dst) for ip_gw, ip_dst in routes])
+        all_routes = len(routes) + len(ip_gws)
+        fib_flows = all_routes - valve.fib_flows_saved()
+        _, withdraw_time = timed(lambda: [
+            valve.del_route(vlan, ip_dst) for _, ip_dst in routes[:2000]])
+        report(
+            'fib_aggregation=%s' % aggregate,
+            '%u routes, %u FIB flows, load %.1fs, withdraw 2000 %.2fs' % (
+                all_routes, fib_flows, load_time, withdraw_time))
+
+
+@benchmark
+def resolve_backoff(config_dir):
+    """Resolve 200 dead nexthops on a 3 port VLAN, over 300s of cycles."""
+    nexthops = 200
+    cycles = 150
+    for label, backoff in (
+            ('every cycle, all nexthops', False),
+            ('with backoff, spread over cycles', True)):
+        valve = valve_from_config(config_dir, route_config(ports=3))
+        vlan = valve.dp.vlans[100]
+        route_manager = valve.ipv4_route_manager
+        if not backoff:
+            # Resolve every unresolved nexthop every cycle, as before.
+            route_manager._resolve_backoff = lambda retries: 0
+            route_manager.max_hosts_per_resolve_cycle = 0
+        for nexthop in range(nexthops):
+            valve.add_route(
+                vlan, ipaddr.IPAddress('10.0.0.%u' % (nexthop + 10)),
+                ipaddr.IPNetwork('10.%u.0.0/16' % (nexthop + 1)))
+        now = time.time()
+        # The same jitter for each run.
+        random.seed(1)
+        cycle_packet_outs, resolve_time = timed(lambda: [
+            len(route_manager.resolve_gateways(vlan, now + cycle * 2))
+            for cycle in range(cycles)])
+        report(label, '%u packet outs (at most %u per cycle), %.2fs' % (
+            sum(cycle_packet_outs), max(cycle_packet_outs), resolve_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Utility functions for FAUCET benchmarks."""
+
+# Copyright (C) 2015 Brad Cowie, Christopher Lorier and Joe Stringer.
+# Copyright (C) 2015 Research and Innovation Advanced Network New Zealand Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from collections import OrderedDict
+
+testdir = os.path.dirname(__file__)
+srcdir = '../src/ryu_faucet/org/onfsdn/'
+sys.path.insert(0, os.path.abspath(os.path.join(testdir, srcdir)))
+
+from faucet.config_parser import dp_parser
+from faucet.valve import valve_factory
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(func):
+    """Register a function to be run as a benchmark."""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def timed(func, *args, **kwargs):
+    """Return the result of calling func, and the seconds it took."""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+
+def report(label, value):
+    print '  %-44s %s' % (label + ':', value)
+
+
+def write_file(config_dir, file_name, text):
+    """Write a file into config_dir, and return its path."""
+    path = os.path.join(config_dir, file_name)
+    with open(path, 'w') as config_file:
+        config_file.write(text)
+    return path
+
+
+def valve_from_config(config_dir, config, ports=None):
+    """Return a Valve for a config's first DP, connected to its datapath.
+
+    Args:
+        config_dir (str): directory to write the config file in.
+        config (str): FAUCET config.
+        ports (list): port numbers up when the datapath connects.
+    Returns:
+        Valve: valve for the first DP.
+    """
+    config_file = write_file(config_dir, 'faucet.yaml', config)
+    _, dps = dp_parser(config_file, 'bench')
+    dp = dps[0]
+    valve = valve_factory(dp)(dp, 'bench')
+    if ports is None:
+        ports = dp.ports.keys()
+    valve.datapath_connect(dp.dp_id, ports)
+    return valve
+
+
+def main():
+    """Run the benchmarks named on the command line, or all of them.
+
+    Timings are wall clock times, so only compare runs on the same machine.
+    """
+    logging.basicConfig(level=logging.CRITICAL)
+    names = sys.argv[1:] or BENCHMARKS.keys()
+    for name in names:
+        if name not in BENCHMARKS:
+            print 'unknown benchmark %s, one of: %s' % (
+                name, ', '.join(BENCHMARKS.keys()))
+            sys.exit(1)
+    for name in names:
+        print '%s:' % name
+        tmpdir = tempfile.mkdtemp()
+        try:
+            BENCHMARKS[name](tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
@@ -29,6 +29,7 @@ class FakeOFTable():
         self.tables = []
         for i in range(0, num_tables):
             self.tables.append([])
+        self.groups = {}
 
     def apply_ofmsgs(self, ofmsgs):
         """This is used to update the fake flowtable.
@@ -36,7 +37,9 @@ class FakeOFTable():
         Adds, Deletes and modify flow modification messages are applied
         according to section 6.4 of the OpenFlow 1.3 specification."""
         for ofmsg in ofmsgs:
-            if isinstance(ofmsg, parser.OFPFlowMod):
+            if isinstance(ofmsg, parser.OFPGroupMod):
+                self.apply_groupmod(ofmsg)
+            elif isinstance(ofmsg, parser.OFPFlowMod):
                 table_id = ofmsg.table_id
                 if table_id == ofp.OFPTT_ALL or table_id is None:
                     tables = self.tables
@@ -96,6 +99,25 @@ class FakeOFTable():
                                 break
         self.sort_tables()
 
+    def apply_groupmod(self, groupmod):
+        """Add, modify or delete a group.
+
+        As in section 6.5 of the OpenFlow 1.3 specification, deleting a
+        group also deletes the flows that use it."""
+        if groupmod.command == ofp.OFPGC_DELETE:
+            if groupmod.group_id == ofp.OFPG_ALL:
+                group_ids = set(self.groups.keys())
+            else:
+                group_ids = set([groupmod.group_id])
+            for group_id in group_ids:
+                self.groups.pop(group_id, None)
+            for table_id, table in enumerate(self.tables):
+                self.tables[table_id] = [
+                    fte for fte in table
+                    if not fte.group_ids().intersection(group_ids)]
+        else:
+            self.groups[groupmod.group_id] = groupmod.buckets
+
     def lookup(self, match):
         """Return the entries from flowmods that matches match.
 
@@ -166,37 +188,63 @@ class FakeOFTable():
 
         for instruction in instructions:
             if instruction.type == ofp.OFPIT_APPLY_ACTIONS:
-                for action in instruction.actions:
+                output = self.actions_output(
+                    instruction.actions, vid_stack, match.get('in_port'),
+                    port, vid)
+                if output is not None:
+                    return output
 
-                    if action.type == ofp.OFPAT_PUSH_VLAN:
-                        vid_stack.append(ofp.OFPVID_PRESENT)
+        return False
 
-                    elif action.type == ofp.OFPAT_POP_VLAN:
-                        vid_stack.pop()
+    def actions_output(self, actions, vid_stack, in_port, port, vid,
+                       in_group=False):
+        """Return True/False if actions output packets as is_output expects,
+        or None if they do not output to port.
 
-                    elif action.type == ofp.OFPAT_SET_FIELD:
-                        if action.key == 'vlan_vid':
-                            vid_stack[-1] = action.value
-                        else:
-                            continue
+        Group buckets are applied to their own copy of the packet, and
+        (as with an ALL group) are not output to the input port."""
+        for action in actions:
 
-                    elif action.type == ofp.OFPAT_OUTPUT:
-                        if port is None:
-                            return True
+            if action.type == ofp.OFPAT_PUSH_VLAN:
+                vid_stack.append(ofp.OFPVID_PRESENT)
 
-                        elif action.port == port:
+            elif action.type == ofp.OFPAT_POP_VLAN:
+                vid_stack.pop()
 
-                            if vid is None:
-                                return True
+            elif action.type == ofp.OFPAT_SET_FIELD:
+                if action.key == 'vlan_vid':
+                    vid_stack[-1] = action.value
+                else:
+                    continue
 
-                            elif vid & ofp.OFPVID_PRESENT == 0:
-                                return len(vid_stack) == 0
+            elif action.type == ofp.OFPAT_GROUP:
+                for bucket in self.groups.get(action.group_id, []):
+                    output = self.actions_output(
+                        bucket.actions, list(vid_stack), in_port, port, vid,
+                        in_group=True)
+                    if output is not None:
+                        return output
 
-                            else:
-                                return\
-                                    len(vid_stack) > 0 and vid == vid_stack[-1]
+            elif action.type == ofp.OFPAT_OUTPUT:
+                if in_group and action.port == in_port:
+                    continue
 
-        return False
+                if port is None:
+                    return True
+
+                elif action.port == port:
+
+                    if vid is None:
+                        return True
+
+                    elif vid & ofp.OFPVID_PRESENT == 0:
+                        return len(vid_stack) == 0
+
+                    else:
+                        return\
+                            len(vid_stack) > 0 and vid == vid_stack[-1]
+
+        return None
 
     def __str__(self):
         string = ""
@@ -207,6 +255,27 @@ class FakeOFTable():
                 string += "\n"
         return string
 
+    def flow_stats(self, cookie):
+        """Return flow stats for flows with a cookie, as a switch would.
+
+        Matches are serialized and parsed again, as they would be when
+        received from a switch."""
+        flow_stats = []
+        for table_id, table in enumerate(self.tables):
+            for fte in table:
+                if fte.cookie != cookie:
+                    continue
+                buf = bytearray()
+                fte.match.serialize(buf, 0)
+                match = parser.OFPMatch.parser(buffer(buf), 0)
+                flow_stats.append(parser.OFPFlowStats(
+                    table_id=table_id, duration_sec=0, duration_nsec=0,
+                    priority=fte.priority, idle_timeout=fte.idle_timeout,
+                    hard_timeout=fte.hard_timeout, flags=0, cookie=fte.cookie,
+                    packet_count=0, byte_count=0, match=match,
+                    instructions=fte.instructions))
+        return flow_stats
+
     def sort_tables(self):
         for table_id, table in enumerate(self.tables):
             self.tables[table_id] = sorted(table, reverse=True)
@@ -235,6 +304,10 @@ class FlowMod(object):
         """flowmod is a ryu flow modification message object"""
         self.priority = flowmod.priority
         self.instructions = flowmod.instructions
+        self.match = flowmod.match
+        self.cookie = flowmod.cookie
+        self.idle_timeout = flowmod.idle_timeout
+        self.hard_timeout = flowmod.hard_timeout
         self.match_values = {}
         self.match_masks = {}
         self.out_port = None
@@ -255,6 +328,16 @@ class FlowMod(object):
             self.match_values[key] = val
             self.match_masks[key] = mask
 
+    def group_ids(self):
+        """returns the IDs of groups this flowmod's actions use"""
+        group_ids = set()
+        for instruction in self.instructions:
+            if instruction.type == ofp.OFPIT_APPLY_ACTIONS:
+                for action in instruction.actions:
+                    if action.type == ofp.OFPAT_GROUP:
+                        group_ids.add(action.group_id)
+        return group_ids
+
     def out_port_matches(self, other):
         """returns True if other has an output action to this flowmods
         output_port"""
@@ -284,7 +367,7 @@ class FlowMod(object):
                 return False
             else:
                 val_bits = self.match_to_bits(key, pkt_dict[key])
-                if val_bits != (val & self.match_masks[key]):
+                if (val_bits & self.match_masks[key]) != val:
                     return False
         return True
 
@@ -17,8 +17,10 @@
 
 import hashlib
 import logging
+import shutil
 import sys
 import os
+import tempfile
 import ipaddr
 
 testdir = os.path.dirname(__file__)
@@ -26,6 +28,7 @@ srcdir = '../src/ryu_faucet/org/onfsdn/faucet'
 sys.path.insert(0, os.path.abspath(os.path.join(testdir, srcdir)))
 
 import unittest
+import config_parser
 from config_parser import dp_parser, watcher_parser
 
 class DistConfigTestCase(unittest.TestCase):
@@ -97,6 +100,11 @@ class DistConfigTestCase(unittest.TestCase):
              ['switch2', 'switch1'], switch2.shortest_path_to_root())
         self.assertEqual(
              switch1.ports[7], switch1.shortest_path_port('switch2'))
+        self.assertEqual(
+             switch2.ports[1], switch2.shortest_path_port('switch1'))
+        self.assertIsNone(switch1.shortest_path_port('switch1'))
+        # The stack graph is built once and shared.
+        self.assertIs(switch1.stack['graph'], switch2.stack['graph'])
         edges = [edge for edge in switch1.stack['graph'].adjacency_iter()]
         self.assertEqual(
              2, len(edges))
@@ -218,6 +226,206 @@ class DistConfigTestCase(unittest.TestCase):
                 dp.acls[dp.vlans[41].acl_in].rules[0]['nw_dst'],
                 '172.0.0.0/8')
 
+    def test_conf_digests(self):
+        _, reparsed_dps = dp_parser('config/testconfigv2.yaml', 'test_config')
+        reparsed_dp = [
+            dp for dp in reparsed_dps if dp.dp_id == self.v2_dp.dp_id][0]
+        dp = self.v2_dp
+        self.assertEquals(dp.conf_digest(), reparsed_dp.conf_digest())
+        for vid, vlan in dp.vlans.iteritems():
+            self.assertEquals(vlan, reparsed_dp.vlans[vid])
+        for port_no, port in dp.ports.iteritems():
+            self.assertEquals(port, reparsed_dp.ports[port_no])
+        for acl_id, acl in dp.acls.iteritems():
+            self.assertEquals(acl, reparsed_dp.acls[acl_id])
+        # Dynamic state is not configuration.
+        dp.ports[1].phys_up = True
+        dp.vlans[41].host_cache['0e:00:00:00:00:01'] = None
+        self.assertEquals(
+            dp.ports[1].conf_digest(), dp.ports[1]._compute_conf_digest())
+        self.assertEquals(
+            dp.vlans[41].conf_digest(), dp.vlans[41]._compute_conf_digest())
+        self.assertEquals(dp.conf_digest(), reparsed_dp.conf_digest())
+        self.assertNotEquals(dp.ports[1], dp.ports[2])
+        self.assertNotEquals(
+            dp.conf_digest(), self.v2_dps_by_id[0xdeadbeef].conf_digest())
+
+    def test_reuse_unchanged_dps(self):
+        dps = self.v2_dps_by_id.values()
+        _, reparsed_dps = dp_parser(
+            'config/testconfigv2.yaml', 'test_config', dps)
+        # Stacked DPs are always rebuilt.
+        for dp in reparsed_dps:
+            self.assertIsNot(dp, self.v2_dps_by_id[dp.dp_id])
+
+        config_dir = tempfile.mkdtemp()
+        config_file = os.path.join(config_dir, 'faucet.yaml')
+        config = """
+vlans:
+    100:
+        description: "v100"
+    200:
+        description: "v200"
+dps:
+    s1:
+        dp_id: 1
+        interfaces:
+            1:
+                native_vlan: 100
+    s2:
+        dp_id: 2
+        interfaces:
+            1:
+                native_vlan: 200
+"""
+        try:
+            with open(config_file, 'w') as config_fd:
+                config_fd.write(config)
+            _, dps = dp_parser(config_file, 'test_config')
+            _, reparsed_dps = dp_parser(config_file, 'test_config', dps)
+            self.assertEquals(
+                set([id(dp) for dp in dps]),
+                set([id(dp) for dp in reparsed_dps]))
+            with open(config_file, 'w') as config_fd:
+                config_fd.write(config.replace('"v200"', '"changed"'))
+            _, changed_dps = dp_parser(
+                config_file, 'test_config', reparsed_dps)
+            dps_by_id = dict([(dp.dp_id, dp) for dp in reparsed_dps])
+            for dp in changed_dps:
+                if dp.dp_id == 1:
+                    self.assertIs(dp, dps_by_id[dp.dp_id])
+                else:
+                    self.assertIsNot(dp, dps_by_id[dp.dp_id])
+                    self.assertEquals(dp.vlans[200].description, 'changed')
+                    self.assertNotEquals(
+                        dp.conf_digest(), dps_by_id[dp.dp_id].conf_digest())
+        finally:
+            shutil.rmtree(config_dir)
+
+    def test_ignore_learn_ins_warning(self):
+        config_dir = tempfile.mkdtemp()
+        config_file = os.path.join(config_dir, 'faucet.yaml')
+        config = """
+vlans:
+    100:
+        description: "v100"
+dps:
+    s1:
+        dp_id: 1
+        ignore_learn_ins: 3
+        interfaces:
+            1:
+                native_vlan: 100
+"""
+        warnings = []
+
+        class WarningHandler(logging.Handler):
+
+            def emit(self, record):
+                warnings.append(record.getMessage())
+
+        logger = logging.getLogger('test_config.config')
+        handlers = logger.handlers
+        level = logger.level
+        logger.handlers = [WarningHandler(level=logging.WARNING)]
+        logger.setLevel(logging.WARNING)
+        try:
+            with open(config_file, 'w') as config_fd:
+                config_fd.write(config)
+            _, dps = dp_parser(config_file, 'test_config')
+            self.assertEquals(1, len(warnings))
+            self.assertIn('ignore_learn_ins', warnings[0])
+            self.assertNotIn('ignore_learn_ins', dps[0].__dict__)
+            # Packet ins are rate limited by default instead.
+            self.assertTrue(dps[0].packet_in_rate > 0)
+        finally:
+            logger.handlers = handlers
+            logger.setLevel(level)
+            shutil.rmtree(config_dir)
+
+    def test_host_expire_precision(self):
+        config_dir = tempfile.mkdtemp()
+        config_file = os.path.join(config_dir, 'faucet.yaml')
+        config = """
+vlans:
+    100:
+        description: "v100"
+dps:
+    s1:
+        dp_id: 1
+        host_expire_precision: %s
+        interfaces:
+            1:
+                native_vlan: 100
+"""
+        try:
+            for precision in ('0', '-1', '"1"'):
+                with open(config_file, 'w') as config_fd:
+                    config_fd.write(config % precision)
+                self.assertIsNone(dp_parser(config_file, 'test_config'))
+            with open(config_file, 'w') as config_fd:
+                config_fd.write(config % '0.5')
+            _, dps = dp_parser(config_file, 'test_config')
+            self.assertEquals(0.5, dps[0].host_expire_precision)
+        finally:
+            shutil.rmtree(config_dir)
+
+    def test_config_file_hash(self):
+        config_dir = tempfile.mkdtemp()
+        config_file = os.path.join(config_dir, 'faucet.yaml')
+        try:
+            with open(config_file, 'w') as config_fd:
+                config_fd.write('dps: {}\n')
+            self.assertEquals(
+                hashlib.sha256('dps: {}\n').hexdigest(),
+                config_parser.config_file_hash(config_file))
+            # Contents read for the hash are kept until parsed.
+            self.assertIn(config_file, config_parser._config_file_contents)
+            config_parser.read_config(config_file, 'test_config')
+            self.assertNotIn(config_file, config_parser._config_file_contents)
+            with open(config_file, 'w') as config_fd:
+                config_fd.write('vlans: {}\n')
+            self.assertEquals(
+                hashlib.sha256('vlans: {}\n').hexdigest(),
+                config_parser.config_file_hash(config_file))
+        finally:
+            shutil.rmtree(config_dir)
+
+    def test_compiled_config_cache(self):
+        config_dir = tempfile.mkdtemp()
+        config_file = os.path.join(config_dir, 'faucet.yaml')
+        cache_file = os.path.join(config_dir, '.faucet.yaml.cache')
+        config = """
+vlans:
+    100:
+        description: "v100"
+dps:
+    s1:
+        dp_id: 1
+        interfaces:
+            1:
+                native_vlan: 100
+"""
+        os.environ['FAUCET_CONFIG_CACHE'] = '1'
+        try:
+            with open(config_file, 'w') as config_fd:
+                config_fd.write(config)
+            _, dps = dp_parser(config_file, 'test_config')
+            self.assertTrue(os.path.exists(cache_file))
+            config_parser._config_file_cache.clear()
+            _, cached_dps = dp_parser(config_file, 'test_config')
+            self.assertEquals(dps[0].conf_digest(), cached_dps[0].conf_digest())
+            # A cache of a previous version of the file is not used.
+            with open(config_file, 'w') as config_fd:
+                config_fd.write(config.replace('"v100"', '"changed"'))
+            config_parser._config_file_cache.clear()
+            _, changed_dps = dp_parser(config_file, 'test_config')
+            self.assertEquals(
+                changed_dps[0].vlans[100].description, 'changed')
+        finally:
+            del os.environ['FAUCET_CONFIG_CACHE']
+            shutil.rmtree(config_dir)
+
     def test_gauge_port_stats(self):
         for watcher in self.v2_watchers:
             if watcher.type == 'port_stats':
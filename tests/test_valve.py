@@ -14,11 +14,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
 import sys
 import os
 import unittest
 import tempfile
+import ipaddr
+import time
 import shutil
+import struct
 from fakeoftable import FakeOFTable
 
 testdir = os.path.dirname(__file__)
@@ -27,15 +31,26 @@ sys.path.insert(0, os.path.abspath(os.path.join(testdir, srcdir)))
 
 from ryu.ofproto import ether
 from ryu.ofproto import ofproto_v1_3 as ofp
+from ryu.ofproto import ofproto_v1_3_parser as parser
 from ryu.lib.packet import ethernet, arp, vlan, ipv4, ipv6, packet
+from faucet import valve_flood
+from faucet import valve_host
+from faucet import valve_of
+from faucet import valve_ratelimit
 from faucet.valve import valve_factory
+from faucet.valve_packet import parse_packet_in_pkt
 from faucet.config_parser import dp_parser
+from faucet.faucet import Faucet
 
 def build_pkt(pkt):
     layers = []
     if 'arp_target_ip' in pkt:
         ethertype = 0x806
-        layers.append(arp.arp(dst_ip=pkt['arp_target_ip']))
+        layers.append(arp.arp(
+            opcode=pkt.get('arp_code', arp.ARP_REQUEST),
+            src_mac=pkt['eth_src'],
+            src_ip=pkt.get('arp_source_ip', '10.0.0.1'),
+            dst_ip=pkt['arp_target_ip']))
     elif 'ipv6_src' in pkt:
         ethertype = 0x86DD
         layers.append(ipv6.ipv6(src=pkt['ipv6_src'], dst=pkt['ipv6_src']))
@@ -57,8 +72,9 @@ def build_pkt(pkt):
         ethertype=tpid)
     layers.append(eth)
     result = packet.Packet()
-    for layer in layers:
+    for layer in reversed(layers):
         result.add_protocol(layer)
+    result.serialize()
     return result
 
 
@@ -67,7 +83,6 @@ class ValveTestBase(unittest.TestCase):
 version: 2
 dps:
     s1:
-        ignore_learn_ins: 0
         hardware: 'Open vSwitch'
         dp_id: 1
         interfaces:
@@ -116,11 +131,7 @@ vlans:
         self.valve = valve_factory(dp)(dp, 'test_valve')
 
         # establish connection to datapath
-        ofmsgs = self.valve.datapath_connect(
-            self.DP_ID,
-            range(1, self.NUM_PORTS + 1)
-            )
-        self.table.apply_ofmsgs(ofmsgs)
+        self.connect_dp()
 
         # learn some mac addresses
         self.rcv_packet(1, 0x100, {
@@ -138,6 +149,34 @@ vlans:
             'vid': 0x200
             })
 
+    def connect_dp(self):
+        ofmsgs = self.valve.datapath_connect(
+            self.DP_ID,
+            range(1, self.NUM_PORTS + 1)
+            )
+        self.table.apply_ofmsgs(ofmsgs)
+
+    def reconcile(self, ofmsgs):
+        """Reply to a flow request on connect with the table's flows."""
+        requests = [
+            ofmsg for ofmsg in ofmsgs
+            if isinstance(ofmsg, parser.OFPFlowStatsRequest)]
+        self.assertEqual(1, len(requests))
+        request = requests[0]
+        request.xid = 1
+        flow_stats = self.table.flow_stats(request.cookie)
+        # Flows may be returned in more than one reply.
+        self.assertEqual([], self.valve.flow_stats_reply(
+            self.DP_ID, request.xid, flow_stats[:2], True))
+        return self.valve.flow_stats_reply(
+            self.DP_ID, request.xid, flow_stats[2:], False)
+
+    def restart(self, config):
+        """Connect a new Valve with a config, as if FAUCET restarted."""
+        dp = self.update_config(config)
+        self.valve = valve_factory(dp)(dp, 'test_valve')
+        self.connect_dp()
+
     def rcv_packet(self, port, vid, match):
         pkt = build_pkt(match)
         rcv_packet_ofmsgs = self.valve.rcv_packet(
@@ -145,7 +184,7 @@ vlans:
             valves={},
             in_port=port,
             vlan_vid=vid,
-            pkt=pkt
+            pkt_meta=parse_packet_in_pkt(pkt.data)
             )
         self.table.apply_ofmsgs(rcv_packet_ofmsgs)
 
@@ -154,6 +193,407 @@ vlans:
 
 
 class ValveTestCase(ValveTestBase):
+    def test_packet_in_header(self):
+        """Test Ethernet header fields are parsed without a full parse."""
+        pkt = build_pkt({
+            'eth_src': self.P2_V200_MAC,
+            'eth_dst': self.P3_V200_MAC,
+            'vid': 0x200
+            })
+        pkt_meta = parse_packet_in_pkt(pkt.data)
+        self.assertEqual(pkt_meta.eth_src, self.P2_V200_MAC)
+        self.assertEqual(pkt_meta.eth_dst, self.P3_V200_MAC)
+        self.assertEqual(pkt_meta.vid, 0x200)
+        self.assertEqual(pkt_meta.eth_type, ether.ETH_TYPE_IP)
+        self.assertEqual(
+            pkt_meta.get_protocol(ipv4.ipv4).src, '10.0.0.1')
+        untagged_pkt = build_pkt({
+            'eth_src': self.P1_V100_MAC,
+            'eth_dst': self.UNKNOWN_MAC,
+            })
+        self.assertIsNone(parse_packet_in_pkt(untagged_pkt.data).vid)
+        self.assertIsNone(parse_packet_in_pkt(untagged_pkt.data[:10]))
+
+    def test_packet_in_batch(self):
+        """Test batched packet ins are coalesced into one set of flows."""
+        self.valve.dp.packet_in_batch_size = 10
+        pkt = build_pkt({
+            'eth_src': self.UNKNOWN_MAC,
+            'eth_dst': self.P1_V100_MAC
+            })
+        for _ in range(3):
+            self.assertTrue(self.valve.batch_packet_in(
+                self.DP_ID, 1, 0x100, parse_packet_in_pkt(pkt.data)))
+        self.assertFalse(self.valve.packet_in_batch_full())
+        ofmsgs = self.valve.flush_packet_in_batch(self.DP_ID, {})
+        barriers = [
+            ofmsg for ofmsg in ofmsgs
+            if isinstance(ofmsg, parser.OFPBarrierRequest)]
+        self.assertEqual(1, len(barriers))
+        self.table.apply_ofmsgs(ofmsgs)
+        self.assertFalse(
+            self.table.is_output(
+                {'in_port': 1, 'vlan_vid': 0, 'eth_src': self.UNKNOWN_MAC},
+                port=ofp.OFPP_CONTROLLER),
+            msg='batched host not learned')
+        self.assertEqual(
+            [], self.valve.flush_packet_in_batch(self.DP_ID, {}))
+
+    def test_relearn_guard(self):
+        """Test a host is not relearned on the same port within guard time."""
+        host_manager = self.valve.host_manager
+        hits = host_manager.learn_cache_hits
+        misses = host_manager.learn_cache_misses
+        ofmsgs = self.valve.rcv_packet(
+            self.DP_ID, {}, 1, 0x100,
+            parse_packet_in_pkt(build_pkt({
+                'eth_src': self.P1_V100_MAC,
+                'eth_dst': self.UNKNOWN_MAC}).data))
+        self.assertEqual([], ofmsgs)
+        self.assertEqual(hits + 1, host_manager.learn_cache_hits)
+        self.assertEqual(misses, host_manager.learn_cache_misses)
+        # host moved, so must be relearned.
+        self.rcv_packet(2, 0x100, {
+            'eth_src': self.P1_V100_MAC,
+            'eth_dst': self.UNKNOWN_MAC,
+            'vid': 0x100
+            })
+        self.assertEqual(misses + 1, host_manager.learn_cache_misses)
+        self.assertEqual(
+            2, self.valve.dp.vlans[0x100].host_cache[self.P1_V100_MAC].port.number)
+
+    def test_packet_in_rate_limit(self):
+        """Test packet ins over a port's rate are not learned, then banned."""
+        port = self.valve.dp.ports[1]
+        port.packet_in_rate = 1
+        port.packet_in_burst = 1
+        self.valve.dp.packet_in_port_ban_time = 60
+        self.valve.packet_in_rate_limiter = (
+            valve_ratelimit.ValvePacketInRateLimiter(self.valve.dp))
+        host_cache = self.valve.dp.vlans[0x100].host_cache
+        self.rcv_packet(1, 0x100, {
+            'eth_src': self.UNKNOWN_MAC,
+            'eth_dst': self.P2_V200_MAC
+            })
+        self.assertTrue(self.UNKNOWN_MAC in host_cache)
+        limited_mac = '00:00:00:04:00:05'
+        self.rcv_packet(1, 0x100, {
+            'eth_src': limited_mac,
+            'eth_dst': self.P2_V200_MAC
+            })
+        self.assertFalse(limited_mac in host_cache)
+        self.assertFalse(
+            self.table.is_output(
+                {'in_port': 1, 'vlan_vid': 0, 'eth_src': limited_mac},
+                port=ofp.OFPP_CONTROLLER),
+            msg='packet ins not banned from port over rate')
+        self.assertEqual(
+            (1, 1), self.valve.packet_in_rate_limiter.stats()['ports'][1])
+        # other ports are not affected.
+        self.rcv_packet(3, 0x100, {
+            'eth_src': limited_mac,
+            'eth_dst': self.P2_V200_MAC,
+            'vid': 0x100
+            })
+        self.assertTrue(limited_mac in host_cache)
+
+    def test_packet_in_rate_limit_logged(self):
+        """Test packet ins dropped by rate limiting are logged."""
+        messages = []
+
+        class InfoHandler(logging.Handler):
+
+            def emit(self, record):
+                messages.append(record.getMessage())
+
+        handler = InfoHandler()
+        self.valve.logger.addHandler(handler)
+        level = self.valve.logger.level
+        self.valve.logger.setLevel(logging.INFO)
+        try:
+            port = self.valve.dp.ports[1]
+            port.packet_in_rate = 1
+            port.packet_in_burst = 1
+            self.valve.packet_in_rate_limiter = (
+                valve_ratelimit.ValvePacketInRateLimiter(self.valve.dp))
+            for eth_src in ('00:00:00:04:00:05', '00:00:00:04:00:06'):
+                self.rcv_packet(1, 0x100, {
+                    'eth_src': eth_src,
+                    'eth_dst': self.P2_V200_MAC
+                    })
+            self.valve.host_expire()
+            drop_messages = [
+                message for message in messages if 'rate limit' in message]
+            self.assertEqual(1, len(drop_messages))
+            self.assertIn('port 1: 1', drop_messages[0])
+            # Only logged again if more are dropped.
+            self.valve.host_expire()
+            self.assertEqual(
+                drop_messages,
+                [message for message in messages if 'rate limit' in message])
+        finally:
+            self.valve.logger.removeHandler(handler)
+            self.valve.logger.setLevel(level)
+
+    def test_default_packet_in_rate_limit(self):
+        """Test packet ins are rate limited per datapath by default."""
+        self.assertEqual(
+            self.valve.dp.packet_in_rate,
+            self.valve.packet_in_rate_limiter.dp_bucket.rate)
+
+    def test_edge_host_index(self):
+        """Test hosts learned on edge ports are indexed until expired."""
+        valves = {self.DP_ID: self.valve}
+        edge_host_index = self.valve.edge_host_index
+        self.assertEqual(
+            self.valve.dp,
+            edge_host_index.edge_dp(valves, 0x100, self.P1_V100_MAC))
+        self.assertIsNone(
+            edge_host_index.edge_dp(valves, 0x200, self.P1_V100_MAC))
+        vlan = self.valve.dp.vlans[0x100]
+        self.valve.host_manager.expire_hosts_from_vlan(
+            vlan, time.time() + self.valve.dp.timeout + 1)
+        self.assertIsNone(
+            edge_host_index.edge_dp(valves, 0x100, self.P1_V100_MAC))
+        # hosts forgotten without expiry are not found either.
+        self.assertIsNotNone(
+            edge_host_index.edge_dp(valves, 0x200, self.P2_V200_MAC))
+        self.valve.dp.vlans[0x200].host_cache = {}
+        self.assertIsNone(
+            edge_host_index.edge_dp(valves, 0x200, self.P2_V200_MAC))
+
+    def test_edge_host_index_many_dps(self):
+        """Test a host learned on edge ports of two DPs is found on either."""
+        edge_host_index = self.valve.edge_host_index
+        dp2 = self.update_config(self.CONFIG.replace("dp_id: 1", "dp_id: 2"))
+        valve2 = valve_factory(dp2)(
+            dp2, 'test_valve', edge_host_index=edge_host_index)
+        valve2.host_manager.learn_host_on_vlan_port(
+            dp2.ports[1], dp2.vlans[0x100], self.P1_V100_MAC)
+        valves = {self.DP_ID: self.valve, 2: valve2}
+        self.assertEqual(
+            self.valve.dp,
+            edge_host_index.edge_dp(valves, 0x100, self.P1_V100_MAC))
+        self.assertEqual(
+            dp2,
+            edge_host_index.edge_dp(
+                valves, 0x100, self.P1_V100_MAC, self.DP_ID))
+        # Once one DP expires the host, the other DP is still found.
+        self.valve.host_manager.expire_hosts_from_vlan(
+            self.valve.dp.vlans[0x100],
+            time.time() + self.valve.dp.timeout + 1)
+        self.assertEqual(
+            dp2, edge_host_index.edge_dp(valves, 0x100, self.P1_V100_MAC))
+        self.assertIsNone(
+            edge_host_index.edge_dp(valves, 0x100, self.P1_V100_MAC, 2))
+
+    def test_host_expire(self):
+        """Test hosts are expired only once due, and relearning postpones."""
+        host_manager = self.valve.host_manager
+        vlan = self.valve.dp.vlans[0x200]
+        learn_time = vlan.host_cache[self.P2_V200_MAC].cache_time
+        timeout = self.valve.dp.timeout
+        host_manager.expire_hosts_from_vlan(vlan, learn_time + timeout - 1)
+        self.assertEqual(2, len(vlan.host_cache))
+        self.assertEqual(2, len(host_manager.expiry_wheels[0x200]))
+        # relearned host must not expire at its original time.
+        vlan.host_cache[self.P3_V200_MAC].cache_time = learn_time + 10
+        host_manager.expire_hosts_from_vlan(
+            vlan, learn_time + timeout + self.valve.dp.host_expire_precision)
+        self.assertEqual([self.P3_V200_MAC], vlan.host_cache.keys())
+        host_manager.expire_hosts_from_vlan(vlan, learn_time + timeout + 11)
+        self.assertEqual({}, vlan.host_cache)
+        self.assertEqual(0, len(host_manager.expiry_wheels[0x200]))
+
+    def test_host_cache_entry_slots(self):
+        """Test host cache entries have only their own attributes."""
+        host_cache_entry = self.valve.dp.vlans[0x100].host_cache[
+            self.P1_V100_MAC]
+        self.assertIsInstance(host_cache_entry, valve_host.HostCacheEntry)
+        self.assertFalse(hasattr(host_cache_entry, '__dict__'))
+        with self.assertRaises(AttributeError):
+            host_cache_entry.unknown = True
+
+    def test_learned_mac_interned(self):
+        """Test one copy of a learned MAC is kept, however often learned."""
+        vlan = self.valve.dp.vlans[0x100]
+        host_manager = self.valve.host_manager
+        mac = ''.join(list(self.UNKNOWN_MAC))
+        self.assertIsNot(intern(self.UNKNOWN_MAC), mac)
+        host_manager.learn_host_on_vlan_port(
+            self.valve.dp.ports[1], vlan, mac)
+        # Relearned on another port, from a packet in.
+        self.rcv_packet(3, 0x100, {
+            'eth_src': self.UNKNOWN_MAC,
+            'eth_dst': self.P1_V100_MAC,
+            'vid': 0x100
+            })
+        self.assertEqual(3, vlan.host_cache[self.UNKNOWN_MAC].port.number)
+        interned_mac = intern(self.UNKNOWN_MAC)
+        for eth_src in vlan.host_cache:
+            if eth_src == self.UNKNOWN_MAC:
+                self.assertIs(interned_mac, eth_src)
+        self.assertIs(
+            interned_mac, vlan.host_cache[self.UNKNOWN_MAC].eth_src)
+        for eth_src in host_manager.expiry_wheels[0x100]._host_slot:
+            if eth_src == self.UNKNOWN_MAC:
+                self.assertIs(interned_mac, eth_src)
+
+    def test_match_cache_key(self):
+        """Test cached matches are keyed on every argument."""
+        dp = self.valve.dp
+        args = {
+            'table_id': dp.port_acl_table,
+            'in_port': 1,
+            'vlan': dp.vlans[0x100],
+            'eth_type': 0x800,
+            'eth_src': self.P1_V100_MAC,
+            'eth_dst': self.P2_V200_MAC,
+            'eth_dst_mask': 'ff:ff:ff:ff:ff:00',
+            'ipv6_nd_target': ipaddr.IPNetwork('fc00::1/64'),
+            'icmpv6_type': 135,
+            'nw_proto': 6,
+            'nw_src': ipaddr.IPNetwork('10.0.0.1/24'),
+            'nw_dst': ipaddr.IPNetwork('10.0.1.1/24'),
+            }
+        other_values = {
+            'table_id': dp.vlan_acl_table,
+            'in_port': 2,
+            'vlan': dp.vlans[0x200],
+            'eth_type': 0x806,
+            'eth_src': self.P3_V200_MAC,
+            'eth_dst': self.P3_V200_MAC,
+            'eth_dst_mask': 'ff:ff:ff:ff:ff:ff',
+            'ipv6_nd_target': ipaddr.IPNetwork('fc00::2/64'),
+            'icmpv6_type': 136,
+            'nw_proto': 17,
+            # Networks that differ only in their host bits.
+            'nw_src': ipaddr.IPNetwork('10.0.0.2/24'),
+            'nw_dst': ipaddr.IPNetwork('10.0.1.2/24'),
+            }
+        self.assertEqual(sorted(args.keys()), sorted(other_values.keys()))
+
+        def uncached_match(args):
+            match_args = dict(args)
+            del match_args['table_id']
+            return valve_of.match(valve_of.build_match_dict(**match_args))
+
+        match = self.valve.valve_in_match(**args)
+        self.assertIs(match, self.valve.valve_in_match(**args))
+        for arg, other_value in other_values.iteritems():
+            other_args = dict(args)
+            other_args[arg] = other_value
+            other_match = self.valve.valve_in_match(**other_args)
+            self.assertIsNot(match, other_match, msg=arg)
+            self.assertEqual(
+                uncached_match(other_args).to_jsondict(),
+                other_match.to_jsondict(), msg=arg)
+            self.assertIs(match, self.valve.valve_in_match(**args))
+
+    def test_match_cache_reload(self):
+        """Test cached matches are not used after a config reload."""
+        dp = self.valve.dp
+        match = self.valve.valve_in_match(
+            dp.eth_dst_table, vlan=dp.vlans[0x100], eth_dst=self.P1_V100_MAC)
+        new_dp = self.update_config(self.CONFIG.replace(
+            "        dp_id: 1\n", "        dp_id: 1\n        timeout: 77\n"))
+        self.table.apply_ofmsgs(self.valve.reload_config(new_dp))
+        new_match = self.valve.valve_in_match(
+            new_dp.eth_dst_table, vlan=new_dp.vlans[0x100],
+            eth_dst=self.P1_V100_MAC)
+        self.assertIsNot(match, new_match)
+        self.assertEqual(match.to_jsondict(), new_match.to_jsondict())
+
+    def test_shared_actions_unchanged(self):
+        """Test shared instructions and actions are not changed by use."""
+        # Flows using the shared objects were sent by setUp(); send them
+        # to a datapath as well.
+        ofmsgs = self.valve.datapath_connect(
+            self.DP_ID, range(1, self.NUM_PORTS + 1))
+        ofmsgs.extend(self.valve.host_manager.learn_host_on_vlan_port(
+            self.valve.dp.ports[3], self.valve.dp.vlans[0x100],
+            self.UNKNOWN_MAC))
+        faucet = Faucet.__new__(Faucet)
+        faucet.logger = logging.getLogger('test_valve.faucet')
+        faucet.valves = {self.DP_ID: self.valve}
+        faucet._send_flow_msgs(FakeDatapath(self.DP_ID), ofmsgs)
+        self.assertTrue(valve_of._GOTO_TABLE_INSTS)
+        for table_id, inst in valve_of._GOTO_TABLE_INSTS.iteritems():
+            self.assertEqual(
+                parser.OFPInstructionGotoTable(table_id).to_jsondict(),
+                inst.to_jsondict())
+        self.assertEqual(
+            parser.OFPActionPopVlan().to_jsondict(),
+            valve_of.pop_vlan().to_jsondict())
+        self.assertEqual(
+            parser.OFPActionOutput(
+                ofp.OFPP_CONTROLLER, max_len=256).to_jsondict(),
+            valve_of.output_controller().to_jsondict())
+
+    def test_reload_host_timeout(self):
+        """Test hosts are learned with the timeout of a reloaded config."""
+        new_dp = self.update_config(self.CONFIG.replace(
+            "        dp_id: 1\n", "        dp_id: 1\n        timeout: 77\n"))
+        self.table.apply_ofmsgs(self.valve.reload_config(new_dp))
+        ofmsgs = self.valve.host_manager.learn_host_on_vlan_port(
+            new_dp.ports[3], new_dp.vlans[0x100], self.UNKNOWN_MAC)
+        learn_timeouts = [
+            (ofmsg.table_id, ofmsg.hard_timeout, ofmsg.idle_timeout)
+            for ofmsg in ofmsgs if valve_of.is_flowadd(ofmsg)]
+        self.assertEqual(
+            [(new_dp.eth_src_table, 77, 0), (new_dp.eth_dst_table, 0, 77)],
+            learn_timeouts)
+        # Hosts kept across the reload expire with the new timeout.
+        vlan = new_dp.vlans[0x200]
+        learn_time = vlan.host_cache[self.P2_V200_MAC].cache_time
+        self.valve.host_manager.expire_hosts_from_vlan(
+            vlan, learn_time + 77 + new_dp.host_expire_precision)
+        self.assertNotIn(self.P2_V200_MAC, vlan.host_cache)
+
+    def test_learn_flowmod_templates(self):
+        """Test templated learn flowmods serialize as ryu would."""
+        ofmsgs = self.valve.host_manager.learn_host_on_vlan_port(
+            self.valve.dp.ports[3], self.valve.dp.vlans[0x100],
+            self.UNKNOWN_MAC)
+        templated_flowmods = [
+            ofmsg for ofmsg in ofmsgs
+            if isinstance(ofmsg, valve_of.TemplatedFlowMod)]
+        self.assertEqual(2, len(templated_flowmods))
+        null_dp = valve_of._NullDatapath
+        for xid, templated_flowmod in enumerate(templated_flowmods, start=1):
+            flowmod = templated_flowmod.template.build_flowmod(
+                **templated_flowmod.template_fields)
+            for ofmsg in (templated_flowmod, flowmod):
+                ofmsg.datapath = null_dp
+                ofmsg.xid = xid
+                ofmsg.serialize()
+            self.assertEqual(flowmod.buf, templated_flowmod.buf)
+
+    def test_learn_flowmod_templates_reload(self):
+        """Test templated learn flowmods serialize the reloaded config."""
+        new_dp = self.update_config(self.CONFIG.replace(
+            "        dp_id: 1\n", "        dp_id: 1\n        cookie: 1234\n"))
+        self.table.apply_ofmsgs(self.valve.reload_config(new_dp))
+        ofmsgs = self.valve.host_manager.learn_host_on_vlan_port(
+            new_dp.ports[3], new_dp.vlans[0x100], self.UNKNOWN_MAC)
+        templated_flowmods = [
+            ofmsg for ofmsg in ofmsgs
+            if isinstance(ofmsg, valve_of.TemplatedFlowMod)]
+        self.assertEqual(2, len(templated_flowmods))
+        for templated_flowmod in templated_flowmods:
+            # Sending a templated flowmod does not build its match.
+            self.assertIsNone(templated_flowmod._flowmod)
+            buf = valve_of.serialize_offline(templated_flowmod)
+            self.assertIsNone(templated_flowmod._flowmod)
+            self.assertEqual(1234, templated_flowmod.cookie)
+            flowmod = valve_of.flowmod(
+                1234, ofp.OFPFC_ADD, templated_flowmod.table_id,
+                templated_flowmod.priority, 0, 0,
+                templated_flowmod.match, templated_flowmod.instructions,
+                templated_flowmod.hard_timeout,
+                templated_flowmod.idle_timeout)
+            self.assertEqual(valve_of.serialize_offline(flowmod), buf)
+
     def test_invalid_vlan(self):
         """Test that packets with incorrect vlan tagging get dropped."""
 
@@ -429,6 +869,75 @@ class ValveTestCase(ValveTestBase):
                     msg="packet ({0}) with eth dst learnt on deleted port not output "
                         "correctly on vlan {1} to port {2}".format(match, vlan.vid, p.number))
 
+    def test_unicast_flood_disabled(self):
+        """Test unknown unicast is not flooded to or from a port without
+        unicast flooding."""
+        self.table = FakeOFTable(self.NUM_TABLES)
+        dp = self.update_config(self.CONFIG.replace(
+            "                native_vlan: v100\n",
+            "                native_vlan: v100\n"
+            "                unicast_flood: False\n"))
+        self.valve = valve_factory(dp)(dp, 'test_valve')
+        self.connect_dp()
+        self.assertFalse(
+            self.table.is_output(
+                {'in_port': 1, 'vlan_vid': 0,
+                 'eth_src': self.P1_V100_MAC, 'eth_dst': self.UNKNOWN_MAC},
+                port=3),
+            msg='unknown unicast flooded from port without unicast flooding')
+        self.assertFalse(
+            self.table.is_output(
+                {'in_port': 3, 'vlan_vid': self.V100,
+                 'eth_dst': self.UNKNOWN_MAC},
+                port=1),
+            msg='unknown unicast flooded to port without unicast flooding')
+        self.assertTrue(
+            self.table.is_output(
+                {'in_port': 3, 'vlan_vid': self.V100,
+                 'eth_dst': self.UNKNOWN_MAC},
+                port=2, vid=self.V100))
+        self.assertTrue(
+            self.table.is_output(
+                {'in_port': 1, 'vlan_vid': 0,
+                 'eth_src': self.P1_V100_MAC,
+                 'eth_dst': 'ff:ff:ff:ff:ff:ff'},
+                port=3, vid=self.V100),
+            msg='broadcast not flooded from port without unicast flooding')
+
+    def test_port_flap_flood_changes(self):
+        """Test a port flapping changes only flood flows that need to."""
+        flood_table = self.valve.dp.flood_table
+
+        def flood_flowmods(ofmsgs):
+            return [
+                ofmsg for ofmsg in ofmsgs
+                if isinstance(ofmsg, parser.OFPFlowMod) and
+                ofmsg.table_id == flood_table and
+                not valve_of.is_flowdel(ofmsg)]
+
+        ofmsgs = self.valve.port_delete(dp_id=self.DP_ID, port_num=1)
+        for flowmod in flood_flowmods(ofmsgs):
+            self.assertEqual(self.V100, flowmod.match['vlan_vid'])
+            self.assertEqual(ofp.OFPFC_MODIFY_STRICT, flowmod.command)
+        self.table.apply_ofmsgs(ofmsgs)
+        self.assertEqual([], flood_flowmods(
+            self.valve.port_delete(dp_id=self.DP_ID, port_num=1)))
+        ofmsgs = self.valve.port_add(dp_id=self.DP_ID, port_num=1)
+        for flowmod in flood_flowmods(ofmsgs):
+            self.assertEqual(self.V100, flowmod.match['vlan_vid'])
+        self.table.apply_ofmsgs(ofmsgs)
+        # Port 5 is in no VLAN.
+        self.assertEqual([], flood_flowmods(
+            self.valve.port_delete(dp_id=self.DP_ID, port_num=5)))
+        self.assertTrue(
+            self.table.is_output(
+                {'in_port': 2, 'vlan_vid': self.V100}, port=1, vid=0),
+            msg='packet not flooded to port after port flap')
+        self.assertTrue(
+            self.table.is_output(
+                {'in_port': 1, 'vlan_vid': 0}, port=2, vid=self.V100),
+            msg='packet not flooded from port after port flap')
+
     def test_port_down_eth_src_removal(self):
         '''Test that when a port goes down and comes back up learnt mac
         addresses are deleted.'''
@@ -474,7 +983,6 @@ class ValveTestCase(ValveTestBase):
 version: 2
 dps:
     s1:
-        ignore_learn_ins: 0
         hardware: 'Open vSwitch'
         dp_id: 1
         interfaces:
@@ -551,7 +1059,6 @@ class ValveACLTestCase(ValveTestBase):
 version: 2
 dps:
     s1:
-        ignore_learn_ins: 0
         hardware: 'Open vSwitch'
         dp_id: 1
         interfaces:
@@ -622,6 +1129,515 @@ acls:
             msg='packet not allowed by acl'
             )
 
+    def test_reload_keeps_learned_hosts(self):
+        """Test reloading with an ACL change leaves learned hosts alone."""
+        acl_config = self.CONFIG.replace(
+            "        vid: 0x200\n",
+            "        vid: 0x200\n        acl_in: drop_ipv4\n") + '''
+acls:
+    drop_ipv4:
+        - rule:
+            dl_type: 0x800
+            actions:
+                allow: 0
+        - rule:
+            actions:
+                allow: 1
+'''
+        host_match = {
+            'in_port': 4,
+            'vlan_vid': self.V200,
+            'eth_src': self.UNKNOWN_MAC,
+            'eth_dst': self.P3_V200_MAC,
+            'eth_type': 0x806
+            }
+        self.assertTrue(self.table.is_output(host_match, port=3))
+        new_dp = self.update_config(acl_config)
+        ofmsgs = self.valve.reload_config(new_dp)
+        self.assertFalse([
+            ofmsg for ofmsg in ofmsgs
+            if valve_of.is_flowdel(ofmsg) and ofmsg.table_id in (
+                new_dp.eth_src_table, new_dp.eth_dst_table)])
+        self.table.apply_ofmsgs(ofmsgs)
+        self.assertTrue(
+            self.table.is_output(host_match, port=3),
+            msg='learned host flows not kept on reload')
+        self.assertTrue(self.P3_V200_MAC in new_dp.vlans[0x200].host_cache)
+        self.assertFalse(
+            self.table.is_output(
+                dict(host_match, eth_type=0x800), port=3),
+            msg='packet not blocked by acl')
+        self.assertEqual([], self.valve.reload_config(
+            self.update_config(acl_config)))
+
+class ValveRouteTestCase(ValveTestBase):
+    """Test IPv4 routing."""
+
+    CONFIG = """
+version: 2
+dps:
+    s1:
+        hardware: 'Open vSwitch'
+        dp_id: 1
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: v100
+            p2:
+                number: 2
+                native_vlan: v200
+                tagged_vlans: [v100]
+            p3:
+                number: 3
+                tagged_vlans: [v100, v200]
+            p4:
+                number: 4
+                tagged_vlans: [v200]
+            p5:
+                number: 5
+vlans:
+    v100:
+        vid: 0x100
+        controller_ips: ['10.0.0.254/24']
+        routes:
+            - route:
+                ip_dst: '10.0.1.0/24'
+                ip_gw: '10.0.0.1'
+            - route:
+                ip_dst: '10.0.2.0/24'
+                ip_gw: '10.0.0.1'
+            - route:
+                ip_dst: '10.0.3.0/24'
+                ip_gw: '10.0.0.2'
+    v200:
+        vid: 0x200
+"""
+    GW1 = ipaddr.IPAddress('10.0.0.1')
+    GW2 = ipaddr.IPAddress('10.0.0.2')
+    DST1 = ipaddr.IPNetwork('10.0.1.0/24')
+    DST2 = ipaddr.IPNetwork('10.0.2.0/24')
+    DST3 = ipaddr.IPNetwork('10.0.3.0/24')
+    # Host route learned from the packets in setUp, sent from GW1.
+    GW1_HOST = ipaddr.IPNetwork('10.0.0.1/32')
+
+    def resolved_arp_targets(self, now=None):
+        """Return IPs resolved for with ARP requests by resolve_gateways."""
+        if now is None:
+            now = time.time()
+        targets = set()
+        vlan = self.valve.dp.vlans[0x100]
+        for ofmsg in self.valve.ipv4_route_manager.resolve_gateways(vlan, now):
+            if isinstance(ofmsg, parser.OFPPacketOut):
+                arp_pkt = packet.Packet(ofmsg.data).get_protocol(arp.arp)
+                targets.add(ipaddr.IPAddress(arp_pkt.dst_ip))
+        return targets
+
+    def fib_route_dsts(self):
+        """Return destinations of routes with flows in the IPv4 FIB."""
+        route_dsts = set()
+        for fte in self.table.tables[self.valve.dp.ipv4_fib_table]:
+            ipv4_dst = fte.match.get('ipv4_dst', None)
+            if ipv4_dst is not None and fte.match.get('ip_proto', None) is None:
+                route_dsts.add(ipaddr.IPNetwork('/'.join(ipv4_dst)))
+        return route_dsts
+
+    def arp_reply_ofmsgs(self, port, eth_src, ip_src):
+        """Receive an ARP reply to FAUCET on VLAN 0x100, applying changes."""
+        pkt = build_pkt({
+            'eth_src': eth_src,
+            'eth_dst': self.valve.FAUCET_MAC,
+            'arp_code': arp.ARP_REPLY,
+            'arp_source_ip': ip_src,
+            'arp_target_ip': '10.0.0.254'})
+        ofmsgs = self.valve.rcv_packet(
+            dp_id=1, valves={}, in_port=port, vlan_vid=0x100,
+            pkt_meta=parse_packet_in_pkt(pkt.data))
+        self.table.apply_ofmsgs(ofmsgs)
+        return ofmsgs
+
+    def rcv_arp_reply(self, port, eth_src, ip_src):
+        """Receive an ARP reply to FAUCET on VLAN 0x100, returning flows."""
+        return [
+            ofmsg for ofmsg in self.arp_reply_ofmsgs(port, eth_src, ip_src)
+            if isinstance(ofmsg, parser.OFPFlowMod) and
+            ofmsg.table_id == self.valve.dp.ipv4_fib_table]
+
+    def test_resolve_backoff(self):
+        """Test a nexthop not replying is resolved less often, until it does."""
+        now = time.time()
+        max_backoff = self.valve.dp.max_resolve_backoff_time
+        self.rcv_arp_reply(1, self.P1_V100_MAC, str(self.GW1))
+        self.assertEqual(set([self.GW2]), self.resolved_arp_targets(now))
+        self.assertEqual(set(), self.resolved_arp_targets(now + 0.5))
+        resolve_times = []
+        while now < time.time() + 10 * max_backoff:
+            if self.GW2 in self.resolved_arp_targets(now):
+                resolve_times.append(now)
+            now += 0.5
+        backoffs = [
+            resolve_time - last_resolve_time for last_resolve_time, resolve_time
+            in zip(resolve_times, resolve_times[1:])]
+        self.assertTrue(backoffs[0] < backoffs[-1])
+        self.assertTrue(max(backoffs) <= max_backoff + 0.5)
+        # Once resolved, the nexthop is not resolved until stale.
+        self.rcv_arp_reply(1, self.P2_V200_MAC, str(self.GW2))
+        self.assertEqual(set(), self.resolved_arp_targets(now + max_backoff))
+        self.assertIn(
+            self.GW2, self.resolved_arp_targets(
+                time.time() + self.valve.dp.arp_neighbor_timeout + 1))
+
+    def test_resolve_cycle(self):
+        """Test nexthops are resolved over several cycles if limited."""
+        self.valve.ipv4_route_manager.max_hosts_per_resolve_cycle = 1
+        now = time.time()
+        first_targets = self.resolved_arp_targets(now)
+        self.assertEqual(1, len(first_targets))
+        second_targets = self.resolved_arp_targets(now)
+        self.assertEqual(1, len(second_targets))
+        self.assertEqual(
+            set([self.GW1, self.GW2]), first_targets.union(second_targets))
+        self.assertEqual(set(), self.resolved_arp_targets(now))
+
+    def test_nexthop_index(self):
+        """Test routes are indexed by nexthop as they change."""
+        vlan = self.valve.dp.vlans[0x100]
+        self.assertEqual(
+            {self.GW1: set([self.DST1, self.DST2, self.GW1_HOST]),
+             self.GW2: set([self.DST3])},
+            vlan.ipv4_nexthops)
+        self.valve.add_route(vlan, self.GW2, self.DST1)
+        self.valve.del_route(vlan, self.DST3)
+        self.valve.del_route(vlan, self.DST3)
+        self.assertEqual(
+            {self.GW1: set([self.DST2, self.GW1_HOST]),
+             self.GW2: set([self.DST1])},
+            vlan.ipv4_nexthops)
+        self.assertEqual(
+            {self.DST1: self.GW2, self.DST2: self.GW1,
+             self.GW1_HOST: self.GW1},
+            vlan.ipv4_routes)
+
+    def test_resolve_nexthop(self):
+        """Test routes via a nexthop are added when it is resolved."""
+        self.assertEqual(
+            set([self.GW1, self.GW2]), self.resolved_arp_targets())
+        fib_flowmods = self.rcv_arp_reply(1, self.P1_V100_MAC, str(self.GW1))
+        self.assertEqual(
+            set([self.DST1, self.DST2, self.GW1_HOST]),
+            set([ipaddr.IPNetwork('/'.join(flowmod.match['ipv4_dst']))
+                 for flowmod in fib_flowmods]))
+        self.assertTrue(
+            self.table.is_output(
+                {'in_port': 3, 'vlan_vid': self.V100,
+                 'eth_src': self.P2_V200_MAC,
+                 'eth_dst': self.valve.FAUCET_MAC,
+                 'eth_type': 0x800, 'ipv4_dst': '10.0.2.1'},
+                port=1, vid=0),
+            msg='routed packet not output to resolved nexthop')
+        # Only the nexthop not yet resolved is resolved again.
+        self.assertEqual(
+            set([self.GW2]),
+            self.resolved_arp_targets(
+                time.time() + self.valve.dp.max_resolve_backoff_time))
+        # An unchanged nexthop needs no flows changed.
+        self.assertEqual(
+            [], self.rcv_arp_reply(1, self.P1_V100_MAC, str(self.GW1)))
+        # A new route via a resolved nexthop is added immediately.
+        dst4 = ipaddr.IPNetwork('10.0.4.0/24')
+        self.assertEqual(1, len(self.valve.add_route(
+            self.valve.dp.vlans[0x100], self.GW1, dst4)))
+
+    def test_del_covering_route(self):
+        """Test deleting a route leaves flows for routes it covers."""
+        vlan = self.valve.dp.vlans[0x100]
+        covering = ipaddr.IPNetwork('10.0.0.0/16')
+        self.rcv_arp_reply(1, self.P1_V100_MAC, str(self.GW1))
+        self.table.apply_ofmsgs(self.valve.add_route(vlan, self.GW1, covering))
+        self.table.apply_ofmsgs(self.valve.del_route(vlan, covering))
+        self.assertEqual(
+            set([self.DST1, self.DST2, self.GW1_HOST]), self.fib_route_dsts())
+
+    def test_reload_keeps_routes(self):
+        """Test routes are kept on reload, and can then be withdrawn."""
+        vlan = self.valve.dp.vlans[0x100]
+        bgp_route = ipaddr.IPNetwork('10.9.0.0/16')
+        self.rcv_arp_reply(1, self.P1_V100_MAC, str(self.GW1))
+        self.table.apply_ofmsgs(self.valve.add_route(vlan, self.GW1, bgp_route))
+        self.assertIn(bgp_route, self.fib_route_dsts())
+        new_dp = self.update_config(self.CONFIG.replace(
+            "                number: 5\n",
+            "                number: 5\n                native_vlan: v200\n"))
+        self.table.apply_ofmsgs(self.valve.reload_config(new_dp))
+        vlan = new_dp.vlans[0x100]
+        for ip_dst in (bgp_route, self.GW1_HOST, self.DST1):
+            self.assertEqual(self.GW1, vlan.ipv4_routes.get(ip_dst, None))
+        self.assertIn(bgp_route, self.fib_route_dsts())
+        self.table.apply_ofmsgs(self.valve.del_route(vlan, bgp_route))
+        self.assertNotIn(bgp_route, self.fib_route_dsts())
+        self.assertIn(self.DST1, self.fib_route_dsts())
+
+    def test_rib_lookups(self):
+        """Test routes covering and covered by a network are found."""
+        routes = self.valve.dp.vlans[0x100].ipv4_routes
+        covering = ipaddr.IPNetwork('10.0.0.0/16')
+        self.assertEqual(
+            (self.DST2, self.GW1),
+            routes.longest_match(ipaddr.IPAddress('10.0.2.1')))
+        self.assertIsNone(routes.longest_match(ipaddr.IPAddress('10.1.0.1')))
+        self.assertIsNone(routes.covering_route(self.DST1))
+        routes[covering] = self.GW2
+        self.assertEqual((covering, self.GW2), routes.covering_route(self.DST1))
+        self.assertEqual(
+            set([self.DST1, self.DST2, self.DST3, self.GW1_HOST]),
+            set(routes.covered_routes(covering)))
+        self.assertEqual(
+            [covering], routes.covered_routes(ipaddr.IPNetwork('10.0.0.0/8')))
+        del routes[covering]
+        self.assertIsNone(routes.covering_route(self.DST1))
+        self.assertEqual(
+            set([self.DST1, self.DST2, self.DST3, self.GW1_HOST]),
+            set(routes))
+
+
+class ValveFIBAggregationTestCase(ValveRouteTestCase):
+    """Repeats the routing tests with FIB aggregation."""
+
+    CONFIG = ValveRouteTestCase.CONFIG.replace(
+        "dp_id: 1\n", "dp_id: 1\n        fib_aggregation: True\n")
+
+    def test_aggregated_routes(self):
+        """Test routes via the same nexthop as their covering route."""
+        vlan = self.valve.dp.vlans[0x100]
+        covering = ipaddr.IPNetwork('10.0.0.0/16')
+        self.rcv_arp_reply(1, self.P1_V100_MAC, str(self.GW1))
+        self.table.apply_ofmsgs(self.valve.add_route(vlan, self.GW1, covering))
+        self.assertEqual(set([covering]), self.fib_route_dsts())
+        self.assertEqual(3, self.valve.fib_flows_saved())
+        self.assertTrue(
+            self.table.is_output(
+                {'in_port': 3, 'vlan_vid': self.V100,
+                 'eth_src': self.P2_V200_MAC,
+                 'eth_dst': self.valve.FAUCET_MAC,
+                 'eth_type': 0x800, 'ipv4_dst': '10.0.2.1'},
+                port=1, vid=0),
+            msg='aggregated route not output to nexthop')
+        # A covered route via another nexthop needs its own flow.
+        self.rcv_arp_reply(2, self.P2_V200_MAC, str(self.GW2))
+        self.assertEqual(set([covering, self.DST3]), self.fib_route_dsts())
+        # Once the covering route is withdrawn, aggregated routes need flows.
+        self.table.apply_ofmsgs(self.valve.del_route(vlan, covering))
+        self.assertEqual(
+            set([self.DST1, self.DST2, self.DST3, self.GW1_HOST]),
+            self.fib_route_dsts())
+        self.assertEqual(0, self.valve.fib_flows_saved())
+
+
+class ValveGroupRouteTestCase(ValveRouteTestCase):
+    """Repeats the routing tests with a group per nexthop."""
+
+    CONFIG = ValveRouteTestCase.CONFIG.replace(
+        "dp_id: 1\n", "dp_id: 1\n        group_table_routing: True\n")
+
+    def test_nexthop_moved(self):
+        """Test a nexthop moving changes only its group."""
+        self.rcv_arp_reply(1, self.P1_V100_MAC, str(self.GW1))
+        ofmsgs = self.arp_reply_ofmsgs(3, self.P3_V200_MAC, str(self.GW1))
+        self.assertEqual(
+            [ofp.OFPGC_MODIFY],
+            [ofmsg.command for ofmsg in ofmsgs
+             if isinstance(ofmsg, parser.OFPGroupMod)])
+        self.assertFalse([
+            ofmsg for ofmsg in ofmsgs
+            if isinstance(ofmsg, parser.OFPFlowMod) and
+            ofmsg.table_id == self.valve.dp.ipv4_fib_table])
+        self.assertTrue(
+            self.table.is_output(
+                {'in_port': 1, 'vlan_vid': 0,
+                 'eth_src': self.P1_V100_MAC,
+                 'eth_dst': self.valve.FAUCET_MAC,
+                 'eth_type': 0x800, 'ipv4_dst': '10.0.2.1'},
+                port=3, vid=self.V100),
+            msg='routed packet not output to moved nexthop')
+
+    def test_nexthop_host_moved(self):
+        """Test a nexthop's group follows its MAC being relearned."""
+        routed_match = {
+            'in_port': 2, 'vlan_vid': self.V100,
+            'eth_src': self.P2_V200_MAC,
+            'eth_dst': self.valve.FAUCET_MAC,
+            'eth_type': 0x800, 'ipv4_dst': '10.0.2.1'}
+        self.rcv_arp_reply(1, self.P1_V100_MAC, str(self.GW1))
+        self.assertTrue(self.table.is_output(routed_match, port=1, vid=0))
+        self.rcv_packet(3, 0x100, {
+            'eth_src': self.P1_V100_MAC,
+            'eth_dst': self.UNKNOWN_MAC,
+            'vid': 0x100})
+        self.assertTrue(
+            self.table.is_output(routed_match, port=3, vid=self.V100),
+            msg='routed packet not output to relearned nexthop')
+        self.assertFalse(self.table.is_output(routed_match, port=1))
+
+    def nexthop_group_output_actions(self, vlan, eth_dst, port_num):
+        """Return the output actions of a nexthop group, and check they
+        are those of the eth_dst flow for a host learned on the port."""
+        ip_gw = ipaddr.IPAddress('10.0.0.99')
+        groupmods = self.valve.ipv4_route_manager._update_nexthop_group(
+            vlan, ip_gw, eth_dst, port_num)
+        self.assertEqual(1, len(groupmods))
+        # After rewriting the Ethernet addresses and decrementing the TTL.
+        group_actions = groupmods[0].buckets[0].actions[3:]
+        _, dst_flowmod = self.valve.host_manager.host_learn_flows(
+            self.valve.dp.ports[port_num], vlan, eth_dst, 0)
+        self.assertEqual(
+            str(dst_flowmod.instructions[0].actions), str(group_actions))
+        return group_actions
+
+    def test_nexthop_mirrored_port(self):
+        """Test routed packets to a nexthop on a mirrored port are mirrored."""
+        dp = self.update_config(self.CONFIG.replace(
+            "                number: 1\n"
+            "                native_vlan: v100\n",
+            "                number: 1\n"
+            "                native_vlan: v100\n"
+            "                mirror: 5\n"))
+        self.valve = valve_factory(dp)(dp, 'test_valve')
+        self.table = FakeOFTable(self.NUM_TABLES)
+        self.connect_dp()
+        vlan = self.valve.dp.vlans[0x100]
+        self.assertEqual(
+            [ofp.OFPAT_POP_VLAN, ofp.OFPAT_OUTPUT, ofp.OFPAT_OUTPUT],
+            [action.type for action in self.nexthop_group_output_actions(
+                vlan, self.P1_V100_MAC, 1)])
+        self.rcv_arp_reply(1, self.P1_V100_MAC, str(self.GW1))
+        routed_match = {
+            'in_port': 3, 'vlan_vid': self.V100,
+            'eth_src': self.P2_V200_MAC,
+            'eth_dst': self.valve.FAUCET_MAC,
+            'eth_type': 0x800, 'ipv4_dst': '10.0.2.1'}
+        self.assertTrue(self.table.is_output(routed_match, port=1, vid=0))
+        self.assertTrue(
+            self.table.is_output(routed_match, port=5),
+            msg='routed packet not mirrored')
+
+    def test_nexthop_stack_port(self):
+        """Test routed packets to a nexthop via a stack port stay tagged."""
+        with open(self.config_file, 'w') as config_file:
+            config_file.write("""
+version: 2
+dps:
+    s1:
+        dp_id: 1
+        group_table_routing: True
+        stack:
+            priority: 1
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: v100
+            p2:
+                number: 2
+                stack:
+                    dp: s2
+                    port: 1
+    s2:
+        dp_id: 2
+        interfaces:
+            p1:
+                number: 1
+                stack:
+                    dp: s1
+                    port: 2
+            p2:
+                number: 2
+                native_vlan: v100
+vlans:
+    v100:
+        vid: 0x100
+""")
+        _, dps = dp_parser(self.config_file, 'test_valve')
+        dp = [dp for dp in dps if dp.dp_id == 1][0]
+        self.valve = valve_factory(dp)(dp, 'test_valve')
+        vlan = self.valve.dp.vlans[0x100]
+        self.assertEqual(
+            [ofp.OFPAT_OUTPUT],
+            [action.type for action in self.nexthop_group_output_actions(
+                vlan, self.P2_V200_MAC, 2)])
+        self.assertEqual(
+            [ofp.OFPAT_POP_VLAN, ofp.OFPAT_OUTPUT],
+            [action.type for action in self.nexthop_group_output_actions(
+                vlan, self.P1_V100_MAC, 1)])
+
+    def test_unused_nexthop_group_deleted(self):
+        """Test a nexthop's group is deleted with its last route."""
+        vlan = self.valve.dp.vlans[0x100]
+        self.rcv_arp_reply(1, self.P1_V100_MAC, str(self.GW1))
+        group_id = self.valve.nexthop_groups.group_id(0x100, self.GW1)
+        self.assertIn(group_id, self.table.groups)
+        self.table.apply_ofmsgs(self.valve.del_route(vlan, self.DST1))
+        self.table.apply_ofmsgs(self.valve.del_route(vlan, self.DST2))
+        self.assertIn(group_id, self.table.groups)
+        self.table.apply_ofmsgs(self.valve.del_route(vlan, self.GW1_HOST))
+        self.assertNotIn(group_id, self.table.groups)
+        # The nexthop is resolved again, once used by a route.
+        self.assertEqual([], self.valve.add_route(vlan, self.GW1, self.DST1))
+        self.assertIn(self.GW1, self.resolved_arp_targets())
+
+
+class ValveRouteUpdateQueueTestCase(ValveRouteTestCase):
+    """Test route updates queued to be programmed in batches."""
+
+    CONFIG = ValveRouteTestCase.CONFIG.replace(
+        "dp_id: 1\n",
+        "dp_id: 1\n        route_update_interval: 1\n"
+        "        route_update_max_flowmods: 2\n")
+
+    def test_route_updates_coalesced(self):
+        """Test updates to the same prefix are coalesced."""
+        vlan = self.valve.dp.vlans[0x100]
+        dst4 = ipaddr.IPNetwork('10.0.4.0/24')
+        # An add then a withdraw of a new route cancel out.
+        self.assertTrue(self.valve.queue_route_update(vlan, self.GW1, dst4))
+        self.assertTrue(self.valve.queue_route_update(vlan, None, dst4))
+        self.assertEqual(0, self.valve.route_update_queue_depth())
+        # As do a withdraw and an add of an existing route.
+        self.valve.queue_route_update(vlan, None, self.DST3)
+        self.valve.queue_route_update(vlan, self.GW2, self.DST3)
+        self.assertEqual(0, self.valve.route_update_queue_depth())
+        # Otherwise, the most recent update to a prefix is kept.
+        self.valve.queue_route_update(vlan, self.GW1, dst4)
+        self.valve.queue_route_update(vlan, self.GW2, dst4)
+        self.valve.queue_route_update(vlan, None, self.DST1)
+        self.assertEqual(2, self.valve.route_update_queue_depth())
+        self.assertNotIn(dst4, vlan.ipv4_routes)
+        self.table.apply_ofmsgs(self.valve.flush_route_updates())
+        self.assertEqual(0, self.valve.route_update_queue_depth())
+        self.assertEqual(self.GW2, vlan.ipv4_routes[dst4])
+        self.assertNotIn(self.DST1, vlan.ipv4_routes)
+        self.assertIsNotNone(self.valve.route_update_convergence_time)
+
+    def test_route_update_batches(self):
+        """Test queued route updates are programmed in limited batches."""
+        vlan = self.valve.dp.vlans[0x100]
+        self.rcv_arp_reply(1, self.P1_V100_MAC, str(self.GW1))
+        for i in range(4, 9):
+            self.valve.queue_route_update(
+                vlan, self.GW1, ipaddr.IPNetwork('10.0.%u.0/24' % i))
+        batches = []
+        while self.valve.route_update_queue_depth():
+            ofmsgs = self.valve.flush_route_updates()
+            self.table.apply_ofmsgs(ofmsgs)
+            batches.append(len(ofmsgs))
+        self.assertEqual([2, 2, 1], batches)
+        self.assertTrue(
+            self.table.is_output(
+                {'in_port': 3, 'vlan_vid': self.V100,
+                 'eth_src': self.P2_V200_MAC,
+                 'eth_dst': self.valve.FAUCET_MAC,
+                 'eth_type': 0x800, 'ipv4_dst': '10.0.8.1'},
+                port=1, vid=0),
+            msg='queued route not programmed')
+
+
 class ValveReloadConfigTestCase(ValveTestCase):
     '''Repeats the tests after a config reload'''
 
@@ -629,7 +1645,6 @@ class ValveReloadConfigTestCase(ValveTestCase):
 version: 2
 dps:
     s1:
-        ignore_learn_ins: 0
         hardware: 'Open vSwitch'
         dp_id: 1
         interfaces:
@@ -662,11 +1677,7 @@ vlans:
         self.valve = valve_factory(dp)(dp, 'test_valve')
 
         # establish connection to datapath
-        ofmsgs = self.valve.datapath_connect(
-            self.DP_ID,
-            range(1, self.NUM_PORTS + 1)
-            )
-        self.table.apply_ofmsgs(ofmsgs)
+        self.connect_dp()
 
         # learn some mac addresses
         self.rcv_packet(1, 0x100, {
@@ -706,5 +1717,304 @@ vlans:
             })
 
 
+class ValveReconcileTestCase(ValveTestCase):
+    """Repeats the tests with flows reconciled on connect."""
+
+    CONFIG = ValveTestCase.CONFIG.replace(
+        "        dp_id: 1\n",
+        "        dp_id: 1\n        reconcile_flows: True\n")
+
+    def connect_dp(self):
+        ofmsgs = self.valve.datapath_connect(
+            self.DP_ID,
+            range(1, self.NUM_PORTS + 1)
+            )
+        self.table.apply_ofmsgs(ofmsgs)
+        self.table.apply_ofmsgs(self.reconcile(ofmsgs))
+
+    def reconnect(self):
+        self.valve.datapath_disconnect(self.DP_ID)
+        ofmsgs = self.valve.datapath_connect(
+            self.DP_ID, range(1, self.NUM_PORTS + 1))
+        ofmsgs = self.reconcile(ofmsgs)
+        flowdels = [
+            ofmsg for ofmsg in ofmsgs if valve_of.is_flowdel(ofmsg)]
+        flowadds = [
+            ofmsg for ofmsg in ofmsgs if valve_of.is_flowadd(ofmsg)]
+        # FakeOFTable refuses overlapping flows a switch would accept, so
+        # those are added again, but no other flows are.
+        self.assertLess(len(flowadds), len(self.valve._static_flows()) / 2)
+        self.table.apply_ofmsgs(ofmsgs)
+        return flowdels
+
+    def test_reconcile_reconnect(self):
+        """Test reconnect keeps learned hosts, and only fixes stale flows."""
+        self.assertEqual([], self.reconnect())
+
+        cookie = self.valve.dp.cookie
+        stale_flows = [
+            # learned host on a VLAN no longer configured.
+            valve_of.flowmod(
+                cookie, ofp.OFPFC_ADD, self.valve.dp.eth_src_table,
+                self.valve.dp.highest_priority, 0, 0,
+                parser.OFPMatch(
+                    vlan_vid=0x300|ofp.OFPVID_PRESENT,
+                    eth_src=self.UNKNOWN_MAC),
+                [valve_of.goto_table(self.valve.dp.eth_dst_table)], 0, 0),
+            # port no longer configured.
+            valve_of.flowmod(
+                cookie, ofp.OFPFC_ADD, self.valve.dp.vlan_table,
+                self.valve.dp.low_priority, 0, 0,
+                parser.OFPMatch(in_port=6),
+                [valve_of.goto_table(self.valve.dp.eth_src_table)], 0, 0),
+            ]
+        self.table.apply_ofmsgs(stale_flows)
+        self.assertEqual(2, len(self.reconnect()))
+        self.assertEqual([], self.reconnect())
+        # Learned hosts are still forwarded to.
+        self.assertTrue(
+            self.table.is_output(
+                {'in_port': 3, 'vlan_vid': self.V200,
+                 'eth_src': self.P3_V200_MAC, 'eth_dst': self.P2_V200_MAC},
+                port=2, vid=0))
+
+    def test_reconcile_port_vlan_changed(self):
+        """Test host flows are deleted when their port leaves the VLAN."""
+        host_match = {
+            'in_port': 2, 'vlan_vid': 0,
+            'eth_src': self.P2_V200_MAC, 'eth_dst': self.P3_V200_MAC}
+        self.assertTrue(self.table.is_output(host_match, port=3))
+        self.restart(self.CONFIG.replace(
+            "                tagged_vlans: [v100, v200]\n",
+            "                tagged_vlans: [v100]\n"))
+        self.assertFalse(self.table.is_output(host_match, port=3))
+        # Hosts learned on other ports are kept.
+        self.assertTrue(
+            self.table.is_output(
+                {'in_port': 4, 'vlan_vid': self.V200,
+                 'eth_src': self.UNKNOWN_MAC, 'eth_dst': self.P2_V200_MAC},
+                port=2, vid=0))
+
+
+class ValveRouteReconcileTestCase(ValveRouteTestCase):
+    """Repeats the routing tests with flows reconciled on connect."""
+
+    CONFIG = ValveRouteTestCase.CONFIG.replace(
+        "        dp_id: 1\n",
+        "        dp_id: 1\n        reconcile_flows: True\n")
+
+    def connect_dp(self):
+        ofmsgs = self.valve.datapath_connect(
+            self.DP_ID,
+            range(1, self.NUM_PORTS + 1)
+            )
+        self.table.apply_ofmsgs(ofmsgs)
+        self.table.apply_ofmsgs(self.reconcile(ofmsgs))
+
+    def fib_matches(self, field, value):
+        """Return FIB and eth_src table flows matching field on value."""
+        return [
+            fte for table_id in (
+                self.valve.dp.eth_src_table, self.valve.dp.ipv4_fib_table)
+            for fte in self.table.tables[table_id]
+            if value in str(fte.match.get(field, ''))]
+
+    def test_reconcile_removed_controller_ip(self):
+        """Test flows for a controller IP removed on restart are deleted."""
+        self.assertTrue(self.fib_matches('arp_tpa', '10.0.0.254'))
+        self.assertTrue(self.fib_matches('ipv4_dst', '10.0.0.254'))
+        self.restart(self.CONFIG.replace('10.0.0.254/24', '10.0.0.253/24'))
+        self.assertFalse(self.fib_matches('arp_tpa', '10.0.0.254'))
+        self.assertFalse(self.fib_matches('ipv4_dst', '10.0.0.254'))
+        self.assertTrue(self.fib_matches('arp_tpa', '10.0.0.253'))
+
+    def test_reconcile_removed_route(self):
+        """Test route flows are deleted on restart, and re-added if routed."""
+        vlan = self.valve.dp.vlans[0x100]
+        bgp_route = ipaddr.IPNetwork('10.9.0.0/16')
+        self.rcv_arp_reply(1, self.P1_V100_MAC, str(self.GW1))
+        self.table.apply_ofmsgs(self.valve.add_route(vlan, self.GW1, bgp_route))
+        self.assertEqual(
+            set([self.DST1, self.DST2, self.GW1_HOST, bgp_route]),
+            self.fib_route_dsts())
+        self.restart(self.CONFIG.replace(
+            "            - route:\n"
+            "                ip_dst: '10.0.1.0/24'\n"
+            "                ip_gw: '10.0.0.1'\n", ""))
+        self.assertEqual(set(), self.fib_route_dsts())
+        # Routes still configured are added once the nexthop is resolved.
+        self.assertIn(self.GW1, self.resolved_arp_targets())
+        self.rcv_arp_reply(1, self.P1_V100_MAC, str(self.GW1))
+        self.assertEqual(set([self.DST2]), self.fib_route_dsts())
+
+    def test_reconcile_reconnect_keeps_routes(self):
+        """Test routes via resolved nexthops are kept on reconnect."""
+        routed_match = {
+            'in_port': 3, 'vlan_vid': self.V100,
+            'eth_src': self.P2_V200_MAC,
+            'eth_dst': self.valve.FAUCET_MAC,
+            'eth_type': 0x800, 'ipv4_dst': '10.0.2.1'}
+        self.rcv_arp_reply(1, self.P1_V100_MAC, str(self.GW1))
+        route_dsts = set([self.DST1, self.DST2, self.GW1_HOST])
+        self.assertEqual(route_dsts, self.fib_route_dsts())
+        self.valve.datapath_disconnect(self.DP_ID)
+        ofmsgs = self.reconcile(self.valve.datapath_connect(
+            self.DP_ID, range(1, self.NUM_PORTS + 1)))
+        self.assertEqual([], [
+            ofmsg for ofmsg in ofmsgs
+            if valve_of.is_flowdel(ofmsg) and
+            ofmsg.table_id == self.valve.dp.ipv4_fib_table])
+        self.table.apply_ofmsgs(ofmsgs)
+        self.assertEqual(route_dsts, self.fib_route_dsts())
+        self.assertTrue(
+            self.table.is_output(routed_match, port=1, vid=0),
+            msg='routed packet not output to nexthop after reconnect')
+        # The resolved nexthop is not resolved again.
+        self.assertEqual(set([self.GW2]), self.resolved_arp_targets())
+
+
+class ValveGroupRouteReconcileTestCase(ValveRouteReconcileTestCase):
+    """Repeats the routing tests with flows reconciled, and nexthop groups."""
+
+    CONFIG = ValveGroupRouteTestCase.CONFIG.replace(
+        "        dp_id: 1\n",
+        "        dp_id: 1\n        reconcile_flows: True\n")
+
+
+class ValveGroupTableTestCase(ValveTestCase):
+    """Repeats the tests with flooding done by groups."""
+
+    CONFIG = ValveTestCase.CONFIG.replace(
+        "        dp_id: 1\n",
+        "        dp_id: 1\n        group_table: True\n")
+
+    def test_group_flood(self):
+        """Test each VLAN floods with groups, and few flows."""
+        flood_table = self.valve.dp.flood_table
+        # An all ports and a unicast flood group, for each VLAN.
+        self.assertEqual(
+            set([0x100, 0x200, 0x1100, 0x1200]), set(self.table.groups))
+        # A flow per destination, except unknown unicast which has a flow
+        # per port in the VLAN, as well as the default drop flow.
+        self.assertEqual(
+            2 * (len(valve_flood.ValveFloodManager.FLOOD_DSTS) - 1) + 6 + 1,
+            len(self.table.tables[flood_table]))
+
+    def test_group_flood_port_delete(self):
+        """Test a port going down changes only the groups it is in."""
+        flood_table = self.valve.dp.flood_table
+        ofmsgs = self.valve.port_delete(dp_id=self.DP_ID, port_num=1)
+        groupmods = [
+            ofmsg for ofmsg in ofmsgs
+            if isinstance(ofmsg, parser.OFPGroupMod)]
+        self.assertEqual(
+            [(0x100, ofp.OFPGC_MODIFY), (0x1100, ofp.OFPGC_MODIFY)],
+            sorted([(groupmod.group_id, groupmod.command)
+                    for groupmod in groupmods]))
+        self.assertEqual([], [
+            ofmsg for ofmsg in ofmsgs
+            if isinstance(ofmsg, parser.OFPFlowMod) and
+            ofmsg.table_id == flood_table and not valve_of.is_flowdel(ofmsg)])
+        self.table.apply_ofmsgs(ofmsgs)
+        self.assertFalse(
+            self.table.is_output(
+                {'in_port': 2, 'vlan_vid': self.V100}, port=1),
+            msg='packet flooded to port that is down')
+        # Port 5 is not in any VLAN, so is in no groups.
+        self.assertEqual([], [
+            ofmsg for ofmsg in self.valve.port_delete(
+                dp_id=self.DP_ID, port_num=5)
+            if isinstance(ofmsg, parser.OFPGroupMod)])
+
+
+class ValveGroupTableReloadConfigTestCase(ValveReloadConfigTestCase):
+    """Repeats the tests after a config reload, with flooding by groups."""
+
+    CONFIG = ValveGroupTableTestCase.CONFIG
+    OLD_CONFIG = ValveReloadConfigTestCase.OLD_CONFIG.replace(
+        "        dp_id: 1\n",
+        "        dp_id: 1\n        group_table: True\n")
+
+
+class FakeDatapath(object):
+    """A Ryu datapath that records the bytes written to it."""
+
+    ofproto = ofp
+    ofproto_parser = parser
+
+    def __init__(self, dp_id):
+        self.id = dp_id
+        self.xid = 0
+        self.writes = []
+
+    def send(self, buf):
+        self.writes.append(buf)
+
+    def sent_xids(self):
+        """Return the xids of the OpenFlow messages written, in order."""
+        xids = []
+        for buf in self.writes:
+            offset = 0
+            while offset < len(buf):
+                _, _, msg_len, xid = struct.unpack_from(
+                    ofp.OFP_HEADER_PACK_STR, buf, offset)
+                xids.append(xid)
+                offset += msg_len
+        return xids
+
+
+class ValveSendFlowMsgsTestCase(ValveTestBase):
+    """Test OpenFlow messages are batched into writes to the datapath."""
+
+    def setUp(self):
+        super(ValveSendFlowMsgsTestCase, self).setUp()
+        self.faucet = Faucet.__new__(Faucet)
+        self.faucet.logger = logging.getLogger('test_valve.faucet')
+        self.faucet.valves = {self.DP_ID: self.valve}
+        self.ryu_dp = FakeDatapath(self.DP_ID)
+
+    def flowmods(self, count):
+        return [
+            valve_of.flowmod(
+                0, ofp.OFPFC_ADD, 0, priority, ofp.OFPP_ANY, ofp.OFPG_ANY,
+                parser.OFPMatch(in_port=1), [], 0, 0)
+            for priority in range(count)]
+
+    def test_batches_split(self):
+        """Test messages are split into writes no larger than the limit."""
+        flowmods = self.flowmods(10)
+        msg_len = len(valve_of.serialize_offline(flowmods[0]))
+        self.valve.dp.max_flow_msg_batch_bytes = msg_len * 3 + 1
+        self.faucet._send_flow_msgs(self.ryu_dp, flowmods)
+        self.assertEqual(
+            [msg_len * 3, msg_len * 3, msg_len * 3, msg_len],
+            [len(buf) for buf in self.ryu_dp.writes])
+        self.assertEqual(
+            ''.join([str(flowmod.buf) for flowmod in flowmods]),
+            ''.join(self.ryu_dp.writes))
+
+    def test_message_over_limit(self):
+        """Test a message larger than the limit is written on its own."""
+        flowmods = self.flowmods(3)
+        self.valve.dp.max_flow_msg_batch_bytes = 1
+        self.faucet._send_flow_msgs(self.ryu_dp, flowmods)
+        self.assertEqual(
+            [str(flowmod.buf) for flowmod in flowmods], self.ryu_dp.writes)
+
+    def test_xids(self):
+        """Test each message sent has a new, increasing xid."""
+        flowmods = self.flowmods(3)
+        self.faucet._send_flow_msgs(self.ryu_dp, flowmods)
+        # Messages that already have an xid (eg. sent before) get a new one.
+        self.faucet._send_flow_msgs(
+            self.ryu_dp, flowmods + [valve_of.barrier()])
+        self.assertEqual(range(1, 8), self.ryu_dp.sent_xids())
+        self.assertEqual(7, self.ryu_dp.xid)
+        # xids wrap around.
+        self.ryu_dp.xid = ofp.MAX_XID
+        self.faucet._send_flow_msgs(self.ryu_dp, self.flowmods(2))
+        self.assertEqual([0, 1], self.ryu_dp.sent_xids()[-2:])
+
+
 if __name__ == "__main__":
     unittest.main()